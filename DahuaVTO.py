@@ -1,27 +1,58 @@
 #!/usr/bin/env python3
 
+import asyncio
 import sys
 import logging
 from time import sleep
+from typing import Any, Dict, List, Optional
 
 from clients.DahuaClient import DahuaClient
+from clients.Metrics import MetricsServer
 from clients.MQTTClient import MQTTClient
+from clients.Profiler import Profiler
+from common.consts import RUNTIME_MODE, RUNTIME_ASYNCIO, STATS_DEVICES, STATS_EVENT_CODES, STATS_EVENT_CODES_SUPPRESSED
+from models.DahuaConfigData import DahuaConfigurationData
 
 
 class DahuaVTOManager:
-    def __init__(self):
-        self._mqtt_client = MQTTClient()
-        self._dahua_client = DahuaClient()
+    def __init__(self, devices: Optional[List[DahuaConfigurationData]] = None):
+        self._dahua_client = DahuaClient(devices)
+        self._mqtt_client = MQTTClient(self._dahua_client.devices)
 
     def initialize(self):
+        if RUNTIME_MODE == RUNTIME_ASYNCIO:
+            asyncio.run(self.initialize_async())
+            return
+
         self._mqtt_client.initialize(self._dahua_client.outgoing_events)
         self._dahua_client.initialize(self._mqtt_client.outgoing_events)
 
         while True:
             sleep(1)
 
+    async def initialize_async(self):
+        """
+            Single event loop runtime, both clients run on this loop and hand events over through asyncio queues.
+        """
+        self._mqtt_client.outgoing_events = self._mqtt_client.create_async_queue()
+        self._dahua_client.outgoing_events = self._dahua_client.create_async_queue()
 
-if __name__ == "__main__":
+        await asyncio.gather(
+            self._mqtt_client.initialize_async(self._dahua_client.outgoing_events),
+            self._dahua_client.initialize_async(self._mqtt_client.outgoing_events)
+        )
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            "dahua": self._dahua_client.get_stats(),
+            "mqtt": self._mqtt_client.get_stats(),
+            STATS_DEVICES: self._dahua_client.get_device_stats(),
+            STATS_EVENT_CODES: self._dahua_client.get_event_code_stats(),
+            STATS_EVENT_CODES_SUPPRESSED: self._dahua_client.get_suppressed_code_stats()
+        }
+
+
+def setup_logging():
     log_level = logging.DEBUG
     root = logging.getLogger()
     root.setLevel(log_level)
@@ -35,7 +66,15 @@ if __name__ == "__main__":
     stream_handler.setFormatter(formatter)
     root.addHandler(stream_handler)
 
+
+if __name__ == "__main__":
+    setup_logging()
+
     logger = logging.getLogger(__name__)
 
     manager = DahuaVTOManager()
+
+    MetricsServer.start_if_enabled(manager.get_stats)
+    Profiler.install_signal()
+
     manager.initialize()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+from threading import Thread
+from time import monotonic, sleep
+from typing import Any, Dict, List, Optional
+
+from DahuaVTO import DahuaVTOManager, setup_logging
+from clients.Metrics import MetricsServer, merge_stats
+from clients.Profiler import Profiler
+from common.consts import *
+from models.DevicesConfigData import DevicesConfigurationData
+
+logger = logging.getLogger(__name__)
+
+
+class HashRing:
+    """
+        Consistent hashing of device names to shards.
+
+        A device keeps its shard across restarts, changing the number of shards only moves the devices
+        of the added / removed shard.
+    """
+
+    def __init__(self, shards: int, replicas: int = 128):
+        self._ring: List[int] = []
+        self._shards: Dict[int, int] = {}
+
+        for shard in range(shards):
+            for replica in range(replicas):
+                point = self._hash(f"shard-{shard}-{replica}")
+
+                self._shards[point] = shard
+                bisect.insort(self._ring, point)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def get_shard(self, key: str) -> int:
+        index = bisect.bisect(self._ring, self._hash(key)) % len(self._ring)
+
+        return self._shards[self._ring[index]]
+
+
+def run_worker(shard: int, items: List[Dict[str, Any]], stats_queue: multiprocessing.Queue, client_id: str):
+    """
+        Worker process entry point, bridges its share of the devices on its own MQTT client ID.
+    """
+    os.environ["MQTT_BROKER_CLIENT_ID"] = client_id
+
+    # Shutdown is driven by the supervisor (SIGTERM), ignore the Ctrl+C sent to the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Profiler.install_signal()
+
+    setup_logging()
+
+    devices = DevicesConfigurationData(items=items).devices
+    manager = DahuaVTOManager(devices)
+
+    def report_stats():
+        while True:
+            sleep(SUPERVISOR_STATS_INTERVAL)
+
+            try:
+                stats_queue.put_nowait((shard, os.getpid(), manager.get_stats()))
+
+            except Exception as ex:
+                logger.warning(f"Worker #{shard} failed to report stats, error: {ex}")
+
+    Thread(target=report_stats, name=f"Worker-{shard}-Stats", daemon=True).start()
+
+    manager.initialize()
+
+
+class DahuaVTOSupervisor:
+    """
+        Splits the devices of DAHUA_DEVICES_FILE across worker processes, so event decoding scales with cores.
+
+        Each worker runs a DahuaVTOManager for its shard and publishes on its own MQTT client ID
+        ({MQTT_BROKER_CLIENT_ID}-{shard}). Crashed workers are restarted with a capped exponential delay,
+        their health and counters are collected over a multiprocessing queue and logged combined.
+    """
+
+    def __init__(self, workers: int = SUPERVISOR_WORKERS):
+        devices_config = DevicesConfigurationData()
+
+        if not devices_config.items:
+            raise ValueError("The supervisor requires a devices file, set DAHUA_DEVICES_FILE")
+
+        self._context = multiprocessing.get_context("spawn")
+        self._stats_queue = self._context.Queue()
+        self._client_id = os.environ.get('MQTT_BROKER_CLIENT_ID', DEFAULT_MQTT_CLIENT_ID)
+        self._is_running = True
+
+        ring = HashRing(workers)
+        self._shards: Dict[int, List[Dict[str, Any]]] = {}
+
+        for item in devices_config.items:
+            self._shards.setdefault(ring.get_shard(item["name"]), []).append(item)
+
+        self._processes: Dict[int, multiprocessing.Process] = {}
+        self._restarts: Dict[int, int] = {shard: 0 for shard in self._shards}
+        self._restart_delays: Dict[int, float] = {shard: SUPERVISOR_RESTART_DELAY for shard in self._shards}
+        self._restart_at: Dict[int, float] = {}
+        self._started_at: Dict[int, float] = {}
+        self._stats: Dict[int, Dict[str, Any]] = {}
+
+        for shard in sorted(self._shards):
+            names = ", ".join(item["name"] for item in self._shards[shard])
+            logger.info(f"Shard #{shard}: {names}")
+
+    def initialize(self):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+
+        if PROFILE_SIGNAL is not None:
+            signal.signal(PROFILE_SIGNAL, self._on_profile_signal)
+
+        for shard in self._shards:
+            self._start(shard)
+
+        next_report = monotonic() + SUPERVISOR_STATS_INTERVAL
+
+        while self._is_running:
+            self._collect_stats(1)
+            self._monitor()
+
+            if monotonic() >= next_report:
+                self._report()
+                next_report = monotonic() + SUPERVISOR_STATS_INTERVAL
+
+        self.terminate()
+
+    def terminate(self):
+        logger.info("Terminating workers")
+
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+
+        for process in self._processes.values():
+            process.join(10)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Counters of all workers combined"""
+        totals: Dict[str, Any] = {}
+
+        for stats in list(self._stats.values()):
+            merge_stats(totals, stats)
+
+        totals["supervisor"] = {
+            "workers": len(self._shards),
+            "workers_alive": sum(1 for process in self._processes.values() if process.is_alive()),
+            "restarts": sum(self._restarts.values())
+        }
+
+        return totals
+
+    def _on_signal(self, signum, frame):
+        logger.info(f"Received signal {signum}")
+
+        self._is_running = False
+
+    def _on_profile_signal(self, signum, frame):
+        """
+            Profile the workers, the supervisor itself only relays their stats.
+        """
+        for process in self._processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    def _start(self, shard: int):
+        process = self._context.Process(
+            target=run_worker,
+            args=(shard, self._shards[shard], self._stats_queue, f"{self._client_id}-{shard}"),
+            name=f"DahuaVTOWorker-{shard}",
+            daemon=True
+        )
+        process.start()
+
+        self._processes[shard] = process
+        self._started_at[shard] = monotonic()
+
+        logger.info(f"Worker #{shard} started, PID: {process.pid}, Devices: {len(self._shards[shard])}")
+
+    def _monitor(self):
+        now = monotonic()
+
+        for shard, process in self._processes.items():
+            if process.is_alive():
+                # Reset the restart delay once a worker stays up
+                if now - self._started_at[shard] > SUPERVISOR_RESTART_MAX_DELAY:
+                    self._restart_delays[shard] = SUPERVISOR_RESTART_DELAY
+
+                continue
+
+            restart_at = self._restart_at.get(shard)
+
+            if restart_at is None:
+                delay = self._restart_delays[shard]
+
+                logger.error(f"Worker #{shard} exited with code {process.exitcode}, restarting in {delay} seconds")
+
+                self._stats.pop(shard, None)
+                self._restart_at[shard] = now + delay
+                self._restart_delays[shard] = min(delay * 2, SUPERVISOR_RESTART_MAX_DELAY)
+
+            elif now >= restart_at:
+                del self._restart_at[shard]
+                self._restarts[shard] += 1
+
+                self._start(shard)
+
+    def _collect_stats(self, timeout: float):
+        try:
+            shard, pid, stats = self._stats_queue.get(timeout=timeout)
+
+            while True:
+                process = self._processes.get(shard)
+
+                # Ignore late reports of a replaced worker
+                if process is not None and process.pid == pid:
+                    self._stats[shard] = stats
+
+                shard, pid, stats = self._stats_queue.get_nowait()
+
+        except queue.Empty:
+            pass
+
+    def _report(self):
+        stats = self.get_stats()
+
+        for section in sorted(stats):
+            # Per device sections are left to the metrics endpoint
+            if section in (STATS_DEVICES, STATS_EVENT_CODES, STATS_EVENT_CODES_SUPPRESSED):
+                continue
+
+            values = ", ".join(f"{key}: {value}" for key, value in sorted(stats[section].items()))
+            logger.info(f"Stats [{section}] {values}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Run the devices of DAHUA_DEVICES_FILE in several worker processes")
+    parser.add_argument("--workers", type=int, default=SUPERVISOR_WORKERS, help="Number of worker processes")
+    args = parser.parse_args(argv)
+
+    setup_logging()
+
+    supervisor = DahuaVTOSupervisor(max(1, args.workers))
+
+    MetricsServer.start_if_enabled(supervisor.get_stats)
+
+    supervisor.initialize()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
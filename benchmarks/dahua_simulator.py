@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+"""
+    Simulated Dahua VTO / NVR devices speaking DHIP, to run and load test the bridge without hardware.
+
+    Every device listens on its own port, starting at --port. It answers what DahuaAPI sends:
+        global.login (challenge, then the MD5 response of DahuaAPI._get_hashed_password is checked)
+        global.keepAlive, magicBox.getSoftwareVersion / getDeviceType, configManager.getConfig
+        system.multicall, accessControl.factory.instance / openDoor
+        eventManager.attach, after which events of the --mix are streamed at --rate per device:
+            doorbell - Invite, then CallNoAnswered
+            motion   - VideoMotion Start / Stop
+            ivs      - a storm of --storm-size CrossRegionDetection frames of a moving object, coalesced in one write
+
+    Faults are injected per write with the given probabilities:
+        --split  the frame is written in pieces, a few milliseconds apart
+        --stall  the device stops writing for --stall-seconds, what it had to say is sent afterward
+        --reset  the connection is reset (RST)
+
+    --devices-file writes the matching DAHUA_DEVICES_FILE for the bridge.
+
+    Usage: python benchmarks/dahua_simulator.py [--devices 100] [--port 5000] [--rate 5] [--mix doorbell=1,motion=5,ivs=1]
+           [--split 0.05] [--stall 0.001] [--reset 0.0005] [--devices-file devices.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import struct
+import sys
+from time import monotonic, time
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for key, value in {
+    "DAHUA_VTO_HOST": "127.0.0.1",
+    "DAHUA_VTO_USERNAME": "admin",
+    "DAHUA_VTO_PASSWORD": "admin",
+    "MQTT_BROKER_HOST": "127.0.0.1",
+}.items():
+    os.environ.setdefault(key, value)
+
+from clients.DahuaAPI import DahuaAPI  # noqa: E402
+from clients.DHIPCodec import DHIPDecoder, DHIPEncoder  # noqa: E402
+from common.consts import *  # noqa: E402
+
+DAHUA_NOTIFY_EVENT_STREAM = "client.notifyEventStream"
+
+ERROR_LOGIN_CHALLENGE = {"code": 268632079, "message": "Component error: login challenge!"}
+ERROR_INVALID_PASSWORD = {"code": 268632085, "message": "Component error: invalid username or password!"}
+ERROR_NOT_LOGGED_IN = {"code": 287637505, "message": "Invalid session in request data!"}
+ERROR_UNSUPPORTED = {"code": 268894210, "message": "Method not found!"}
+
+DEFAULT_MIX = "doorbell=1,motion=5,ivs=1"
+
+# IVS coordinates are relative, 0 - 8191
+IVS_MAX_COORDINATE = 8191
+IVS_BOX_SIZE = 1200
+
+
+class SimulatorStats:
+    def __init__(self):
+        self.connections = 0
+        self.active = 0
+        self.logins = 0
+        self.login_failures = 0
+        self.requests = 0
+        self.events = 0
+        self.frames = 0
+        self.bytes = 0
+        self.splits = 0
+        self.stalls = 0
+        self.resets = 0
+
+    def get_stats(self) -> Dict[str, int]:
+        return dict(self.__dict__)
+
+
+class SimulatedDevice:
+    """
+        Identity and event generators of one device, kept across its connections.
+    """
+
+    def __init__(self, index: int, args: argparse.Namespace):
+        self.index = index
+        self.name = f"sim-{index:04d}"
+        self.port = args.port + index
+        self.serial_number = f"SIM{index:09d}"
+        self.device_type = "VTO2202F-P" if index % 2 == 0 else "IPC-HFW5442E-ZE"
+        self.realm = f"Login to {self.serial_number}"
+
+        self.call_id = 0
+        self.motion = False
+        self.object_id = 0
+        self.event_id = 0
+
+    @staticmethod
+    def _stamp(data: Dict[str, Any]) -> Dict[str, Any]:
+        now = time()
+        data["UTC"] = int(now)
+        data["UTCMS"] = int(now * 1000) % 1000
+
+        return data
+
+    def doorbell(self, storm_size: int) -> List[Dict[str, Any]]:
+        self.call_id += 1
+
+        invite = {"CallID": str(self.call_id), "LockNum": 2, "TCPPort": 37777, "UserID": "9901"}
+        unanswered = {"CallID": str(self.call_id)}
+
+        return [
+            {"Action": "Pulse", "Code": "Invite", "Data": self._stamp(invite), "Index": 0},
+            {"Action": "Start", "Code": "CallNoAnswered", "Data": self._stamp(unanswered), "Index": 0},
+        ]
+
+    def motion_event(self, storm_size: int) -> List[Dict[str, Any]]:
+        self.motion = not self.motion
+        action = "Start" if self.motion else "Stop"
+
+        return [{"Action": action, "Code": "VideoMotion", "Data": self._stamp({"SmartMotionEnable": False}), "Index": 0}]
+
+    def ivs_storm(self, storm_size: int) -> List[Dict[str, Any]]:
+        """
+            One object crossing a region, every frame moves its box a little, some frames not at all.
+        """
+        self.object_id += 1
+
+        left = random.randint(0, IVS_MAX_COORDINATE - IVS_BOX_SIZE)
+        top = random.randint(0, IVS_MAX_COORDINATE - IVS_BOX_SIZE)
+        events = []
+
+        for sequence in range(storm_size):
+            if sequence == 0:
+                action = "Appear"
+            elif sequence == storm_size - 1:
+                action = "Disappear"
+            else:
+                action = "Move"
+
+            if sequence % 3 != 2:
+                left = min(max(0, left + random.randint(-300, 300)), IVS_MAX_COORDINATE - IVS_BOX_SIZE)
+                top = min(max(0, top + random.randint(-300, 300)), IVS_MAX_COORDINATE - IVS_BOX_SIZE)
+
+            self.event_id += 1
+
+            event_object = {
+                "Action": action,
+                "BoundingBox": [left, top, left + IVS_BOX_SIZE, top + IVS_BOX_SIZE],
+                "Center": [left + IVS_BOX_SIZE // 2, top + IVS_BOX_SIZE // 2],
+                "ObjectID": self.object_id,
+                "ObjectType": "Human",
+            }
+            data = {
+                "Action": action,
+                "Class": "Normal",
+                "EventID": self.event_id,
+                "Name": "IVS-1",
+                "Object": event_object,
+                "RuleID": 1,
+            }
+
+            events.append({
+                "Action": "Stop" if action == "Disappear" else "Start",
+                "Code": "CrossRegionDetection",
+                "Data": self._stamp(data),
+                "Index": 0
+            })
+
+        return events
+
+
+class SimulatedConnection(asyncio.Protocol):
+    """
+        One session of the bridge with a simulated device.
+    """
+
+    def __init__(self, device: SimulatedDevice, args: argparse.Namespace, stats: SimulatorStats):
+        self.device = device
+        self.args = args
+        self.stats = stats
+
+        self.transport: Optional[asyncio.Transport] = None
+        self.decoder = DHIPDecoder()
+        self.session_id = random.randint(1, 2 ** 31 - 1)
+        self.random = str(random.randint(10 ** 9, 10 ** 10 - 1))
+        self.logged_in = False
+        self.attach_id: Optional[int] = None
+        self.codes: Optional[List[str]] = None
+        self.stream: Optional[asyncio.Task] = None
+        self.object_id = random.randint(1000, 9999)
+
+        # Written after a split or stall ended, later writes queue up behind it
+        self.held = bytearray()
+        self.release_handle: Optional[asyncio.TimerHandle] = None
+
+        self.generators: Dict[str, Callable[[int], List[Dict[str, Any]]]] = {
+            "doorbell": device.doorbell,
+            "motion": device.motion_event,
+            "ivs": device.ivs_storm,
+        }
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        self.stats.connections += 1
+        self.stats.active += 1
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.stats.active -= 1
+
+        if self.stream is not None:
+            self.stream.cancel()
+
+        if self.release_handle is not None:
+            self.release_handle.cancel()
+
+    def data_received(self, data: bytes):
+        for message in self.decoder.decode(data):
+            replies = []
+
+            self.handle(message, replies.append)
+
+            for reply in replies:
+                self.write([reply])
+
+    def handle(self, message: Dict[str, Any], reply: Callable[[Dict[str, Any]], None]):
+        self.stats.requests += 1
+
+        method = message.get("method")
+        request_id = message.get("id")
+        params = message.get("params") or {}
+
+        def respond(result: Any = True, response_params: Any = None, error: Optional[Dict[str, Any]] = None):
+            response = {"id": request_id, "session": self.session_id, "result": result, "params": response_params}
+
+            if error is not None:
+                response["error"] = error
+
+            reply(response)
+
+        if method == DAHUA_GLOBAL_LOGIN:
+            self.login(params, respond)
+
+        elif not self.logged_in:
+            respond(False, None, ERROR_NOT_LOGGED_IN)
+
+        elif method == DAHUA_SYSTEM_MULTICALL and isinstance(params, list):
+            results = []
+
+            for call in params:
+                self.handle(call, results.append)
+
+            respond(True, results)
+
+        elif method == DAHUA_GLOBAL_KEEPALIVE:
+            respond(True, {"timeout": params.get("timeout")})
+
+        elif method == DAHUA_MAGICBOX_GETSOFTWAREVERSION:
+            respond(True, {"version": {"BuildDate": "2023-05-10", "Version": "4.600.0000000.5.R"}})
+
+        elif method == DAHUA_MAGICBOX_GETDEVICETYPE:
+            respond(True, {"type": self.device.device_type})
+
+        elif method == DAHUA_CONFIG_MANAGER_GETCONFIG and params.get("name") == "T2UServer":
+            respond(True, {"table": {"Enable": True, "UUID": self.device.serial_number}})
+
+        elif method == DAHUA_CONFIG_MANAGER_GETCONFIG and params.get("name") == "AccessControl":
+            respond(True, {"table": [{"AccessProtocol": "Local", "Name": "Door1", "UnlockReloadInterval": 2}]})
+
+        elif method == DAHUA_EVENT_MANAGER_ATTACH:
+            codes = params.get("codes") or [DAHUA_EVENT_CODES_ALL]
+
+            self.codes = None if DAHUA_EVENT_CODES_ALL in codes else codes
+            self.attach_id = request_id
+
+            respond(True, {"SID": 513})
+
+            if self.stream is None:
+                self.stream = asyncio.get_running_loop().create_task(self.stream_events())
+
+        elif method == DAHUA_ACCESS_CONTROL_FACTORY_INSTANCE:
+            respond(self.object_id)
+
+        elif method == DAHUA_ACCESS_CONTROL_OPEN_DOOR:
+            respond(message.get("object") == self.object_id)
+
+        else:
+            respond(False, None, ERROR_UNSUPPORTED)
+
+    def login(self, params: Dict[str, Any], respond: Callable[..., None]):
+        if not params.get("password"):
+            challenge = {"encryption": "Default", "random": self.random, "realm": self.device.realm}
+
+            respond(False, challenge, ERROR_LOGIN_CHALLENGE)
+            return
+
+        expected = DahuaAPI._get_hashed_password(self.random, self.device.realm, self.args.username, self.args.password)
+
+        if params.get("userName") != self.args.username or params.get("password") != expected:
+            self.stats.login_failures += 1
+
+            respond(False, None, ERROR_INVALID_PASSWORD)
+            return
+
+        self.logged_in = True
+        self.stats.logins += 1
+
+        respond(True, {"keepAliveInterval": self.args.keepalive_interval})
+
+    async def stream_events(self):
+        kinds = list(self.args.mix.keys())
+        weights = list(self.args.mix.values())
+
+        while not self.transport.is_closing():
+            await asyncio.sleep(random.expovariate(self.args.rate))
+
+            kind = random.choices(kinds, weights)[0]
+            events = self.generators[kind](self.args.storm_size)
+
+            if self.codes is not None:
+                events = [event for event in events if event["Code"] in self.codes]
+
+            if not events:
+                continue
+
+            notifications = [
+                {
+                    "id": self.attach_id,
+                    "method": DAHUA_NOTIFY_EVENT_STREAM,
+                    "params": {"SID": 513, "eventList": [event]},
+                    "session": self.session_id
+                }
+                for event in events
+            ]
+
+            self.stats.events += len(events)
+
+            if kind == "ivs":
+                # A storm arrives coalesced, as busy cameras send it
+                self.write(notifications)
+
+            else:
+                for notification in notifications:
+                    self.write([notification])
+
+    def write(self, messages: List[Dict[str, Any]]):
+        if self.transport is None or self.transport.is_closing():
+            return
+
+        data = b"".join(DHIPEncoder.encode(message) for message in messages)
+
+        self.stats.frames += len(messages)
+        self.stats.bytes += len(data)
+
+        if random.random() < self.args.reset:
+            self.reset()
+            return
+
+        if self.held:
+            self.held += data
+            return
+
+        if random.random() < self.args.stall:
+            self.stats.stalls += 1
+            self.hold(data, self.args.stall_seconds)
+            return
+
+        if random.random() < self.args.split and len(data) > 1:
+            self.stats.splits += 1
+
+            cut = random.randint(1, len(data) - 1)
+
+            self.transport.write(data[:cut])
+            self.hold(data[cut:], random.uniform(0.001, 0.02))
+            return
+
+        self.transport.write(data)
+
+    def hold(self, data: bytes, delay: float):
+        self.held += data
+        self.release_handle = asyncio.get_running_loop().call_later(delay, self.release)
+
+    def release(self):
+        self.release_handle = None
+
+        data, self.held = bytes(self.held), bytearray()
+
+        if not self.transport.is_closing():
+            self.transport.write(data)
+
+    def reset(self):
+        self.stats.resets += 1
+
+        sock = self.transport.get_extra_info("socket")
+
+        if sock is not None:
+            # Linger 0, the close sends a RST instead of a FIN
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+
+        self.transport.abort()
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+
+        if kind not in ("doorbell", "motion", "ivs"):
+            raise argparse.ArgumentTypeError(f"Unknown event kind: {kind}, expected doorbell, motion or ivs")
+
+        mix[kind] = float(weight or 1)
+
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError("The mix needs at least one kind with a positive weight")
+
+    return mix
+
+
+def write_devices_file(path: str, devices: List[SimulatedDevice], args: argparse.Namespace):
+    data = {
+        "devices": [
+            {
+                "name": device.name,
+                "host": args.advertised_host or args.host,
+                "port": device.port,
+                "username": args.username,
+                "password": args.password
+            }
+            for device in devices
+        ]
+    }
+
+    # Replaced at once, the file is read as soon as it exists
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(data, file, indent=2)
+
+    os.replace(f"{path}.tmp", path)
+
+    print(f"Devices file for the bridge written to {path}")
+
+
+async def report(stats: SimulatorStats, interval: float):
+    previous = stats.get_stats()
+    started = monotonic()
+
+    while True:
+        await asyncio.sleep(interval)
+
+        current = stats.get_stats()
+        events_per_second = (current["events"] - previous["events"]) / interval
+        previous = current
+
+        print(
+            f"[{monotonic() - started:8.0f}s] sessions: {current['active']}, logins: {current['logins']}, "
+            f"login failures: {current['login_failures']}, events: {current['events']} ({events_per_second:.0f}/s), "
+            f"frames: {current['frames']}, splits: {current['splits']}, stalls: {current['stalls']}, "
+            f"resets: {current['resets']}",
+            flush=True
+        )
+
+
+async def run(args: argparse.Namespace):
+    loop = asyncio.get_running_loop()
+    stats = SimulatorStats()
+    devices = [SimulatedDevice(index, args) for index in range(args.devices)]
+
+    for device in devices:
+        await loop.create_server(
+            lambda device=device: SimulatedConnection(device, args, stats),
+            args.host,
+            device.port,
+            reuse_address=True
+        )
+
+    print(
+        f"Simulating {len(devices)} devices on {args.host}:{args.port}-{args.port + len(devices) - 1}, "
+        f"{args.rate} events/s each, mix: {args.mix}",
+        flush=True
+    )
+
+    if args.devices_file:
+        write_devices_file(args.devices_file, devices, args)
+
+    await report(stats, args.stats_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=1, help="Number of simulated devices")
+    parser.add_argument("--host", default="127.0.0.1", help="Address the devices listen on")
+    parser.add_argument("--advertised-host", help="Host written to the devices file, when not --host")
+    parser.add_argument("--port", type=int, default=5000, help="Port of the first device, the others follow")
+    parser.add_argument("--username", default=os.environ["DAHUA_VTO_USERNAME"], help="Accepted username")
+    parser.add_argument("--password", default=os.environ["DAHUA_VTO_PASSWORD"], help="Accepted password")
+    parser.add_argument("--keepalive-interval", type=int, default=60, help="keepAliveInterval given on login")
+    parser.add_argument("--rate", type=float, default=1.0, help="Events picked from the mix per device per second")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help="Weights of the event kinds")
+    parser.add_argument("--storm-size", type=int, default=20, help="Frames of an IVS storm")
+    parser.add_argument("--split", type=float, default=0.0, help="Probability a write is split in two")
+    parser.add_argument("--stall", type=float, default=0.0, help="Probability a write stalls the device")
+    parser.add_argument("--stall-seconds", type=float, default=5.0, help="Duration of a stall")
+    parser.add_argument("--reset", type=float, default=0.0, help="Probability a write resets the connection")
+    parser.add_argument("--seed", type=int, help="Seed of the random generator, for repeatable runs")
+    parser.add_argument("--devices-file", help="Write the DAHUA_DEVICES_FILE of the simulated devices here")
+    parser.add_argument("--stats-interval", type=float, default=10.0, help="Seconds between the stats lines")
+    args = parser.parse_args()
+
+    if args.rate <= 0:
+        parser.error("--rate must be positive")
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    try:
+        asyncio.run(run(args))
+
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+    Microbenchmarks of the codec and publish hot paths, offline (no device or broker).
+
+    Every benchmark reports ops/s (median of --repeat rounds), the p50 / p99 latency of a single call and the peak
+    memory allocated per call (tracemalloc), results are compared to benchmarks/baselines.json and regressions are flagged.
+    Only ops/s, p50 and allocations are compared, p99 of a single run is too noisy.
+    Baselines are machine specific and not part of the repository, save them (--save) on the machine the comparison runs on.
+
+    Usage: python benchmarks/microbench.py [--filter decode] [--save] [--threshold 0.3] [--json results.json]
+    Exits with 1 when a benchmark regressed.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import tracemalloc
+from time import perf_counter, perf_counter_ns
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for key, value in {
+    "DAHUA_VTO_HOST": "127.0.0.1",
+    "DAHUA_VTO_USERNAME": "admin",
+    "DAHUA_VTO_PASSWORD": "admin",
+    "MQTT_BROKER_HOST": "127.0.0.1",
+    "DEVICE_DETAILS_CACHE_FILE": "",
+}.items():
+    os.environ.setdefault(key, value)
+
+from clients.BoundedQueue import BoundedQueue  # noqa: E402
+from clients.DahuaAPI import DahuaAPI  # noqa: E402
+from clients.DHIPCodec import DHIPDecoder, DHIPEncoder  # noqa: E402
+from clients.MQTTClient import MQTTClient  # noqa: E402
+from common.consts import DAHUA_GLOBAL_KEEPALIVE, EVENT_QUEUE_POLICY  # noqa: E402
+from models.DahuaConfigData import DahuaConfigurationData  # noqa: E402
+
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+# The CrossRegionDetection sample of DahuaAPI.parse_response
+IVS_MESSAGE = {
+    "id": 7,
+    "method": "client.notifyEventStream",
+    "params": {
+        "SID": 513,
+        "eventList": [
+            {
+                "Action": "Start",
+                "Code": "CrossRegionDetection",
+                "Data": {
+                    "Action": "Appear", "CfgRuleId": 3, "Class": "Normal", "CountInGroup": 1,
+                    "DetectRegion": [[1692, 44], [-1, 3996], [-1, 8185], [8188, 8185], [6280, 5401], [3116, 5231]],
+                    "EventID": 10065, "EventSeq": 64, "FrameSequence": 5409291, "GroupID": 64,
+                    "LocaleTime": "2023-09-18 12:48:48", "Mark": 0, "Name": "IVS-1",
+                    "Object": {
+                        "Action": "Appear", "Age": 0, "Angle": 0, "Bag": 0, "BagType": 0,
+                        "BoundingBox": [2976, 2688, 5840, 8160], "CarrierBag": 0, "Center": [4408, 5424],
+                        "Confidence": 0, "DownClothes": 0, "Express": 0, "FaceFlag": 0, "FaceRect": [0, 0, 0, 0],
+                        "FrameSequence": 5409291, "Gender": 0, "Glass": 0, "HairStyle": 0, "HasHat": 0, "Helmet": 0,
+                        "HumanRect": [0, 0, 0, 0], "LowerBodyColor": [0, 0, 0, 0], "MainColor": [0, 0, 0, 0],
+                        "MessengerBag": 0, "ObjectID": 4812, "ObjectType": "Human", "Phone": 0, "RelativeID": 0,
+                        "SerialUUID": "", "ShoulderBag": 0, "Source": 0.0, "Speed": 0, "SpeedTypeInternal": 0,
+                        "Umbrella": 0, "UpClothes": 0, "UpperBodyColor": [0, 0, 0, 0], "UpperPattern": 0
+                    },
+                    "PTS": 43625989680.0, "Priority": 0, "RuleID": 3, "RuleId": 1, "Source": -1.0, "Track": [],
+                    "UTC": 1695041328, "UTCMS": 10
+                },
+                "Index": 0
+            }
+        ]
+    },
+    "session": 1099860316
+}
+IVS_FRAME = DHIPEncoder.encode(IVS_MESSAGE)
+COALESCED_FRAMES = IVS_FRAME * 8
+SPLIT_AT = (len(IVS_FRAME) // 3, 2 * len(IVS_FRAME) // 3)
+
+KEEPALIVE_REQUEST = {
+    "id": 1234,
+    "magic": "0x1234",
+    "method": DAHUA_GLOBAL_KEEPALIVE,
+    "params": {"timeout": 55, "action": True},
+    "session": 1099860316
+}
+
+
+class Sink:
+    """Outgoing queue that keeps nothing"""
+
+    def put_nowait(self, item: Any):
+        pass
+
+
+class PublishResult:
+    rc = 0
+    mid = 1
+
+
+def benchmark_decode_single() -> Callable[[], Any]:
+    return lambda: DahuaAPI.parse_response(IVS_FRAME)
+
+
+def benchmark_decode_coalesced() -> Callable[[], Any]:
+    decoder = DHIPDecoder()
+
+    return lambda: decoder.decode(COALESCED_FRAMES)
+
+
+def benchmark_decode_split() -> Callable[[], Any]:
+    decoder = DHIPDecoder()
+    first, second = SPLIT_AT
+    chunks = (IVS_FRAME[:first], IVS_FRAME[first:second], IVS_FRAME[second:])
+
+    def run():
+        for chunk in chunks:
+            decoder.decode(chunk)
+
+    return run
+
+
+def benchmark_convert_message() -> Callable[[], Any]:
+    return lambda: DahuaAPI.convert_message(KEEPALIVE_REQUEST)
+
+
+def benchmark_notify_enrichment() -> Callable[[], Any]:
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+    api = DahuaAPI(Sink(), DahuaConfigurationData(), lambda _: None)
+    api.dahua_details = {"serialNumber": "8H0123456789", "deviceType": "VTO2000A", "version": "4.500"}
+    params = IVS_MESSAGE["params"]
+
+    def run():
+        # The session adds its stamps to the event, start from a fresh copy as the device would send it
+        api.handle_notify_event_stream({"SID": 513, "eventList": [dict(params["eventList"][0])]})
+
+    return run
+
+
+def benchmark_mqtt_serialize() -> Callable[[], Any]:
+    client = MQTTClient()
+    client.is_connected = True
+    client._mqtt_client.publish = lambda *args, **kwargs: PublishResult()
+    event_data = {
+        "device": None,
+        "event": "CrossRegionDetection/Event",
+        "payload": IVS_MESSAGE["params"]["eventList"][0]
+    }
+
+    return lambda: client._event_received(event_data)
+
+
+def benchmark_queue_handoff() -> Callable[[], Any]:
+    client = MQTTClient()
+    client._incoming_events = BoundedQueue(10000, EVENT_QUEUE_POLICY)
+    event_data = {"device": None, "event": "VideoMotion/Event", "payload": {}}
+
+    def run():
+        client._incoming_events.put_nowait(event_data)
+
+        for _ in client._get_batch():
+            client._incoming_events.task_done()
+
+    return run
+
+
+BENCHMARKS: Dict[str, Callable[[], Callable[[], Any]]] = {
+    "decode_single": benchmark_decode_single,
+    "decode_coalesced": benchmark_decode_coalesced,
+    "decode_split": benchmark_decode_split,
+    "convert_message": benchmark_convert_message,
+    "notify_enrichment": benchmark_notify_enrichment,
+    "mqtt_serialize": benchmark_mqtt_serialize,
+    "queue_handoff": benchmark_queue_handoff,
+}
+
+
+def measure(run: Callable[[], Any], duration: float, samples: int, repeat: int) -> Dict[str, float]:
+    for _ in range(100):
+        run()
+
+    gc.collect()
+    gc.disable()
+
+    try:
+        # Throughput, calls in a tight loop for repeat rounds that share duration, the median round counts
+        rates = []
+
+        for _ in range(repeat):
+            calls = 0
+            started = perf_counter()
+            deadline = started + duration / repeat
+
+            while perf_counter() < deadline:
+                for _ in range(100):
+                    run()
+
+                calls += 100
+
+            rates.append(calls / (perf_counter() - started))
+
+        # Latency of single calls
+        latencies = []
+
+        for _ in range(samples):
+            started_ns = perf_counter_ns()
+            run()
+            latencies.append(perf_counter_ns() - started_ns)
+
+    finally:
+        gc.enable()
+
+    # Memory, the peak allocated during a call above what was allocated before it
+    peaks = []
+    tracemalloc.start()
+
+    try:
+        for _ in range(min(samples, 1000)):
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            run()
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+
+    return {
+        "ops_per_sec": round(statistics.median(rates), 1),
+        "p50_us": round(latencies[len(latencies) // 2] / 1000, 3),
+        "p99_us": round(latencies[int(len(latencies) * 0.99)] / 1000, 3),
+        "alloc_bytes": round(statistics.mean(peaks), 1)
+    }
+
+
+def compare(result: Dict[str, float], baseline: Optional[Dict[str, float]], threshold: float) -> List[str]:
+    """
+        :return: The regressions of a result against its baseline
+    """
+    if baseline is None:
+        return []
+
+    regressions = []
+
+    if result["ops_per_sec"] < baseline["ops_per_sec"] * (1 - threshold):
+        regressions.append(f"ops/s {baseline['ops_per_sec']:.0f} -> {result['ops_per_sec']:.0f}")
+
+    if result["p50_us"] > baseline["p50_us"] * (1 + threshold):
+        regressions.append(f"p50 {baseline['p50_us']:.1f} -> {result['p50_us']:.1f} us")
+
+    if result["alloc_bytes"] > baseline["alloc_bytes"] * (1 + threshold) + 64:
+        regressions.append(f"alloc {baseline['alloc_bytes']:.0f} -> {result['alloc_bytes']:.0f} B")
+
+    return regressions
+
+
+def load_baselines() -> Dict[str, Any]:
+    if not os.path.exists(BASELINES_FILE):
+        return {}
+
+    with open(BASELINES_FILE) as file:
+        return json.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", default="", help="Run the benchmarks whose name contains this")
+    parser.add_argument("--duration", type=float, default=1.0, help="Seconds of the throughput run per benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="Rounds of the throughput run, the median is reported")
+    parser.add_argument("--samples", type=int, default=10000, help="Single calls timed per benchmark")
+    parser.add_argument("--threshold", type=float, default=0.3, help="Change flagged as a regression")
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baselines")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    baselines = load_baselines()
+
+    if not baselines and not args.save:
+        print(f"No baselines in {BASELINES_FILE}, run with --save first to compare")
+
+    results: Dict[str, Dict[str, float]] = {}
+    regressed = False
+
+    print(f"{'benchmark':<20} {'ops/s':>12} {'p50 us':>9} {'p99 us':>9} {'alloc B':>9}")
+
+    for name, create in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+
+        result = measure(create(), args.duration, args.samples, max(1, args.repeat))
+        regressions = compare(result, baselines.get("results", {}).get(name), args.threshold)
+        results[name] = result
+        regressed = regressed or bool(regressions)
+
+        flag = f"  REGRESSION: {', '.join(regressions)}" if regressions else ""
+
+        print(
+            f"{name:<20} {result['ops_per_sec']:>12,.0f} {result['p50_us']:>9.2f} {result['p99_us']:>9.2f} "
+            f"{result['alloc_bytes']:>9.0f}{flag}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=4)
+
+    if args.save:
+        baselines = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": {**baselines.get("results", {}), **results}
+        }
+
+        with open(BASELINES_FILE, "w") as file:
+            json.dump(baselines, file, indent=4)
+
+        print(f"Baselines saved to {BASELINES_FILE}")
+
+    sys.exit(1 if regressed and not args.save else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+    Minimal MQTT 3.1.1 broker, a stand-in for the real one in soak and load tests.
+
+    It accepts what MQTTClient does:
+        - CONNECT with username / password, wrong credentials are refused
+        - SUBSCRIBE, wildcards included
+        - PUBLISH at QoS 0 and 1, routed to the matching subscribers at QoS 0
+        - PINGREQ, DISCONNECT
+
+    Nothing is retained or persisted.
+    disconnect_clients() drops every connection and can refuse new ones for a while, like a restarting broker.
+    Published events are timed against their Data.UTC / UTCMS stamps, from the device to the broker.
+
+    Runs on a thread of its own (MQTTBroker.start) or standalone.
+
+    Usage: python benchmarks/mqtt_broker.py [--port 1883] [--username user --password secret]
+"""
+import argparse
+import asyncio
+import json
+import os
+import struct
+import sys
+from threading import Thread
+from time import sleep, time
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for key, value in {
+    "DAHUA_VTO_HOST": "127.0.0.1",
+    "DAHUA_VTO_USERNAME": "admin",
+    "DAHUA_VTO_PASSWORD": "admin",
+    "MQTT_BROKER_HOST": "127.0.0.1",
+}.items():
+    os.environ.setdefault(key, value)
+
+from paho.mqtt.client import topic_matches_sub  # noqa: E402
+
+from clients.Metrics import Histogram  # noqa: E402
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+CONNACK_ACCEPTED = 0
+CONNACK_SERVER_UNAVAILABLE = 3
+CONNACK_NOT_AUTHORIZED = 5
+
+FLAG_USERNAME = 0x80
+FLAG_PASSWORD = 0x40
+FLAG_WILL = 0x04
+
+UINT16 = struct.Struct("!H")
+
+
+def encode_packet(packet_type: int, body: bytes, flags: int = 0) -> bytes:
+    header = bytearray([(packet_type << 4) | flags])
+    length = len(body)
+
+    while True:
+        byte, length = length % 128, length // 128
+        header.append(byte | 0x80 if length else byte)
+
+        if not length:
+            break
+
+    return bytes(header) + body
+
+
+def encode_string(value: str) -> bytes:
+    data = value.encode("utf-8")
+
+    return UINT16.pack(len(data)) + data
+
+
+def read_string(body: bytes, offset: int) -> Tuple[bytes, int]:
+    length = UINT16.unpack_from(body, offset)[0]
+    offset += UINT16.size
+
+    return body[offset:offset + length], offset + length
+
+
+class BrokerSession(asyncio.Protocol):
+    def __init__(self, broker: "MQTTBroker"):
+        self.broker = broker
+        self.transport: Optional[asyncio.Transport] = None
+        self.buffer = bytearray()
+        self.client_id: Optional[str] = None
+        self.subscriptions: List[str] = []
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.broker.sessions.discard(self)
+
+    def data_received(self, data: bytes):
+        self.buffer += data
+
+        while True:
+            packet = self._next_packet()
+
+            if packet is None:
+                return
+
+            self.handle(*packet)
+
+    def _next_packet(self) -> Optional[Tuple[int, int, bytes]]:
+        buffer = self.buffer
+        length = 0
+        multiplier = 1
+
+        for position in range(1, min(len(buffer), 5)):
+            byte = buffer[position]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+
+            if byte & 0x80:
+                continue
+
+            end = position + 1 + length
+
+            if len(buffer) < end:
+                return None
+
+            packet = (buffer[0] >> 4, buffer[0] & 0x0F, bytes(buffer[position + 1:end]))
+            del buffer[:end]
+
+            return packet
+
+        return None
+
+    def send(self, packet_type: int, body: bytes = b"", flags: int = 0):
+        if not self.transport.is_closing():
+            self.transport.write(encode_packet(packet_type, body, flags))
+
+    def handle(self, packet_type: int, flags: int, body: bytes):
+        if self.client_id is None and packet_type != CONNECT:
+            self.transport.close()
+
+        elif packet_type == CONNECT:
+            self.handle_connect(body)
+
+        elif packet_type == PUBLISH:
+            self.handle_publish(flags, body)
+
+        elif packet_type == SUBSCRIBE:
+            self.handle_subscribe(body)
+
+        elif packet_type == UNSUBSCRIBE:
+            packet_id, offset = body[:2], 2
+
+            while offset < len(body):
+                topic, offset = read_string(body, offset)
+
+                if topic.decode("utf-8") in self.subscriptions:
+                    self.subscriptions.remove(topic.decode("utf-8"))
+
+            self.send(UNSUBACK, packet_id)
+
+        elif packet_type == PINGREQ:
+            self.send(PINGRESP)
+
+        elif packet_type == DISCONNECT:
+            self.transport.close()
+
+    def handle_connect(self, body: bytes):
+        broker = self.broker
+        protocol, offset = read_string(body, 0)
+        connect_flags = body[offset + 1]
+        offset += 4
+
+        client_id, offset = read_string(body, offset)
+        username = password = None
+
+        if connect_flags & FLAG_WILL:
+            _, offset = read_string(body, offset)
+            _, offset = read_string(body, offset)
+
+        if connect_flags & FLAG_USERNAME:
+            username, offset = read_string(body, offset)
+
+        if connect_flags & FLAG_PASSWORD:
+            password, offset = read_string(body, offset)
+
+        if broker.refusing:
+            broker.connects_refused += 1
+            return_code = CONNACK_SERVER_UNAVAILABLE
+
+        elif broker.username is not None and (
+                username != broker.username.encode("utf-8") or password != (broker.password or "").encode("utf-8")
+        ):
+            broker.auth_failures += 1
+            return_code = CONNACK_NOT_AUTHORIZED
+
+        else:
+            return_code = CONNACK_ACCEPTED
+
+        self.send(CONNACK, bytes([0, return_code]))
+
+        if return_code != CONNACK_ACCEPTED:
+            self.transport.close()
+            return
+
+        self.client_id = client_id.decode("utf-8")
+        broker.connects += 1
+        broker.sessions.add(self)
+
+    def handle_publish(self, flags: int, body: bytes):
+        qos = (flags >> 1) & 0x03
+        topic, offset = read_string(body, 0)
+
+        if qos > 0:
+            self.send(PUBACK, body[offset:offset + 2])
+            offset += 2
+
+        self.broker.received(topic.decode("utf-8"), body[offset:])
+
+    def handle_subscribe(self, body: bytes):
+        packet_id, offset = body[:2], 2
+        granted = bytearray()
+
+        while offset < len(body):
+            topic, offset = read_string(body, offset)
+            offset += 1
+
+            self.subscriptions.append(topic.decode("utf-8"))
+            granted.append(0)
+
+        self.broker.subscribes += 1
+        self.send(SUBACK, packet_id + bytes(granted))
+
+
+class MQTTBroker:
+    """
+        The broker and its counters, served by an event loop on a daemon thread.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 1883, username: str = None, password: str = None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+
+        self.sessions = set()
+        self.refusing = False
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+        self.connects = 0
+        self.connects_refused = 0
+        self.auth_failures = 0
+        self.subscribes = 0
+        self.publishes = 0
+        self.publish_bytes = 0
+        self.disconnects_injected = 0
+        self.latency = Histogram()
+
+    def get_stats(self) -> Dict[str, Any]:
+        sessions = list(self.sessions)
+
+        return {
+            "clients": len(sessions),
+            "subscriptions": sum(len(session.subscriptions) for session in sessions),
+            "connects": self.connects,
+            "connects_refused": self.connects_refused,
+            "auth_failures": self.auth_failures,
+            "subscribes": self.subscribes,
+            "publishes": self.publishes,
+            "publish_bytes": self.publish_bytes,
+            "disconnects_injected": self.disconnects_injected,
+            **self.latency.get_stats("latency")
+        }
+
+    def start(self):
+        """
+            Serve from a daemon thread, returns once the port is bound.
+        """
+        self.loop = asyncio.new_event_loop()
+
+        self._server = self.loop.run_until_complete(
+            self.loop.create_server(lambda: BrokerSession(self), self.host, self.port, reuse_address=True)
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+
+        Thread(target=self.loop.run_forever, name="MQTTBroker", daemon=True).start()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def disconnect_clients(self, refuse_seconds: float = 0):
+        """
+            Drop all connections, new ones are refused for refuse_seconds.
+        """
+        def disconnect():
+            self.disconnects_injected += 1
+            self.refusing = refuse_seconds > 0
+
+            for session in list(self.sessions):
+                session.transport.abort()
+
+            if self.refusing:
+                self.loop.call_later(refuse_seconds, setattr, self, "refusing", False)
+
+        self.loop.call_soon_threadsafe(disconnect)
+
+    def publish(self, topic: str, payload: Any):
+        """
+            Deliver a message to the subscribers, as another client of the broker would.
+        """
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+
+        self.loop.call_soon_threadsafe(self._route, topic, data)
+
+    def received(self, topic: str, payload: bytes):
+        self.publishes += 1
+        self.publish_bytes += len(payload)
+
+        self._observe_latency(payload)
+        self._route(topic, payload)
+
+    def _route(self, topic: str, payload: bytes):
+        packet = None
+
+        for session in list(self.sessions):
+            if any(topic_matches_sub(subscription, topic) for subscription in session.subscriptions):
+                packet = packet or encode_packet(PUBLISH, encode_string(topic) + payload)
+
+                if not session.transport.is_closing():
+                    session.transport.write(packet)
+
+    def _observe_latency(self, payload: bytes):
+        # Event payloads carry the device stamps, cheap check before parsing
+        if b'"UTC"' not in payload:
+            return
+
+        try:
+            data = json.loads(payload).get("Data") or {}
+            device_at = data["UTC"] + (data.get("UTCMS") or 0) % 1000 / 1000
+
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return
+
+        self.latency.observe(time() - device_at)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=1883, help="Port to listen on")
+    parser.add_argument("--username", help="Required username, anonymous clients are accepted without it")
+    parser.add_argument("--password", help="Required password")
+    args = parser.parse_args()
+
+    broker = MQTTBroker(args.host, args.port, args.username, args.password)
+    broker.start()
+
+    print(f"Listening on {args.host}:{broker.port}", flush=True)
+
+    try:
+        while True:
+            sleep(10)
+
+            stats = broker.get_stats()
+
+            print(
+                f"clients: {stats['clients']}, connects: {stats['connects']}, publishes: {stats['publishes']}, "
+                f"auth failures: {stats['auth_failures']}",
+                flush=True
+            )
+
+    except KeyboardInterrupt:
+        broker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+    Compare the event handoff latency of the threaded and asyncio runtimes.
+
+    Events are decoded from DHIP frames by a DahuaAPI session and handed to the MQTTClient listener,
+    latency is measured from the frame being fed to the decoder until MQTTClient publishes it.
+    The paho publish call is replaced by a recorder, no device or broker is needed.
+
+    Usage: python benchmarks/runtime_latency.py [--events 5000] [--interval 0.0005]
+"""
+import argparse
+import asyncio
+import os
+import queue
+import statistics
+import sys
+import threading
+from time import perf_counter
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for key, value in {
+    "DAHUA_VTO_HOST": "127.0.0.1",
+    "DAHUA_VTO_USERNAME": "admin",
+    "DAHUA_VTO_PASSWORD": "admin",
+    "MQTT_BROKER_HOST": "127.0.0.1",
+}.items():
+    os.environ.setdefault(key, value)
+
+from clients.DahuaAPI import DahuaAPI  # noqa: E402
+from clients.DHIPCodec import DHIPEncoder  # noqa: E402
+from clients.MQTTClient import MQTTClient  # noqa: E402
+from models.DahuaConfigData import DahuaConfigurationData  # noqa: E402
+
+FRAME = DHIPEncoder.encode({
+    "id": 7,
+    "method": "client.notifyEventStream",
+    "params": {
+        "SID": 513,
+        "eventList": [
+            {
+                "Action": "Pulse",
+                "Code": "VideoMotion",
+                "Data": {"LocaleTime": "2023-09-18 12:48:48", "UTC": 1695041328, "UTCMS": 10},
+                "Index": 0
+            }
+        ]
+    },
+    "session": 1099860316
+})
+
+
+class PublishResult:
+    rc = 0
+    mid = 1
+
+
+class PublishRecorder:
+    def __init__(self, expected: int):
+        self.published: List[float] = []
+        self.expected = expected
+        self.done = threading.Event()
+
+    def publish(self, topic, payload=None, *args, **kwargs):
+        self.published.append(perf_counter())
+
+        if len(self.published) >= self.expected:
+            self.done.set()
+
+        return PublishResult()
+
+
+def create_mqtt_client(expected: int) -> Tuple[MQTTClient, PublishRecorder]:
+    recorder = PublishRecorder(expected)
+
+    client = MQTTClient()
+    client.is_connected = True
+    client._mqtt_client.publish = recorder.publish
+
+    return client, recorder
+
+
+async def produce(api: DahuaAPI, events: int, interval: float) -> List[float]:
+    fed = []
+
+    for _ in range(events):
+        fed.append(perf_counter())
+
+        for message in api._decoder.decode(FRAME):
+            api.handle_notify_event_stream(message.get("params"))
+
+        await asyncio.sleep(interval)
+
+    return fed
+
+
+def run_threaded(events: int, interval: float) -> List[float]:
+    mqtt_client, recorder = create_mqtt_client(events)
+    events_queue = queue.Queue()
+    mqtt_client.initialize(events_queue)
+
+    async def main():
+        api = DahuaAPI(events_queue, DahuaConfigurationData(), lambda _: None)
+
+        return await produce(api, events, interval)
+
+    fed = asyncio.run(main())
+    recorder.done.wait(30)
+    events_queue.put(None)
+
+    return [published - sent for sent, published in zip(fed, recorder.published)]
+
+
+def run_asyncio(events: int, interval: float) -> List[float]:
+    mqtt_client, recorder = create_mqtt_client(events)
+
+    async def main():
+        events_queue = asyncio.Queue()
+        mqtt_client._incoming_events = events_queue
+        listener = asyncio.get_running_loop().create_task(mqtt_client._listen_async())
+
+        api = DahuaAPI(events_queue, DahuaConfigurationData(), lambda _: None)
+        fed = await produce(api, events, interval)
+
+        while len(recorder.published) < events:
+            await asyncio.sleep(0.01)
+
+        listener.cancel()
+
+        return fed
+
+    fed = asyncio.run(main())
+
+    return [published - sent for sent, published in zip(fed, recorder.published)]
+
+
+def report(name: str, latencies: List[float]):
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2] * 1e6
+    p99 = latencies[int(len(latencies) * 0.99)] * 1e6
+
+    print(
+        f"{name:<10} events: {len(latencies):>6}, mean: {statistics.mean(latencies) * 1e6:8.1f} us, "
+        f"p50: {p50:8.1f} us, p99: {p99:8.1f} us, max: {latencies[-1] * 1e6:8.1f} us"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--interval", type=float, default=0.0005, help="Seconds between events")
+    args = parser.parse_args()
+
+    report("threaded", run_threaded(args.events, args.interval))
+    report("asyncio", run_asyncio(args.events, args.interval))
+
+
+if __name__ == "__main__":
+    main()
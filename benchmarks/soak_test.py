@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+"""
+    Soak test, runs the bridge for hours against simulated devices and the MQTT broker stand-in
+    and fails when its resources grow without bound.
+
+    The bridge (DahuaVTO.py) and the device simulator run as subprocesses, the broker in this process.
+    Every --sample-interval seconds the bridge is sampled:
+        RSS, threads and open files from /proc
+        queue depths, pending requests, scheduled timers, tracked objects from its metrics endpoint
+        latency from the device to paho (bridge) and from the device to the broker (stand-in)
+
+    The broker drops the bridge every --disconnect-interval seconds, the first time halfway through the warmup,
+    a door is opened every --command-interval.
+    After --warmup, the run is cut into --windows time windows and the growth per hour of the minimum of every
+    series per window is fitted, outages and bursts do not count, a rising floor does. A series growing faster
+    than its limit fails the run, as does the bridge exiting or no longer publishing.
+
+    Usage: python benchmarks/soak_test.py [--duration 21600] [--devices 50] [--rate 2] [--csv soak.csv]
+           [--limits rss_mib=16,threads=1] [--bridge-log bridge.log]
+    Exits with 1 when the run failed.
+"""
+import argparse
+import csv
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+from time import monotonic, sleep
+from typing import Dict, List, Optional, Tuple
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for key, value in {
+    "DAHUA_VTO_HOST": "127.0.0.1",
+    "DAHUA_VTO_USERNAME": "admin",
+    "DAHUA_VTO_PASSWORD": "admin",
+    "MQTT_BROKER_HOST": "127.0.0.1",
+}.items():
+    os.environ.setdefault(key, value)
+
+from benchmarks.mqtt_broker import MQTTBroker  # noqa: E402
+from common.consts import DEFAULT_MQTT_TOPIC_PREFIX, METRICS_PREFIX, TOPIC_COMMAND, TOPIC_DOOR  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BROKER_USERNAME = "soak"
+BROKER_PASSWORD = "soak"
+
+# Metrics of the bridge sampled as series, by metric name without the prefix
+METRIC_SERIES = {
+    "dahua_queue_depth": "dahua_queue",
+    "mqtt_queue_depth": "mqtt_queue",
+    "dahua_pending_requests": "pending_requests",
+    "dahua_timers": "timers",
+    "dahua_objects_tracked": "objects_tracked",
+    "dahua_events_held": "events_held",
+    "mqtt_spool_pending": "spool_pending",
+}
+
+# Latency histograms, the mean over each sample interval
+LATENCY_SERIES = {
+    "mqtt_latency_total": "latency_bridge",
+    "broker_latency": "latency_broker",
+}
+
+# Growth per hour a series may show after the warmup
+DEFAULT_LIMITS = {
+    "rss_mib": 16.0,
+    "threads": 1.0,
+    "fds": 2.0,
+    "dahua_queue": 100.0,
+    "mqtt_queue": 100.0,
+    "pending_requests": 10.0,
+    "timers": 10.0,
+    "objects_tracked": 100.0,
+    "events_held": 100.0,
+    "spool_pending": 100.0,
+    "latency_bridge": 0.5,
+    "latency_broker": 0.5,
+}
+
+
+def parse_limits(value: str) -> Dict[str, float]:
+    limits = {}
+
+    for item in value.split(","):
+        name, _, limit = item.partition("=")
+
+        if name.strip() not in DEFAULT_LIMITS:
+            raise argparse.ArgumentTypeError(f"Unknown series: {name}, expected one of {', '.join(DEFAULT_LIMITS)}")
+
+        limits[name.strip()] = float(limit)
+
+    return limits
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+
+        return sock.getsockname()[1]
+
+
+def sample_process(pid: int) -> Dict[str, float]:
+    sample = {}
+
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            name, _, value = line.partition(":")
+
+            if name == "VmRSS":
+                sample["rss_mib"] = int(value.split()[0]) / 1024
+
+            elif name == "Threads":
+                sample["threads"] = int(value)
+
+    sample["fds"] = len(os.listdir(f"/proc/{pid}/fd"))
+
+    return sample
+
+
+def scrape_metrics(port: int) -> Dict[str, float]:
+    """
+        The unlabeled metrics of the bridge, by name without the prefix.
+    """
+    metrics = {}
+
+    with urlopen(f"http://127.0.0.1:{port}/metrics", timeout=10) as response:
+        for line in response.read().decode("utf-8").splitlines():
+            if line.startswith("#") or "{" in line:
+                continue
+
+            name, _, value = line.partition(" ")
+            metrics[name[len(METRICS_PREFIX) + 1:]] = float(value)
+
+    return metrics
+
+
+def get_growth(samples: List[Dict[str, float]], series: str, windows: int) -> Optional[float]:
+    """
+        Growth of a series per hour, the least squares slope of its minimum per time window.
+        Bursts (a broker outage fills the queues, starts threads) come and go, a leak raises the floor.
+    """
+    points = [(sample["elapsed"], sample[series]) for sample in samples if sample.get(series) is not None]
+
+    if len(points) < windows or windows < 2:
+        return None
+
+    started, ended = points[0][0], points[-1][0]
+    width = (ended - started) / windows or 1
+    floors: Dict[int, Tuple[float, float]] = {}
+
+    for x, y in points:
+        window = min(int((x - started) / width), windows - 1)
+        floors[window] = min(floors.get(window, (x, y)), (x, y), key=lambda point: point[1])
+
+    points = [(started + (window + 0.5) * width, y) for window, (x, y) in sorted(floors.items())]
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+
+    if variance == 0:
+        return None
+
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance * 3600
+
+
+class SoakTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.work_dir = args.work_dir or tempfile.mkdtemp(prefix="dahuavto2mqtt-soak-")
+        self.devices_file = os.path.join(self.work_dir, "devices.json")
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.metrics_port = get_free_port()
+        self.limits = {**DEFAULT_LIMITS, **args.limits}
+
+        self.broker = MQTTBroker(port=0, username=BROKER_USERNAME, password=BROKER_PASSWORD)
+        self.simulator: Optional[subprocess.Popen] = None
+        self.bridge: Optional[subprocess.Popen] = None
+        self.bridge_log = None
+
+        self.samples: List[Dict[str, float]] = []
+        self.failures: List[str] = []
+        self._previous: Dict[str, float] = {}
+
+    def start(self):
+        args = self.args
+
+        self.broker.start()
+
+        self.simulator = subprocess.Popen(
+            [
+                sys.executable, os.path.join(ROOT, "benchmarks", "dahua_simulator.py"),
+                "--devices", str(args.devices),
+                "--port", str(args.device_port),
+                "--rate", str(args.rate),
+                "--mix", args.mix,
+                "--split", str(args.split),
+                "--stall", str(args.stall),
+                "--reset", str(args.reset),
+                "--devices-file", self.devices_file,
+                "--stats-interval", str(args.sample_interval)
+            ],
+            stdout=subprocess.DEVNULL
+        )
+
+        deadline = monotonic() + 30
+
+        while not os.path.exists(self.devices_file):
+            if monotonic() > deadline or self.simulator.poll() is not None:
+                raise RuntimeError("The device simulator did not start")
+
+            sleep(0.1)
+
+        environment = {
+            **os.environ,
+            "DAHUA_DEVICES_FILE": self.devices_file,
+            "MQTT_BROKER_HOST": "127.0.0.1",
+            "MQTT_BROKER_PORT": str(self.broker.port),
+            "MQTT_BROKER_USERNAME": BROKER_USERNAME,
+            "MQTT_BROKER_PASSWORD": BROKER_PASSWORD,
+            "METRICS_HOST": "127.0.0.1",
+            "METRICS_PORT": str(self.metrics_port),
+            "DEVICE_DETAILS_CACHE_FILE": os.path.join(self.work_dir, "details.json"),
+        }
+        # Door commands go over the session to the simulator, which has no HTTP API
+        environment.setdefault("DAHUA_DOOR_OPEN_METHOD", "rpc")
+
+        self.bridge_log = open(args.bridge_log, "w") if args.bridge_log else subprocess.DEVNULL
+        self.bridge = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "DahuaVTO.py")],
+            env=environment,
+            stdout=self.bridge_log,
+            stderr=subprocess.STDOUT
+        )
+
+        print(
+            f"Soaking the bridge (pid {self.bridge.pid}) for {args.duration:.0f}s with {args.devices} devices "
+            f"at {args.rate} events/s, work directory {self.work_dir}",
+            flush=True
+        )
+
+    def stop(self):
+        for process in (self.bridge, self.simulator):
+            if process is None or process.poll() is not None:
+                continue
+
+            process.terminate()
+
+            try:
+                process.wait(10)
+
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+        if self.bridge_log not in (None, subprocess.DEVNULL):
+            self.bridge_log.close()
+
+        self.broker.stop()
+
+    def run(self) -> bool:
+        args = self.args
+        started = monotonic()
+        # The first drop within the warmup, the memory a full queue takes is then part of the baseline
+        first_disconnect = min(args.disconnect_interval, args.warmup / 2) if args.warmup > 0 else args.disconnect_interval
+        next_disconnect = started + first_disconnect if args.disconnect_interval > 0 else None
+        next_command = started + args.command_interval if args.command_interval > 0 else None
+        idle_samples = 0
+
+        self.start()
+
+        try:
+            while monotonic() - started < args.duration:
+                sleep(args.sample_interval)
+                now = monotonic()
+
+                if self.bridge.poll() is not None:
+                    self.failures.append(f"The bridge exited with {self.bridge.returncode}")
+                    break
+
+                if self.simulator.poll() is not None:
+                    self.failures.append(f"The device simulator exited with {self.simulator.returncode}")
+                    break
+
+                sample = self.sample(now - started)
+
+                if sample is None:
+                    continue
+
+                self.samples.append(sample)
+                self.report(sample)
+
+                # Events keep coming, nothing reaching the broker for long means the bridge is stuck
+                idle_samples = idle_samples + 1 if sample["published"] == 0 else 0
+
+                if idle_samples * args.sample_interval >= args.stall_timeout:
+                    self.failures.append(f"Nothing was published for {idle_samples * args.sample_interval:.0f}s")
+                    break
+
+                if next_disconnect is not None and now >= next_disconnect:
+                    print("Disconnecting the bridge from the broker", flush=True)
+
+                    self.broker.disconnect_clients(args.refuse_seconds)
+                    next_disconnect = now + args.disconnect_interval
+
+                if next_command is not None and now >= next_command:
+                    device = f"sim-{random.randrange(args.devices):04d}"
+                    topic = f"{DEFAULT_MQTT_TOPIC_PREFIX}/{device}{TOPIC_COMMAND}/{TOPIC_DOOR}"
+
+                    self.broker.publish(topic, {"Door": 1})
+                    next_command = now + args.command_interval
+
+        except KeyboardInterrupt:
+            print("Interrupted, evaluating the samples so far", flush=True)
+
+        finally:
+            self.stop()
+
+        self.evaluate()
+        self.write_csv()
+
+        return not self.failures
+
+    def sample(self, elapsed: float) -> Optional[Dict[str, float]]:
+        try:
+            sample = {"elapsed": round(elapsed, 1), **sample_process(self.bridge.pid)}
+            metrics = scrape_metrics(self.metrics_port)
+
+        except (OSError, ValueError) as ex:
+            print(f"Failed to sample the bridge, error: {ex}", flush=True)
+            return None
+
+        for name, series in METRIC_SERIES.items():
+            sample[series] = metrics.get(name)
+
+        broker_stats = self.broker.get_stats()
+        metrics["broker_latency_sum"] = broker_stats["latency_sum"]
+        metrics["broker_latency_count"] = broker_stats["latency_count"]
+        metrics["broker_publishes"] = broker_stats["publishes"]
+
+        for name, series in LATENCY_SERIES.items():
+            total = metrics.get(f"{name}_sum", 0) - self._previous.get(f"{name}_sum", 0)
+            count = metrics.get(f"{name}_count", 0) - self._previous.get(f"{name}_count", 0)
+            sample[series] = total / count if count > 0 else None
+
+        sample["published"] = metrics["broker_publishes"] - self._previous.get("broker_publishes", 0)
+        self._previous = metrics
+
+        return sample
+
+    @staticmethod
+    def report(sample: Dict[str, float]):
+        def value(series: str, format_spec: str = ".0f") -> str:
+            return "-" if sample.get(series) is None else format(sample[series], format_spec)
+
+        print(
+            f"[{sample['elapsed']:8.0f}s] rss: {value('rss_mib', '.1f')} MiB, threads: {value('threads')}, "
+            f"fds: {value('fds')}, queues: {value('dahua_queue')}/{value('mqtt_queue')}, "
+            f"pending requests: {value('pending_requests')}, timers: {value('timers')}, "
+            f"published: {value('published')}, latency: {value('latency_bridge', '.4f')}s / "
+            f"{value('latency_broker', '.4f')}s",
+            flush=True
+        )
+
+    def evaluate(self):
+        samples = [sample for sample in self.samples if sample["elapsed"] >= self.args.warmup]
+
+        print(f"\n{'series':<18} {'first':>10} {'last':>10} {'max':>10} {'growth/h':>10} {'limit/h':>10}")
+
+        for series, limit in self.limits.items():
+            values = [sample[series] for sample in samples if sample.get(series) is not None]
+
+            if not values:
+                continue
+
+            growth = get_growth(samples, series, self.args.windows)
+            failed = growth is not None and growth > limit
+            growth_text = "-" if growth is None else f"{growth:.3f}"
+
+            print(
+                f"{series:<18} {values[0]:>10.3f} {values[-1]:>10.3f} {max(values):>10.3f} {growth_text:>10} "
+                f"{limit:>10.3f}{'  FAILED' if failed else ''}"
+            )
+
+            if failed:
+                self.failures.append(f"{series} grows by {growth:.3f} per hour, the limit is {limit}")
+
+        if len(samples) < self.args.windows:
+            self.failures.append(f"Only {len(samples)} samples after the warmup, run longer")
+
+        print(f"\nBroker: {self.broker.get_stats()['publishes']} publishes, {self.broker.connects} connects")
+
+        for failure in self.failures:
+            print(f"FAILED: {failure}")
+
+        if not self.failures:
+            print("PASSED")
+
+    def write_csv(self):
+        if not self.args.csv or not self.samples:
+            return
+
+        names = list(self.samples[0].keys())
+
+        with open(self.args.csv, "w", newline="") as file:
+            writer = csv.DictWriter(file, names)
+            writer.writeheader()
+            writer.writerows(self.samples)
+
+        print(f"Samples written to {self.args.csv}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=6 * 3600, help="Seconds to run")
+    parser.add_argument("--warmup", type=float, default=600, help="Seconds before growth is measured")
+    parser.add_argument("--sample-interval", type=float, default=30, help="Seconds between samples")
+    parser.add_argument("--devices", type=int, default=20, help="Number of simulated devices")
+    parser.add_argument("--device-port", type=int, default=15000, help="Port of the first simulated device")
+    parser.add_argument("--rate", type=float, default=2.0, help="Events per device per second")
+    parser.add_argument("--mix", default="doorbell=1,motion=5,ivs=1", help="Weights of the event kinds")
+    parser.add_argument("--split", type=float, default=0.05, help="Probability a device write is split")
+    parser.add_argument("--stall", type=float, default=0.0001, help="Probability a device write stalls the device")
+    parser.add_argument("--reset", type=float, default=0.0001, help="Probability a device write resets the session")
+    parser.add_argument("--disconnect-interval", type=float, default=900, help="Seconds between broker drops, 0 never")
+    parser.add_argument("--refuse-seconds", type=float, default=10, help="Seconds connects are refused after a drop")
+    parser.add_argument("--command-interval", type=float, default=60, help="Seconds between door commands, 0 never")
+    parser.add_argument("--stall-timeout", type=float, default=300, help="Seconds without publishes that fail the run")
+    parser.add_argument("--windows", type=int, default=6, help="Time windows the growth is fitted over")
+    parser.add_argument("--limits", type=parse_limits, default={}, help="Growth per hour allowed, series=limit,...")
+    parser.add_argument("--csv", help="Write the samples to this file")
+    parser.add_argument("--bridge-log", help="Write the output of the bridge to this file")
+    parser.add_argument("--work-dir", help="Directory of the devices and details files, a temporary one by default")
+    args = parser.parse_args()
+
+    sys.exit(0 if SoakTest(args).run() else 1)
+
+
+if __name__ == "__main__":
+    main()
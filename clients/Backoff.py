@@ -0,0 +1,40 @@
+import random
+
+from common.consts import *
+
+
+class Backoff:
+    """
+        Capped exponential reconnect delay with jitter.
+
+        The first retry is fast (a dropped connection usually comes right back), every failure doubles the delay
+        up to the cap. The jitter spreads clients that lost their connection at the same moment (switch reboot)
+        so they do not all hit the device / broker at once again.
+    """
+
+    def __init__(
+            self,
+            initial: float = RECONNECT_INITIAL_DELAY,
+            maximum: float = RECONNECT_MAX_DELAY,
+            jitter: float = RECONNECT_JITTER
+    ):
+        self.initial = initial
+        self.maximum = maximum
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next_delay(self) -> float:
+        """
+            The delay before the next attempt, grows with every call until reset.
+        """
+        delay = min(self.maximum, self.initial * (2 ** min(self.attempts, 32)))
+
+        self.attempts += 1
+
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        """
+            Connected, the next failure starts over with a fast retry.
+        """
+        self.attempts = 0
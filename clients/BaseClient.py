@@ -1,23 +1,61 @@
+import asyncio
 import queue
 import logging
+import sys
 
-from threading import Timer
-from typing import Optional
+from threading import Thread, Timer
+from time import sleep
+from typing import Any, Dict, List, Optional, Union
 
-from common.consts import API_DEBUG, MQTT_DEBUG
+from clients.BoundedQueue import AsyncBoundedQueue, BoundedQueue
+from clients.Profiler import Profiler
+from common.consts import API_DEBUG, MQTT_DEBUG, LISTEN_WORKERS, LISTEN_BATCH_SIZE, QUEUE_POLICY_BLOCK, QUEUE_RESUME_INTERVAL
 
 logger = logging.getLogger(__name__)
 
 
 class BaseClient:
-    def __init__(self, client_name):
+    def __init__(self, client_name, queue_size: int = 0, queue_policy: str = QUEUE_POLICY_BLOCK):
+        """
+        :param client_name:
+        :param queue_size: Limit of outgoing_events, 0 does not limit
+        :param queue_policy: What outgoing_events does when full, see OverflowPolicy
+        """
         self.client_name = client_name
+        self._queue_size = queue_size
+        self._queue_policy = queue_policy
         self.is_connected = False
         self.is_running = True
-        self._timer_listen: Optional[Timer] = None
+        self._listeners: List[Thread] = []
         self._timer_connect: Optional[Timer] = None
         self._incoming_events = None
-        self.outgoing_events = queue.Queue()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._connect_requested: Optional[asyncio.Event] = None
+        self.outgoing_events: Union[BoundedQueue, AsyncBoundedQueue] = BoundedQueue(queue_size, queue_policy)
+        self._profiler = Profiler.get()
+
+    def create_async_queue(self) -> AsyncBoundedQueue:
+        """
+            The asyncio runtime's outgoing_events, same limit and policy.
+        """
+        return AsyncBoundedQueue(self._queue_size, self._queue_policy)
+
+    def get_stats(self) -> Dict[str, Any]:
+        outgoing_events = self.outgoing_events
+
+        if outgoing_events is None:
+            return {"connected": int(self.is_connected), "queue_depth": 0}
+
+        return {
+            "connected": int(self.is_connected),
+            "queue_depth": outgoing_events.qsize(),
+            **outgoing_events.get_stats()
+        }
+
+    @property
+    def is_ready(self) -> bool:
+        """Whether incoming events can be handled now, otherwise they stay queued (and the queue policy applies)"""
+        return True
 
     @property
     def should_connect(self):
@@ -28,45 +66,163 @@ class BaseClient:
 
         self._incoming_events = incoming_events
 
-        self._timer_listen = Timer(1.0, self._listen)
-        self._timer_listen.start()
+        for index in range(LISTEN_WORKERS):
+            listener = Thread(target=self._listen, name=f"{self.client_name}Listener-{index}", daemon=True)
+            listener.start()
+
+            self._listeners.append(listener)
 
         self.connect()
 
+    async def initialize_async(self, incoming_events: asyncio.Queue):
+        """
+            Run the client on the running event loop (asyncio runtime), returns once the client is terminated.
+            The incoming queue and the outgoing_events of this client must be asyncio queues.
+        """
+        logger.info(f"Initialize {self.client_name}Client (asyncio)")
+
+        self._incoming_events = incoming_events
+        self._loop = asyncio.get_running_loop()
+        self._connect_requested = asyncio.Event()
+
+        listener = self._loop.create_task(self._listen_async())
+
+        try:
+            await self.connect_async()
+
+        finally:
+            listener.cancel()
+
     def terminate(self):
         logger.info(f"Terminating {self.client_name}Client")
 
         self.is_connected = False
         self.is_running = False
 
-        self.outgoing_events.empty()
-        self.outgoing_events = None
+        if self.outgoing_events is not None:
+            self.outgoing_events.empty()
+            self.outgoing_events = None
 
-    def connect(self):
+    def connect(self, delay: float = 1.0):
+        """
+            Schedule a connection attempt in delay seconds.
+        """
         logger.info(f"Starting to connect {self.client_name}Client, Should connect: {self.should_connect}")
 
         if self.should_connect:
-            self._timer_connect = Timer(1.0, self._connect)
-            self._timer_connect.start()
+            if self._loop is not None:
+                # asyncio runtime, connect_async owns (re)connecting
+                self._loop.call_soon_threadsafe(self._loop.call_later, delay, self._connect_requested.set)
+
+            elif self._timer_connect is not None and self._timer_connect.is_alive():
+                # The pending attempt keeps trying until connected, every failed attempt would start another one
+                logger.debug(f"{self.client_name}Client is already connecting")
+
+            else:
+                self._timer_connect = Timer(delay, self._connect)
+                self._timer_connect.start()
 
     def _connect(self):
         if not self.is_running:
             self.terminate()
 
+    async def connect_async(self):
+        """
+            Keep the client connected until it is terminated, asyncio runtime counterpart of _connect.
+        """
+        while self.is_running:
+            await self.wait_connect_request(1)
+
+    async def wait_connect_request(self, timeout: float):
+        """
+            Sleep for up to timeout seconds, returns early when connect() is called.
+        """
+        try:
+            await asyncio.wait_for(self._connect_requested.wait(), timeout)
+
+        except asyncio.TimeoutError:
+            pass
+
+        self._connect_requested.clear()
+
     def _listen(self):
-        if self.is_running:
-            data = self._incoming_events.get()
+        """
+            Long-lived consumer, drains the incoming events in batches until the None sentinel is received.
+        """
+        while self.is_running:
+            if not self.is_ready:
+                sleep(QUEUE_RESUME_INTERVAL)
+                continue
 
+            batch = self._get_batch()
+
+            if not self._handle_batch(batch):
+                return
+
+    async def _listen_async(self):
+        """
+            asyncio runtime counterpart of _listen.
+        """
+        while self.is_running:
+            if not self.is_ready:
+                await asyncio.sleep(QUEUE_RESUME_INTERVAL)
+                continue
+
+            batch = [await self._incoming_events.get()]
+
+            while len(batch) < LISTEN_BATCH_SIZE and batch[-1] is not None:
+                try:
+                    batch.append(self._incoming_events.get_nowait())
+
+                except asyncio.QueueEmpty:
+                    break
+
+            if not self._handle_batch(batch):
+                return
+
+    def _handle_batch(self, batch: List[Any]) -> bool:
+        """
+            Handle a batch of incoming events.
+
+        :return: False once the None sentinel was received
+        """
+        self._profiler.checkpoint()
+
+        for data in batch:
             if data is None:
+                # Pass the sentinel on to the other listeners, the overflow policy never drops it
+                if len(self._listeners) > 1:
+                    self._incoming_events.put_nowait(None)
+
+                self._incoming_events.task_done()
                 self.terminate()
 
-            else:
+                return False
+
+            try:
                 self._event_received(data)
 
+            except Exception as ex:
+                exc_type, exc_obj, exc_tb = sys.exc_info()
+
+                logger.error(f"{self.client_name}Client Failed to handle event, error: {ex}, Line: {exc_tb.tb_lineno}")
+
+            finally:
                 self._incoming_events.task_done()
 
-                self._timer_listen = Timer(0, self._listen)
-                self._timer_listen.start()
+        return True
+
+    def _get_batch(self) -> List[Any]:
+        batch = [self._incoming_events.get()]
+
+        while len(batch) < LISTEN_BATCH_SIZE and batch[-1] is not None:
+            try:
+                batch.append(self._incoming_events.get_nowait())
+
+            except queue.Empty:
+                break
+
+        return batch
 
     def _event_received(self, data):
         if self.client_name == "MQTT" and MQTT_DEBUG:
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import queue
+from typing import Any, Deque, Optional
+
+from common.consts import *
+
+logger = logging.getLogger(__name__)
+
+
+LOWEST_PRIORITY = 1
+
+
+def get_priority(item: Any) -> int:
+    """
+        Priority level of a queued event / command, 0 (doorbell, lock, door commands) is kept over 1 by the priority policy.
+    """
+    if not isinstance(item, dict):
+        return 0
+
+    name = item.get("event") or item.get("topic") or ""
+
+    return 0 if name.split("/")[0] in QUEUE_PRIORITY_CODES else LOWEST_PRIORITY
+
+
+class OverflowPolicy:
+    """
+        What a full queue does with one more item:
+            block - accepts it, producers check over_limit and pause (the Dahua session stops reading its socket)
+            drop_oldest - drops the oldest queued item
+            drop_newest - drops the new item
+            priority - drops the oldest item of the least important level, doorbell / lock events are kept over motion
+
+        Items are always served in FIFO order, the priority only decides what is dropped.
+    """
+
+    def __init__(self, limit: int, policy: str):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"Unknown queue policy: {policy}, expected one of {', '.join(QUEUE_POLICIES)}")
+
+        self.limit = limit
+        self.policy = policy
+        self.dropped = 0
+        self.high_watermark = 0
+
+    def admit(self, items: Deque[Any], item: Any) -> bool:
+        """
+            Make room for item in a full queue, the None sentinel is always queued.
+
+        :return: False when item is dropped, True when it is queued (an older item may have been dropped)
+        """
+        if self.limit <= 0 or len(items) < self.limit or self.policy == QUEUE_POLICY_BLOCK or item is None:
+            return True
+
+        self.dropped += 1
+
+        if self.policy == QUEUE_POLICY_DROP_NEWEST:
+            return False
+
+        return self.evict(items, item)
+
+    def evict(self, items: Deque[Any], item: Any) -> bool:
+        """
+            Drop the oldest queued item, with the priority policy the oldest of the least important level
+            that is not more important than item.
+
+        :return: False when all queued items are more important
+        """
+        if self.policy == QUEUE_POLICY_PRIORITY:
+            levels = range(LOWEST_PRIORITY, get_priority(item) - 1, -1)
+
+        else:
+            levels = [None]
+
+        for level in levels:
+            for index, queued in enumerate(items):
+                # The None sentinel stops the listeners, it is never dropped
+                if queued is not None and (level is None or get_priority(queued) == level):
+                    del items[index]
+                    return True
+
+        return False
+
+    def get_stats(self) -> dict:
+        return {
+            "queue_dropped": self.dropped,
+            "queue_high_watermark": self.high_watermark
+        }
+
+
+class BoundedQueue(queue.Queue):
+    """
+        queue.Queue with a size limit and an overflow policy, put never blocks or raises Full.
+    """
+
+    def __init__(self, limit: int = 0, policy: str = QUEUE_POLICY_BLOCK):
+        self.overflow = OverflowPolicy(limit, policy)
+
+        super().__init__()
+
+    @property
+    def over_limit(self) -> bool:
+        return 0 < self.overflow.limit <= self.qsize()
+
+    def put(self, item: Any, block: bool = True, timeout: Optional[float] = None):
+        with self.not_full:
+            size = len(self.queue)
+
+            if not self.overflow.admit(self.queue, item):
+                return
+
+            if len(self.queue) < size:
+                # An older item was dropped, it will never be marked as done
+                self.unfinished_tasks -= 1
+
+            self._put(item)
+            self.overflow.high_watermark = max(self.overflow.high_watermark, len(self.queue))
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def put_nowait(self, item: Any):
+        self.put(item, False)
+
+    def get_stats(self) -> dict:
+        return self.overflow.get_stats()
+
+
+class AsyncBoundedQueue(asyncio.Queue):
+    """
+        asyncio counterpart of BoundedQueue, put_nowait never raises QueueFull.
+    """
+
+    def __init__(self, limit: int = 0, policy: str = QUEUE_POLICY_BLOCK):
+        self.overflow = OverflowPolicy(limit, policy)
+
+        super().__init__()
+
+    @property
+    def over_limit(self) -> bool:
+        return 0 < self.overflow.limit <= self.qsize()
+
+    def put_nowait(self, item: Any):
+        size = len(self._queue)
+
+        if not self.overflow.admit(self._queue, item):
+            return
+
+        if len(self._queue) < size:
+            self._unfinished_tasks -= 1
+
+        super().put_nowait(item)
+
+        self.overflow.high_watermark = max(self.overflow.high_watermark, len(self._queue))
+
+    def get_stats(self) -> dict:
+        return self.overflow.get_stats()
@@ -0,0 +1,82 @@
+from collections import deque
+from threading import Lock
+from time import monotonic
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from common.consts import *
+
+
+class ClockSkewEstimator:
+    """
+        Offset of a device's clock from the bridge's, estimated from the UTC / UTCMS stamps of its events.
+
+        Every event gives receipt time - device time, which is the clock offset plus the delay of that event.
+        The smallest value over the last CLOCK_SKEW_WINDOW seconds is taken as the offset (the fastest event had
+        next to no delay), so the device latency is the delay above the best case of the window. It also absorbs
+        devices reporting local time as UTC, which would otherwise show up as hours of latency.
+    """
+
+    _estimators: Dict[str, "ClockSkewEstimator"] = {}
+    _estimators_lock = Lock()
+
+    def __init__(self, window: float = CLOCK_SKEW_WINDOW):
+        self.window = window
+        # (monotonic time, offset), offsets increasing, the front is the minimum of the window
+        self._samples: Deque[Tuple[float, float]] = deque()
+
+    @classmethod
+    def get(cls, device: str) -> "ClockSkewEstimator":
+        """
+            The estimator of a device, kept across its sessions.
+        """
+        with cls._estimators_lock:
+            estimator = cls._estimators.get(device)
+
+            if estimator is None:
+                estimator = cls()
+                cls._estimators[device] = estimator
+
+        return estimator
+
+    @property
+    def offset(self) -> float:
+        """Seconds the device clock is behind the bridge's, 0 until the first event"""
+        return self._samples[0][1] if self._samples else 0.0
+
+    def add(self, offset: float) -> float:
+        """
+            Add the receipt time - device time of an event.
+
+        :return: The offset estimate including it
+        """
+        now = monotonic()
+        samples = self._samples
+
+        while samples and samples[-1][1] >= offset:
+            samples.pop()
+
+        samples.append((now, offset))
+
+        while samples[0][0] < now - self.window:
+            samples.popleft()
+
+        return samples[0][1]
+
+    @staticmethod
+    def get_device_time(message: Dict[str, Any]) -> Optional[float]:
+        """
+            When the device raised an event, from Data.UTC (seconds) and Data.UTCMS (milliseconds of that second).
+
+        :return: Seconds since the epoch, None when the event is not stamped
+        """
+        data = message.get("Data")
+
+        if not isinstance(data, dict) or not isinstance(data.get("UTC"), (int, float)):
+            return None
+
+        milliseconds = data.get("UTCMS")
+
+        if not isinstance(milliseconds, (int, float)):
+            milliseconds = 0
+
+        return data["UTC"] + (milliseconds % 1000) / 1000
@@ -0,0 +1,223 @@
+import json
+import logging
+import struct
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# DHIP frame header (32 bytes, little endian unless noted):
+#   0  - 4  : 0x20000000 (big endian)
+#   4  - 8  : b"DHIP"
+#   8  - 12 : session ID
+#   12 - 16 : request ID
+#   16 - 20 : body length
+#   20 - 24 : 0
+#   24 - 28 : body length (again)
+#   28 - 32 : 0
+DHIP_MAGIC = b"DHIP"
+DHIP_HEADER = struct.Struct("<4s4sIIIIII")
+DHIP_HEADER_SIZE = DHIP_HEADER.size
+DHIP_PREFIX = b" \x00\x00\x00"
+DHIP_BODY_LENGTH = struct.Struct("<I")
+DHIP_BODY_LENGTH_OFFSET = 16
+
+DHIP_JSON_SEPARATORS = (",", ":")
+DHIP_REQUEST_MAGIC = "0x1234"
+DHIP_MAX_TEMPLATES = 64
+
+# Anything bigger than this is a corrupted length field, not a real message
+DHIP_MAX_BODY_SIZE = 16 * 1024 * 1024
+
+
+class DHIPDecoder:
+    """
+        Incremental decoder for the DHIP stream sent by Dahua devices on port 5000.
+
+        TCP does not preserve message boundaries, a single read may hold several frames
+        (busy IVS cameras coalesce notifyEventStream frames) or only part of one.
+        The decoder keeps whatever is incomplete and returns every complete frame per read.
+    """
+
+    def __init__(self, max_body_size: int = DHIP_MAX_BODY_SIZE):
+        self._buffer = bytearray()
+        self._max_body_size = max_body_size
+
+        self.frames = 0
+        self.bytes = 0
+        self.parse_failures = 0
+        self.resyncs = 0
+
+    @property
+    def pending(self) -> int:
+        """Number of buffered bytes waiting for the rest of their frame"""
+        return len(self._buffer)
+
+    def reset(self):
+        self._buffer.clear()
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """
+            Add a chunk read from the socket.
+
+        :param data: bytes as received in data_received
+        :return: The bodies of all complete frames, in order
+        """
+        self.bytes += len(data)
+
+        if self._buffer:
+            self._buffer += data
+            buffer = self._buffer
+        else:
+            # Fast path, nothing pending - read straight from the chunk without copying it
+            buffer = data
+
+        bodies = []
+        offset = self._split(buffer, bodies)
+
+        if buffer is self._buffer:
+            del self._buffer[:offset]
+        elif offset < len(data):
+            self._buffer += memoryview(data)[offset:]
+
+        self.frames += len(bodies)
+
+        return bodies
+
+    def decode(self, data: bytes) -> List[Dict[str, Any]]:
+        """
+            Add a chunk read from the socket and decode the JSON body of every complete frame.
+
+        :param data: bytes as received in data_received
+        :return: A list of messages, frames that are not valid JSON are skipped
+        """
+        messages = []
+
+        for body in self.feed(data):
+            message = self.load(body)
+
+            if message is not None:
+                messages.append(message)
+
+        return messages
+
+    def load(self, body: bytes) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(body)
+
+        except ValueError as ex:
+            self.parse_failures += 1
+
+            logger.error(f"Failed to decode frame: {bytes(body[:256])}, error: {ex}")
+
+        return None
+
+    def _split(self, buffer, bodies: List[bytes]) -> int:
+        view = memoryview(buffer)
+        size = len(buffer)
+        offset = 0
+
+        try:
+            while size - offset >= DHIP_HEADER_SIZE:
+                if view[offset + 4:offset + 8] != DHIP_MAGIC:
+                    offset = self._resync(buffer, offset, size)
+                    continue
+
+                length, = DHIP_BODY_LENGTH.unpack_from(view, offset + DHIP_BODY_LENGTH_OFFSET)
+
+                if length > self._max_body_size:
+                    logger.error(f"Invalid frame length: {length}, dropping {size - offset} buffered bytes")
+
+                    self.parse_failures += 1
+                    offset = size
+                    break
+
+                end = offset + DHIP_HEADER_SIZE + length
+
+                if end > size:
+                    break
+
+                bodies.append(bytes(view[offset + DHIP_HEADER_SIZE:end]))
+                offset = end
+
+        finally:
+            view.release()
+
+        return offset
+
+    def _resync(self, buffer, offset: int, size: int) -> int:
+        """Skip garbage until the next DHIP header, keeping the 4 bytes before its magic"""
+        self.resyncs += 1
+
+        index = buffer.find(DHIP_MAGIC, offset + 5)
+
+        if index < 0:
+            # Keep the tail, the magic may be split across reads
+            new_offset = max(offset + 1, size - 7)
+        else:
+            new_offset = index - 4
+
+        logger.warning(f"Invalid frame header, skipped {new_offset - offset} bytes")
+
+        return new_offset
+
+
+class DHIPEncoder:
+    """
+        Encoder for the requests sent to Dahua devices.
+
+        Bodies are compact JSON, the header is packed by one precompiled struct with the length of the encoded bytes.
+        Requests repeated with the same method and params (global.keepAlive) are rendered from a cached template,
+        templates are shared by all sessions.
+    """
+
+    _templates: Dict[Tuple, bytes] = {}
+
+    @staticmethod
+    def encode(data: Dict[str, Any]) -> bytes:
+        """
+            Encode a complete request.
+
+        :param data: The request, id / session / magic / method / params
+        :return: The DHIP frame
+        """
+        body = json.dumps(data, separators=DHIP_JSON_SEPARATORS).encode("utf-8")
+
+        return DHIPEncoder.frame(body)
+
+    @staticmethod
+    def frame(body: bytes) -> bytes:
+        length = len(body)
+
+        return DHIP_HEADER.pack(DHIP_PREFIX, DHIP_MAGIC, 0, 0, length, 0, length, 0) + body
+
+    @classmethod
+    def encode_cached(cls, request_id: int, session: int, method: str, params: Dict[str, Any]) -> bytes:
+        """
+            Encode a request from a template cached by method and params, only the IDs are rendered per call.
+            Params must hold hashable values, use encode for anything else.
+
+        :return: The DHIP frame
+        """
+        key = (method, *params.items())
+        template = cls._templates.get(key)
+
+        if template is None:
+            template = cls._build_template(method, params)
+
+            if len(cls._templates) >= DHIP_MAX_TEMPLATES:
+                cls._templates.clear()
+
+            cls._templates[key] = template
+
+        return cls.frame(template % (request_id, session))
+
+    @staticmethod
+    def _build_template(method: str, params: Dict[str, Any]) -> bytes:
+        static = json.dumps(
+            {"magic": DHIP_REQUEST_MAGIC, "method": method, "params": params},
+            separators=DHIP_JSON_SEPARATORS
+        )
+
+        template = '{"id":%d,"session":%d,' + static[1:].replace("%", "%%")
+
+        return template.encode("utf-8")
@@ -1,17 +1,23 @@
 from __future__ import annotations
 import asyncio
 import hashlib
-import json
 import logging
 import os
 import queue
-import struct
 import sys
-from threading import Timer
-from typing import Optional, Dict, Any, Callable, AnyStr, TYPE_CHECKING
-
-import requests
-
+from concurrent.futures import Future
+from time import monotonic, time
+from typing import Optional, Dict, Any, Callable, AnyStr, List, Union, TYPE_CHECKING
+
+from clients.ClockSkewEstimator import ClockSkewEstimator
+from clients.DahuaHTTPClient import DahuaHTTPClient
+from clients.DeviceDetailsCache import DeviceDetailsCache
+from clients.DHIPCodec import DHIPDecoder, DHIPEncoder
+from clients.EventPipeline import EventPipeline
+from clients.Metrics import Histogram
+from clients.PendingRequests import PendingRequestTable, is_no_reply
+from clients.Profiler import Profiler
+from clients.SessionScheduler import SessionScheduler
 from common.consts import *
 
 if TYPE_CHECKING:
@@ -99,7 +105,7 @@ class DahuaAPI(asyncio.Protocol):
     dahua_details: Dict[str, Any]
     hold_time: int
     lock_status: Dict[int, bool]
-    data_handlers: Dict[Any, Callable[[Any, str], None]]
+    pending_requests: PendingRequestTable
     event_handlers: Dict[str, Callable[[dict], None]]
 
     access_control_attempts: int = 1
@@ -111,7 +117,13 @@ class DahuaAPI(asyncio.Protocol):
     serial_number: str = ""
 
 
-    def __init__(self, outgoing_events: queue.Queue, dahua_config: DahuaConfigurationData, set_api):
+    def __init__(
+            self,
+            outgoing_events: Union[queue.Queue, asyncio.Queue],
+            dahua_config: DahuaConfigurationData,
+            set_api,
+            on_connection_lost: Optional[asyncio.Future] = None
+    ):
         self.dahua_config = dahua_config
         self.dahua_details = {}
 
@@ -123,15 +135,61 @@ class DahuaAPI(asyncio.Protocol):
         self.transport: Optional[asyncio.Transport] = None
         self.hold_time = 0
         self.lock_status = {}
-        self.data_handlers = {}
+        self.access_control_instances: Dict[int, int] = {}
+        self.rpc_open_door_supported = True
+        self.multicall_supported = True
+        # None subscribes to all codes
+        self.event_codes = None if DAHUA_EVENT_CODES_ALL in dahua_config.event_codes else set(dahua_config.event_codes)
+        self.event_codes_exclude = set(dahua_config.event_codes_exclude)
+        self.events = 0
+        self.events_by_code: Dict[str, int] = {}
+        self.events_filtered = 0
+        self.keepalive_rtt = Histogram()
+        # Device clock -> receipt (skew corrected) and receipt -> queued for MQTT (event pipeline)
+        self.latency_device = Histogram()
+        self.latency_pipeline = Histogram()
+        self.clock_skew = ClockSkewEstimator.get(dahua_config.name)
+        self.received_at = 0.0
+        self.profiler = Profiler.get()
+        self.event_codes_ignored = False
+        self.reading_paused = False
+        self.backpressure_pauses = 0
+        self._multicall: Optional[List[Dict[str, Any]]] = None
+        self._decoder = DHIPDecoder()
         self.event_handlers = {
             TOPIC_DOOR: self.access_control_open_door,
             TOPIC_MUTE: self.run_cmd_mute
         }
 
         self._loop = asyncio.get_event_loop()
+        self._on_connection_lost = on_connection_lost
+        # Resolved with True once the device accepted the login, False when the session ends before
+        self.logged_in: asyncio.Future = self._loop.create_future()
+
+        # Watchdog, monotonic times of the last activity, reason is set when it recycled the session
+        self.last_byte_at = self.last_keepalive_at = self.last_event_at = monotonic()
+        self.watchdog_reason: Optional[str] = None
+        self.scheduler = SessionScheduler(self._loop, f"{dahua_config.name}")
+        self.pending_requests = PendingRequestTable(self._loop, self.scheduler)
+        self.event_pipeline = EventPipeline(dahua_config.event_policies, self.scheduler, self.publish_event)
+        self.http_client = DahuaHTTPClient.get(
+            dahua_config.base_url,
+            dahua_config.username,
+            dahua_config.password,
+            dahua_config.name
+        )
         self.outgoing_events = outgoing_events
 
+        self.details_cache = DeviceDetailsCache.get()
+        self.details_key = DeviceDetailsCache.get_key(dahua_config.host, dahua_config.port)
+        self.details_cached = False
+        self.details_stale = False
+
+        cached_details = self.details_cache.load(self.details_key)
+
+        if cached_details is not None:
+            self.apply_details(cached_details)
+
         set_api(self)
         logger.info(f"{API_DEBUG=}")
         if API_DEBUG is True:
@@ -146,6 +204,58 @@ class DahuaAPI(asyncio.Protocol):
             logger.info(f"Set INFO level for {__name__}")
 
 
+    def apply_details(self, entry: Dict[str, Any]):
+        """
+            Restore the details of a previous session, events are enriched before the device answers.
+
+        :param entry: The entry of the device in the details cache
+        :return: Nothing
+        """
+        self.dahua_details = entry.get("details", {})
+        self.device_type = self.dahua_details.get(DAHUA_DEVICE_TYPE, "")
+        self.serial_number = self.dahua_details.get(DAHUA_SERIAL_NUMBER, "")
+        self.hold_time = entry.get("hold_time", 0)
+        self.multicall_supported = entry.get("multicall", True)
+        self.rpc_open_door_supported = entry.get("rpc_open_door", True)
+
+        self.details_cached = True
+        self.details_stale = self.details_cache.is_stale(entry)
+
+        logger.info(f"Using cached details of {self.details_key}: {self.dahua_details}")
+
+    def save_details(self):
+        """
+            Store the details and capabilities of the device in the details cache.
+
+        :return: Nothing
+        """
+        entry = {
+            "details": dict(self.dahua_details),
+            "hold_time": self.hold_time,
+            "multicall": self.multicall_supported,
+            "rpc_open_door": self.rpc_open_door_supported
+        }
+
+        if self.details_cache.update(self.details_key, entry):
+            self.scheduler.call_later(DEVICE_DETAILS_FLUSH_DELAY, self.details_cache.flush)
+
+    def get_stats(self) -> Dict[str, float]:
+        return {
+            "frames": self._decoder.frames,
+            "bytes": self._decoder.bytes,
+            "parse_failures": self._decoder.parse_failures,
+            "timers": self.scheduler.live,
+            **self.pending_requests.get_stats(),
+            "events": self.events,
+            "events_filtered": self.events_filtered,
+            **self.event_pipeline.get_stats(),
+            "backpressure_pauses": self.backpressure_pauses,
+            **self.keepalive_rtt.get_stats("keepalive_rtt"),
+            **self.latency_device.get_stats("latency_device"),
+            **self.latency_pipeline.get_stats("latency_pipeline"),
+            **self.http_client.get_stats()
+        }
+
     def handle_action(self, topic: str, payload: dict):
         try:
             if topic in self.event_handlers:
@@ -164,6 +274,7 @@ class DahuaAPI(asyncio.Protocol):
 
         try:
             self.transport = transport
+            self.last_byte_at = self.last_keepalive_at = self.last_event_at = monotonic()
 
             self.pre_login()
 
@@ -174,91 +285,202 @@ class DahuaAPI(asyncio.Protocol):
 
     def data_received(self, data):
         lp: str = "received::"
-        try:
-            message = self.parse_response(data)
-            if message is not None and isinstance(message, dict):
-                # {
-                #   'error': {
-                #           'code': 268959743,
-                #           'message': 'Unknown error! error code was not set in service!'
-                #           },
-                #   'id': 4,
-                #   'params': {'table': None},
-                #   'result': False,
-                #   'session': 1149542436
-                # }
-                message_id = message.get("id")
-                # Skip displaying keep alive responses
-                params = message.get("params")
-                method = message.get("method")
-                if params and params.get("timeout") is not None:
-                    pass
-                elif method and method == "client.notifyEventStream":
-                    pass
-                else:
-                    logger.debug(f"{lp} from VTO: {message}")
+        self.profiler.checkpoint()
+        self.last_byte_at = monotonic()
+        self.received_at = time()
+        for message in self._decoder.decode(data):
+            try:
+                self.handle_message(message)
 
+            except Exception as ex:
+                exc_type, exc_obj, exc_tb = sys.exc_info()
 
-                if self.data_handlers:
-                    handler: Optional[Callable] = self.data_handlers.get(message_id, self.handle_default)
-                    if handler:
-                        # logger.info(f"{lp} Handling message id: {message_id} with handler: {handler}")
-                        try:
-                            handler(message)
-                        except Exception as ex:
-                            exc_type, exc_obj, exc_tb = sys.exc_info()
+                logger.error(f"{lp} Failed to handle message: {message.get('id')} - error: {ex}, Line: {exc_tb.tb_lineno}")
 
-                            logger.error(f"{lp} Failed to handle message: {message_id} - error: {ex}, Line: {exc_tb.tb_lineno}")
-                            logger.warning(f"{lp} If this was an access control handler, there is nothing to worry about as Lorex/Amcrest doorbells dont have AccessControl!")
+        overflow = getattr(self.outgoing_events, "overflow", None)
 
-                    else:
-                        logger.warning(f"{lp} No data handlers for message id: {message_id}")
-                else:
-                    logger.warning(f"{lp} No data handlers are available at all")
-            else:
-                logger.warning(f"{lp} Failed to parse data: {data}")
+        # Block policy, stop reading from the device until MQTT caught up, TCP pushes back on the device
+        if overflow is not None and overflow.policy == QUEUE_POLICY_BLOCK and self.outgoing_events.over_limit:
+            self.pause_reading()
+
+    def pause_reading(self):
+        lp: str = "backpressure::"
+
+        if self.transport is None or self.reading_paused:
+            return
+
+        logger.warning(f"{lp} Event queue is full, pausing reads from the device")
+
+        self.reading_paused = True
+        self.backpressure_pauses += 1
+        self.transport.pause_reading()
+        self.scheduler.call_later(QUEUE_RESUME_INTERVAL, self.resume_reading)
+
+    def resume_reading(self):
+        lp: str = "backpressure::"
+
+        if self.outgoing_events.over_limit:
+            self.scheduler.call_later(QUEUE_RESUME_INTERVAL, self.resume_reading)
+            return
+
+        logger.info(f"{lp} Event queue drained, resuming reads from the device")
+
+        self.reading_paused = False
+        self.transport.resume_reading()
+        # Paused on purpose, not a stale stream
+        self.last_byte_at = self.last_keepalive_at = self.last_event_at = monotonic()
+
+    def handle_message(self, message: Dict[str, Any]):
+        lp: str = "received::"
+        if not isinstance(message, dict):
+            logger.warning(f"{lp} Failed to parse data: {message}")
+            return
+
+        # {
+        #   'error': {
+        #           'code': 268959743,
+        #           'message': 'Unknown error! error code was not set in service!'
+        #           },
+        #   'id': 4,
+        #   'params': {'table': None},
+        #   'result': False,
+        #   'session': 1149542436
+        # }
+        message_id = message.get("id")
+        # Skip displaying keep alive responses
+        params = message.get("params")
+        method = message.get("method")
+        if isinstance(params, dict) and params.get("timeout") is not None:
+            pass
+        elif method and method == "client.notifyEventStream":
+            pass
+        else:
+            logger.debug(f"{lp} from VTO: {message}")
+
+        # Notifications reuse the ID of the eventManager.attach request, they are routed by method
+        if method == "client.notifyEventStream":
+            self.handle_notify_event_stream(params)
+            return
+
+        request = self.pending_requests.pop(message_id)
+
+        if request is None:
+            self.handle_default(message)
+            return
+
+        try:
+            if request.handler is not None:
+                request.handler(message)
 
         except Exception as ex:
             exc_type, exc_obj, exc_tb = sys.exc_info()
 
             logger.error(f"{lp} Failed to handle message: {message_id} - error: {ex}, Line: {exc_tb.tb_lineno}")
-            raise ex
+            logger.warning(f"{lp} If this was an access control handler, there is nothing to worry about as Lorex/Amcrest doorbells dont have AccessControl!")
+
+        finally:
+            request.complete(message)
 
     def handle_notify_event_stream(self, params):
         lp: str = "handle_notify_event_stream::"
+        self.last_event_at = monotonic()
         try:
             event_list = params.get("eventList")
 
             for message in event_list:
                 code = message.get("Code")
 
-                for k in self.dahua_details:
-                    if k in DAHUA_ALLOWED_DETAILS:
-                        message[k] = self.dahua_details.get(k)
+                if not self.is_event_subscribed(code):
+                    self.events_filtered += 1
 
-                event_data = {
-                    "event": f"{code}/Event",
-                    "payload": message
-                }
+                    if not self.event_codes_ignored and self.event_codes is not None and code not in self.event_codes:
+                        self.event_codes_ignored = True
+
+                        logger.warning(f"{lp} Device sent {code} although not subscribed, filtering events on the client")
 
-                self.outgoing_events.put(event_data)
+                    continue
+
+                self.events += 1
+                self.events_by_code[code] = self.events_by_code.get(code, 0) + 1
+                self.stamp_event(message)
+
+                self.event_pipeline.process(message)
 
         except Exception as ex:
             exc_type, exc_obj, exc_tb = sys.exc_info()
 
             logger.error(f"Failed to handle event, error: {ex}, Line: {exc_tb.tb_lineno}")
 
+    def stamp_event(self, message: Dict[str, Any]):
+        """
+            Record when the device raised the event (skew corrected) and when it was received,
+            the stamps travel with the event through the event pipeline.
+        """
+        received_at = self.received_at
+        device_at = ClockSkewEstimator.get_device_time(message)
+
+        if device_at is not None:
+            offset = received_at - device_at
+            skew = self.clock_skew.add(offset)
+            device_at += skew
+
+            self.latency_device.observe(offset - skew)
+
+        message[EVENT_TIMINGS_KEY] = {"device_at": device_at, "received_at": received_at}
+
+    def publish_event(self, message: Dict[str, Any]):
+        """
+            Enrich an event that passed the event pipeline with the device details and queue it for MQTT.
+
+        :param message: An element of the eventList
+        :return: Nothing
+        """
+        timings = message.pop(EVENT_TIMINGS_KEY, None)
+
+        for k in self.dahua_details:
+            if k in DAHUA_ALLOWED_DETAILS:
+                message[k] = self.dahua_details.get(k)
+
+        event_data = {
+            "device": self.dahua_config.name,
+            "event": f"{message.get('Code')}/Event",
+            "payload": message
+        }
+
+        if timings is not None:
+            timings["enqueued_at"] = time()
+            event_data["timings"] = timings
+
+            self.latency_pipeline.observe(timings["enqueued_at"] - timings["received_at"])
+
+        self.outgoing_events.put_nowait(event_data)
+
+    def is_event_subscribed(self, code: Optional[str]) -> bool:
+        if code in self.event_codes_exclude:
+            return False
+
+        return self.event_codes is None or code in self.event_codes
+
     def handle_default(self, message):
         logger.info(f"Data received without handler: {message}")
 
     def stop(self):
         lp: str = "stop::"
+        self.event_pipeline.flush()
+        self.scheduler.close()
+        self.pending_requests.close()
+        self.details_cache.flush()
+        if not self.logged_in.done():
+            self.logged_in.set_result(False)
         if self.transport is not None:
             if self.transport.is_closing():
                 logger.warning(f"{lp} transport Connection is already closing")
             else:
                 self.transport.close()
-        if self._loop.is_running():
+        if self._on_connection_lost is not None:
+            if not self._on_connection_lost.done():
+                self._on_connection_lost.set_result(True)
+        elif self._loop.is_running():
             self._loop.stop()
 
     def eof_received(self):
@@ -271,46 +493,53 @@ class DahuaAPI(asyncio.Protocol):
 
         self.stop()
 
-    def send(self, action, handler, params=None):
+    def send(self, action, handler, params=None, object_id: Optional[int] = None) -> asyncio.Future:
+        """
+            Send a request to the VTO device, handler is called with the reply (or with an error reply on timeout).
+
+        :return: A future resolved with the reply, requests can be pipelined by awaiting several of them
+        """
         lp: str = "send::"
         if params is None:
             params = {}
 
         self.request_id += 1
 
-        message_data = {
-            "id": self.request_id,
-            "session": self.sessionId,
-            "magic": "0x1234",
-            "method": action,
-            "params": params
-        }
-        # logger.info(f"Setting CALLBACK data handler for message ID {self.request_id}: {handler}")
-        self.data_handlers[self.request_id] = handler
+        result = self.pending_requests.add(self.request_id, action, handler)
+
         if not self.transport.is_closing():
-            message = self.convert_message(message_data)
-            if action != DAHUA_GLOBAL_KEEPALIVE:
+            if action == DAHUA_GLOBAL_KEEPALIVE:
+                message = DHIPEncoder.encode_cached(self.request_id, self.sessionId, action, params)
+
+            else:
+                message_data = {
+                    "id": self.request_id,
+                    "session": self.sessionId,
+                    "magic": "0x1234",
+                    "method": action,
+                    "params": params
+                }
+
+                if object_id is not None:
+                    message_data["object"] = object_id
+
+                if self._multicall is not None:
+                    self._multicall.append(message_data)
+                    return result
+
+                message = self.convert_message(message_data)
                 logger.debug(f"{lp} to VTO: {message_data}")
+
             self.transport.write(message)
 
         else:
             logger.warning(f"{lp} Connection to VTO device is closed! Unable to send data!")
 
+        return result
+
     @staticmethod
     def convert_message(data):
-        message_data = json.dumps(data, indent=4)
-
-        header = struct.pack(">L", 0x20000000)
-        header += struct.pack(">L", 0x44484950)
-        header += struct.pack(">d", 0)
-        header += struct.pack("<L", len(message_data))
-        header += struct.pack("<L", 0)
-        header += struct.pack("<L", len(message_data))
-        header += struct.pack("<L", 0)
-
-        message = header + message_data.encode("utf-8")
-
-        return message
+        return DHIPEncoder.encode(data)
 
     def pre_login(self):
         """First message we send is pre_login, this will give us the random, realm and session ID
@@ -332,19 +561,15 @@ class DahuaAPI(asyncio.Protocol):
             error = message.get("error")
             params = message.get("params")
 
-            if error is not None:
-                error_message = error.get("message")
-
-                if error_message == "Component error: login challenge!":
-                    self.random = params.get("random")
-                    self.realm = params.get("realm")
-                    self.sessionId = message.get("session")
+            if error is not None and error.get("message") == "Component error: login challenge!":
+                self.random = params.get("random")
+                self.realm = params.get("realm")
+                self.sessionId = message.get("session")
 
-                    self.login()
+                self.login()
             else:
                 logger.critical(f"{lp} Failed to get challenge from VTO device, error: {error}")
                 self.stop()
-                exit(1)
 
         request_data = {
             "clientType": "",
@@ -361,7 +586,7 @@ class DahuaAPI(asyncio.Protocol):
 
         The keep alive message is sent every keepAliveInterval-5 seconds to keep the session alive.
 
-        Then, the following messages are sent to get the device details:
+        Then, the following messages are sent to get the device details (batched, see load_details):
             - Access Control
             - Version
             - Serial Number
@@ -374,27 +599,34 @@ class DahuaAPI(asyncio.Protocol):
 
         def handle_login(message):
             """
-                Handle the login response from the VTO device. Setup the keep alive Timer.
+                Handle the login response from the VTO device. Schedule the first keep alive.
             :param message:
             :return:
             """
-            params = message.get("params")
+            params = message.get("params") or {}
             keep_alive_interval = params.get("keepAliveInterval")
 
-            if keep_alive_interval is not None:
-                self.keep_alive_interval = keep_alive_interval - 5
-                # This is where the sequence happens, so
-                # we should make the methods return True/False and retry on False
+            if keep_alive_interval is None:
+                logger.critical(f"{lp} Failed to login, error: {message.get('error')}")
+                self.stop()
+                return
+
+            self.keep_alive_interval = keep_alive_interval - 5
+            self.logged_in.set_result(True)
+            # This is where the sequence happens, so
+            # we should make the methods return True/False and retry on False
 
-                self.load_version()
-                self.load_serial_number()
-                self.load_device_type()
-                self.attach_event_manager()
+            if self.details_cached:
+                # Revalidate in the background, right away when the cached details are old
+                delay = 0 if self.details_stale else DEVICE_DETAILS_REVALIDATE_DELAY
+                self.scheduler.call_later(delay, self.load_details)
+            else:
+                self.load_details()
 
-                Timer(self.keep_alive_interval, self.keep_alive).start()
+            self.attach_event_manager()
 
-                # not needed for  Lorex/Amcrest Doorbells
-                self.load_access_control()
+            self.scheduler.call_later(self.keep_alive_interval, self.keep_alive)
+            self.scheduler.call_later(WATCHDOG_INTERVAL, self.watchdog)
 
         password = self._get_hashed_password(
             self.random,
@@ -414,6 +646,66 @@ class DahuaAPI(asyncio.Protocol):
 
         self.send(DAHUA_GLOBAL_LOGIN, handle_login, request_data)
 
+    def load_details(self):
+        """
+            Request the device details in one system.multicall round trip, each call keeps its own handler and retries.
+            Devices rejecting system.multicall get the calls one by one.
+
+        :return: Nothing
+        """
+        if self.multicall_supported:
+            self._multicall = []
+
+        try:
+            self.load_version()
+            self.load_serial_number()
+            self.load_device_type()
+
+            # not needed for  Lorex/Amcrest Doorbells
+            self.load_access_control()
+
+        finally:
+            batch, self._multicall = self._multicall, None
+
+        if batch:
+            self.send_multicall(batch)
+
+    def send_multicall(self, batch: List[Dict[str, Any]]):
+        """
+            Send several requests in one frame, the replies are dispatched to the handlers of the batched requests.
+
+        :param batch: The requests, already tracked in the pending request table
+        :return: Nothing
+        """
+        lp: str = "multicall::"
+        logger.debug(f"{lp} Sending {len(batch)} requests")
+
+        def handle_multicall(message: Dict[str, Any]):
+            replies = message.get("params")
+
+            if message.get("result") is not True or not isinstance(replies, list):
+                if is_no_reply(message):
+                    # A slow device says nothing about system.multicall, it is used again next time
+                    logger.warning(f"{lp} No reply to system.multicall, sending requests one by one, error: {message.get('error')}")
+
+                else:
+                    logger.warning(f"{lp} Device rejected system.multicall, sending requests one by one, error: {message.get('error')}")
+
+                    self.multicall_supported = False
+                    self.save_details()
+
+                for request in batch:
+                    # Requests that timed out meanwhile were already retried by their handlers
+                    if request["id"] in self.pending_requests and not self.transport.is_closing():
+                        self.transport.write(self.convert_message(request))
+
+                return
+
+            for reply in replies:
+                self.handle_message(reply)
+
+        self.send(DAHUA_SYSTEM_MULTICALL, handle_multicall, batch)
+
     def attach_event_manager(self):
         """
             Attach to the event manager to get the event stream.
@@ -427,16 +719,14 @@ class DahuaAPI(asyncio.Protocol):
 
         def handle_attach_event_manager(message):
             lp = "event manager:hndl::"
-            method = message.get("method")
             params = message.get("params")
-            logger.debug(f"{lp} Method: {method} Params: {params}")
-            if method == "client.notifyEventStream":
-                self.handle_notify_event_stream(params)
-            else:
-                logger.warning(f"{lp} Unknown method: {method}, unable to handle event!")
+            logger.debug(f"{lp} Params: {params}")
+            if message.get("result") is False:
+                logger.critical(f"{lp} Failed to attach, error: {message.get('error')}")
+                self.stop()
 
         request_data = {
-            "codes": ['All']
+            "codes": [DAHUA_EVENT_CODES_ALL] if self.event_codes is None else sorted(self.event_codes)
         }
 
         self.send(DAHUA_EVENT_MANAGER_ATTACH, handle_attach_event_manager, request_data)
@@ -467,10 +757,8 @@ class DahuaAPI(asyncio.Protocol):
             params = message.get("params")
             success = message.get("result")
             if success is False:
-                logger.warning(f"{lp} Failed to get access control details, trying again!")
-                self.load_access_control()
-                return
-            if params:
+                logger.warning(f"{lp} Failed to get access control details")
+            elif params:
                 logger.debug(f"{lp} Params: {params}")
                 table = params.get("table")
                 if table:
@@ -483,6 +771,7 @@ class DahuaAPI(asyncio.Protocol):
                             if access_control == 'Local':
                                 self.hold_time = item.get('UnlockReloadInterval')
                                 logger.info(f"{lp} Hold time: {self.hold_time}")
+                                self.save_details()
                                 return
                         else:
                             logger.warning(f"{lp} Access Control (AccessProtocol) is not available in the table item!")
@@ -491,7 +780,7 @@ class DahuaAPI(asyncio.Protocol):
             if self.access_control_attempts < ACCESS_CONTROL_ATTEMPTS:
                 logger.info(f"{lp} Trying again!")
                 self.access_control_attempts += 1
-                self.load_access_control()
+                self.scheduler.call_later(BOOTSTRAP_RETRY_DELAY, self.load_access_control)
             else:
                 logger.critical(f"{lp} Giving up, exhausted attempts: {ACCESS_CONTROL_ATTEMPTS}!")
 
@@ -528,17 +817,20 @@ class DahuaAPI(asyncio.Protocol):
                         self.dahua_details[DAHUA_BUILD_DATE] = build_date
 
                         logger.info(f"{lp} Version: {version}, Build Date: {build_date}")
+                        self.save_details()
                         return
 
             logger.warning(f"{lp} No version details available")
             if self.version_attempts < VERSION_ATTEMPTS:
                 logger.info(f"{lp} Trying again!")
                 self.version_attempts += 1
-                self.load_version()
+                self.scheduler.call_later(BOOTSTRAP_RETRY_DELAY, self.load_version)
             else:
                 logger.critical(f"{lp} Giving up, exhausted attempts: {VERSION_ATTEMPTS}!")
-                self.stop()
-                exit(1)
+
+                # Keep running on the cached details, only a session without any details is useless
+                if not self.details_cached:
+                    self.stop()
 
         self.send(DAHUA_MAGICBOX_GETSOFTWAREVERSION, handle_version)
 
@@ -564,17 +856,19 @@ class DahuaAPI(asyncio.Protocol):
                     self.device_type = self.dahua_details[DAHUA_DEVICE_TYPE] = device_type
 
                     logger.info(f"{lp} Device Type: {device_type}")
+                    self.save_details()
                     return
 
             logger.warning(f"{lp} No device type available")
             if self.device_type_attempts < DEVICE_TYPE_ATTEMPTS:
                 logger.info(f"{lp} Trying again!")
                 self.device_type_attempts += 1
-                self.load_device_type()
+                self.scheduler.call_later(BOOTSTRAP_RETRY_DELAY, self.load_device_type)
             else:
                 logger.critical(f"{lp} Giving up, exhausted attempts: {DEVICE_TYPE_ATTEMPTS}!")
-                self.stop()
-                exit(1)
+
+                if not self.details_cached:
+                    self.stop()
 
         self.send(DAHUA_MAGICBOX_GETDEVICETYPE, handle_device_type)
 
@@ -603,17 +897,19 @@ class DahuaAPI(asyncio.Protocol):
                     self.dahua_details[DAHUA_SERIAL_NUMBER] = serial_number
 
                     logger.info(f"{lp} Serial Number: {serial_number}")
+                    self.save_details()
                     return
 
             logger.warning(f"{lp} No serial number available")
             if self.serial_number_attempts < SERIAL_NUMBER_ATTEMPTS:
                 logger.info(f"{lp} Trying again!")
                 self.serial_number_attempts += 1
-                self.load_serial_number()
+                self.scheduler.call_later(BOOTSTRAP_RETRY_DELAY, self.load_serial_number)
             else:
                 logger.critical(f"{lp} Giving up, exhausted attempts: {SERIAL_NUMBER_ATTEMPTS - 1}!")
-                self.stop()
-                exit(1)
+
+                if not self.details_cached:
+                    self.stop()
 
         request_data = {
             "name": "T2UServer"
@@ -628,15 +924,18 @@ class DahuaAPI(asyncio.Protocol):
         """
         lp: str = "keep_alive::"
         logger.debug(f"{lp} Sending packet") if KEEPALIVE_DEBUG else None
+        sent_at = monotonic()
 
         def handle_keep_alive(message):
             """Handle the keep alive response from the VTO device.
 
             :param str message:
             """
+            if message.get("result") is not False:
+                self.last_keepalive_at = monotonic()
+                self.keepalive_rtt.observe(self.last_keepalive_at - sent_at)
 
-            self.keepalive_timer = Timer(self.keep_alive_interval, self.keep_alive)
-            self.keepalive_timer.start()
+            self.scheduler.call_later(self.keep_alive_interval, self.keep_alive)
 
         request_data = {
             "timeout": self.keep_alive_interval,
@@ -645,6 +944,42 @@ class DahuaAPI(asyncio.Protocol):
 
         self.send(DAHUA_GLOBAL_KEEPALIVE, handle_keep_alive, request_data)
 
+    def watchdog(self):
+        """
+            Recycle the session when the device went quiet, the TCP connection may look alive for many minutes
+            after the device stopped sending (half-open connection, stuck event stream).
+
+        :return: Nothing
+        """
+        lp: str = "watchdog::"
+        now = monotonic()
+
+        if self.reading_paused:
+            self.scheduler.call_later(WATCHDOG_INTERVAL, self.watchdog)
+            return
+        idle_timeout = WATCHDOG_IDLE_TIMEOUT or self.keep_alive_interval * 2 + REQUEST_TIMEOUT
+
+        checks = [
+            ("data", self.last_byte_at, idle_timeout),
+            ("keepalive reply", self.last_keepalive_at, idle_timeout),
+            ("event", self.last_event_at, WATCHDOG_EVENT_TIMEOUT)
+        ]
+
+        for reason, last_at, timeout in checks:
+            if 0 < timeout < now - last_at:
+                logger.error(f"{lp} No {reason} received for {now - last_at:.0f} seconds, recycling the session")
+
+                self.watchdog_reason = reason
+
+                # Do not wait for the send buffer of a dead connection to drain
+                if self.transport is not None:
+                    self.transport.abort()
+
+                self.stop()
+                return
+
+        self.scheduler.call_later(WATCHDOG_INTERVAL, self.watchdog)
+
     def run_cmd_mute(self, payload: dict):
         """
             A CallBack used to mute the VTO device.
@@ -685,39 +1020,122 @@ class DahuaAPI(asyncio.Protocol):
             door_id = 1
 
         is_locked = self.lock_status.get(door_id, False)
-        should_unlock = False
-        logger.debug(f"{lp} Door #{door_id} is locked: {is_locked} || Should unlock: {should_unlock}")
+        logger.debug(f"{lp} Door #{door_id} is locked: {is_locked}")
 
-        try:
-            # todo: investigate this logic
-            if is_locked:
-                logger.info(f"{lp} Access Control - Door #{door_id} is already unlocked, ignoring request")
+        # todo: investigate this logic
+        if is_locked:
+            logger.info(f"{lp} Access Control - Door #{door_id} is already unlocked, ignoring request")
+            return
+
+        self.lock_status[door_id] = True
+        self.publish_lock_state(door_id, False)
+
+        if self.dahua_config.door_open_method == DOOR_OPEN_METHOD_RPC and self.rpc_open_door_supported:
+            self.rpc_open_door(door_id)
+        else:
+            self.http_open_door(door_id)
+
+    def rpc_open_door(self, door_id: int):
+        """
+            Open the door through the RPC session, falls back to HTTP when the device rejects the methods.
+
+        :param door_id:
+        :return: Nothing
+        """
+        lp: str = "rpc_open_door::"
+
+        def fallback(message: Dict[str, Any]):
+            if is_no_reply(message):
+                # A slow device says nothing about the methods, only this attempt goes through HTTP
+                logger.warning(f"{lp} No reply to RPC door open, using HTTP, error: {message.get('error')}")
 
             else:
-                is_locked = True
-                should_unlock = True
+                logger.warning(f"{lp} Device rejected RPC door open, using HTTP from now on, error: {message.get('error')}")
+
+                self.rpc_open_door_supported = False
+                self.save_details()
+
+            self.http_open_door(door_id)
+
+        def handle_open_door(message: Dict[str, Any]):
+            if message.get("result") is not True:
+                fallback(message)
+                return
+
+            logger.info(f"{lp} Door #{door_id} opened")
+
+            self.scheduler.call_later(float(self.hold_time), self.magnetic_unlock, self, door_id)
+
+        def open_door(object_id: int):
+            request_data = {
+                "DoorIndex": door_id - 1,
+                "Type": "Remote",
+                "UserID": "101"
+            }
+
+            self.send(DAHUA_ACCESS_CONTROL_OPEN_DOOR, handle_open_door, request_data, object_id)
+
+        def handle_instance(message: Dict[str, Any]):
+            object_id = message.get("result")
+
+            # The object ID is an int, a bool result means no instance
+            if isinstance(object_id, bool) or not isinstance(object_id, int):
+                fallback(message)
+                return
 
-                self.lock_status[door_id] = is_locked
-                self.publish_lock_state(door_id, False)
+            self.access_control_instances[door_id] = object_id
 
-                url = f"{self.dahua_config.base_url}{ENDPOINT_ACCESS_CONTROL}{door_id}"
+            open_door(object_id)
 
-                response = requests.get(url, verify=False, auth=self.dahua_config.auth)
+        instance = self.access_control_instances.get(door_id)
 
-                response.raise_for_status()
+        if instance is None:
+            self.send(DAHUA_ACCESS_CONTROL_FACTORY_INSTANCE, handle_instance, {"channel": door_id - 1})
+        else:
+            open_door(instance)
+
+    def http_open_door(self, door_id: int):
+        """
+            Open the door using the HTTP Access Control API.
+
+        :param door_id:
+        :return: Nothing
+        """
+        try:
+            # Sent on the device's HTTP worker, the response is handled back on the session's loop
+            result = self.http_client.request(f"{ENDPOINT_ACCESS_CONTROL}{door_id}")
+            result.add_done_callback(
+                lambda future: self.scheduler.call_soon(self.handle_open_door_response, door_id, future)
+            )
 
         except Exception as ex:
             exc_type, exc_obj, exc_tb = sys.exc_info()
 
             logger.error(f"Failed to open door, error: {ex}, Line: {exc_tb.tb_lineno}")
+
+            self.scheduler.call_later(float(self.hold_time), self.magnetic_unlock, self, door_id)
+
+    def handle_open_door_response(self, door_id: int, result: Future):
+        """
+            Handle the response of the HTTP open door request, the magnetic lock is relocked after the hold time.
+
+        :param door_id:
+        :param result: The future of the HTTP request
+        :return: Nothing
+        """
+        try:
+            result.result()
+
+        except Exception as ex:
+            logger.error(f"Failed to open door, error: {ex}")
+
         finally:
-            if should_unlock and is_locked:
-                Timer(float(self.hold_time), self.magnetic_unlock, (self, door_id)).start()
+            self.scheduler.call_later(float(self.hold_time), self.magnetic_unlock, self, door_id)
 
     @staticmethod
     def magnetic_unlock(self, door_id):
         """
-            A CallBack used to unlock the magnetic lock after the hold time has expired. Used in a threading.Timer object.
+            A CallBack used to unlock the magnetic lock after the hold time has expired. Scheduled by the session scheduler.
         :param self:
         :param door_id:
         :return: Nothing
@@ -744,38 +1162,27 @@ class DahuaAPI(asyncio.Protocol):
         }
 
         event_data = {
+            "device": self.dahua_config.name,
             "event": "MagneticLock/Status",
             "payload": message
         }
 
-        self.outgoing_events.put(event_data)
+        self.outgoing_events.put_nowait(event_data)
 
     @staticmethod
     def parse_response(response) -> Optional[Dict[str, Any]]:
         """
-            Parse the response from the VTO device into JSON and then decode the JSON into a Python object.
+            Parse a single, complete response from the VTO device into JSON and then decode the JSON into a Python object.
+            Streams should go through a DHIPDecoder instead, which keeps partial frames between reads.
 
         :param response:
         :return: A dictionary of the response data
         """
         # b' \x00\x00\x00DHIP\\\x89\x8eA\x07\x00\x00\x00{\x04\x00\x00\x00\x00\x00\x00{\x04\x00\x00\x00\x00\x00\x00{"id":7,"method":"client.notifyEventStream","params":{"SID":513,"eventList":[{"Action":"Start","Code":"CrossRegionDetection","Data":{"Action":"Appear","CfgRuleId":3,"Class":"Normal","CountInGroup":1,"DetectRegion":[[1692,44],[-1,3996],[-1,8185],[8188,8185],[6280,5401],[3116,5231]],"EventID":10065,"EventSeq":64,"FrameSequence":5409291,"GroupID":64,"LocaleTime":"2023-09-18 12:48:48","Mark":0,"Name":"IVS-1","Object":{"Action":"Appear","Age":0,"Angle":0,"Bag":0,"BagType":0,"BoundingBox":[2976,2688,5840,8160],"CarrierBag":0,"Center":[4408,5424],"Confidence":0,"DownClothes":0,"Express":0,"FaceFlag":0,"FaceRect":[0,0,0,0],"FrameSequence":5409291,"Gender":0,"Glass":0,"HairStyle":0,"HasHat":0,"Helmet":0,"HumanRect":[0,0,0,0],"LowerBodyColor":[0,0,0,0],"MainColor":[0,0,0,0],"MessengerBag":0,"ObjectID":4812,"ObjectType":"Human","Phone":0,"RelativeID":0,"SerialUUID":"","ShoulderBag":0,"Source":0.0,"Speed":0,"SpeedTypeInternal":0,"Umbrella":0,"UpClothes":0,"UpperBodyColor":[0,0,0,0],"UpperPattern":0},"PTS":43625989680.0,"Priority":0,"RuleID":3,"RuleId":1,"Source":-1.0,"Track":[],"UTC":1695041328,"UTCMS":10},"Index":0}]},"session":1099860316}\n',
         # error: substring not found, Line: 759
-        result = None
-        try:
-            response_parts = str(response).split("\\x00")
-            for response_part in response_parts:
-                if response_part.startswith("{"):
-                    end = response_part.rindex("}") + 1
-                    message = response_part[0:end]
-
-                    result = json.loads(message)
-
-        except Exception as e:
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-
-            logger.error(f"Failed to read data: {response}, error: {e}, Line: {exc_tb.tb_lineno}")
+        messages = DHIPDecoder().decode(response)
 
-        return result
+        return messages[-1] if messages else None
 
     @staticmethod
     def _get_hashed_password(random, realm, username, password):
@@ -1,23 +1,42 @@
 import asyncio
 import logging
 import sys
-from time import sleep
-from typing import Optional
+from time import monotonic
+from typing import Any, Dict, List, Optional
 
+from clients.Backoff import Backoff
 from clients.BaseClient import BaseClient
+from clients.ClockSkewEstimator import ClockSkewEstimator
 from clients.DahuaAPI import DahuaAPI
-from common.consts import API_DEBUG
+from clients.DeviceDetailsCache import DeviceDetailsCache
+from clients.Metrics import merge_stats
+from common.consts import API_DEBUG, EVENT_QUEUE_POLICY, EVENT_QUEUE_SIZE, LOGIN_TIMEOUT, RECONNECT_MAX_CONCURRENT_LOGINS
 from models.DahuaConfigData import DahuaConfigurationData
+from models.DevicesConfigData import DevicesConfigurationData
 
 logger = logging.getLogger(__name__)
 
 
 class DahuaClient(BaseClient):
-    def __init__(self):
-        super().__init__("Dahua")
-
-        self.dahua_config = DahuaConfigurationData()
-        self.api: Optional[DahuaAPI] = None
+    def __init__(self, devices: Optional[List[DahuaConfigurationData]] = None):
+        super().__init__("Dahua", EVENT_QUEUE_SIZE, EVENT_QUEUE_POLICY)
+
+        if devices is None:
+            devices = DevicesConfigurationData().devices
+
+        self.devices = devices
+        self.dahua_config = devices[0]
+        self.apis: Dict[str, DahuaAPI] = {}
+        self._login_slots: Optional[asyncio.Semaphore] = None
+
+        # device name -> when its session was lost, cleared once it is logged in again
+        self._disconnected_at: Dict[str, float] = {}
+        self.reconnects = 0
+        self.device_reconnects: Dict[str, int] = {}
+        self.recoveries = 0
+        self.recover_time_total = 0.0
+        self.recover_time_max = 0.0
+        self.watchdog_triggers = 0
         logger.info(f"{API_DEBUG=}")
         if API_DEBUG is True:
             logger.setLevel(logging.DEBUG)
@@ -30,53 +49,182 @@ class DahuaClient(BaseClient):
                 handler.setLevel(logging.INFO)
             logger.info(f"Set INFO level for {__name__}")
 
+    @property
+    def api(self) -> Optional[DahuaAPI]:
+        """The session of the first device, the only one unless a devices file is used"""
+        return self.apis.get(self.dahua_config.name)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = super(DahuaClient, self).get_stats()
+        stats["devices"] = len(self.devices)
+        stats["sessions"] = len(self.apis)
+        stats["reconnects"] = self.reconnects
+        stats["recoveries"] = self.recoveries
+        stats["recover_time_total"] = self.recover_time_total
+        stats["recover_time_max"] = self.recover_time_max
+        stats["watchdog_triggers"] = self.watchdog_triggers
+
+        for api in list(self.apis.values()):
+            merge_stats(stats, api.get_stats())
+
+        stats.update(DeviceDetailsCache.get().get_stats())
+
+        return stats
+
+    def get_device_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Counters of each device's current session, keyed by device name"""
+        device_stats = {}
+
+        for dahua_config in self.devices:
+            api = self.apis.get(dahua_config.name)
+
+            device_stats[dahua_config.name] = {
+                "connected": int(api is not None),
+                "reconnects": self.device_reconnects.get(dahua_config.name, 0),
+                "clock_skew": ClockSkewEstimator.get(dahua_config.name).offset,
+                **(api.get_stats() if api is not None else {})
+            }
+
+        return device_stats
+
+    def get_event_code_stats(self) -> Dict[str, Dict[str, int]]:
+        """Events received per code by each device's current session"""
+        return {name: dict(api.events_by_code) for name, api in list(self.apis.items())}
+
+    def get_suppressed_code_stats(self) -> Dict[str, Dict[str, int]]:
+        """Events suppressed by the event policies per code, by each device's current session"""
+        return {name: dict(api.event_pipeline.suppressed) for name, api in list(self.apis.items())}
+
     def _set_api(self, api: DahuaAPI):
-        self.api = api
+        self.apis[api.dahua_config.name] = api
 
-    def _connect(self):
-        super(DahuaClient, self)._connect()
+    async def _session(self, dahua_config: DahuaConfigurationData, backoff: Backoff):
+        """
+            Connect to the device and wait until the connection is lost.
+
+            Connecting and logging in holds one of the RECONNECT_MAX_CONCURRENT_LOGINS slots,
+            when a whole site reconnects at once the devices log in a few at a time.
+        """
+        loop = asyncio.get_running_loop()
+        connection_lost = loop.create_future()
 
-        while not self.is_connected:
-            sleep_time = 5
+        async with self._login_slots:
+            transport, api = await loop.create_connection(
+                lambda: DahuaAPI(self.outgoing_events, dahua_config, self._set_api, connection_lost),
+                dahua_config.host,
+                dahua_config.port
+            )
 
             try:
-                logger.info("Connecting")
+                logged_in = await asyncio.wait_for(asyncio.shield(api.logged_in), LOGIN_TIMEOUT)
+
+            except asyncio.TimeoutError:
+                logger.error(f"{dahua_config.name}:: Login timed out after {LOGIN_TIMEOUT} seconds")
+
+                logged_in = False
+
+        if logged_in:
+            backoff.reset()
+
+            self._recovered(dahua_config.name)
+
+        else:
+            api.stop()
+
+        await connection_lost
+
+        if api.watchdog_reason is not None:
+            self.watchdog_triggers += 1
 
-                loop = asyncio.new_event_loop()
+    def _recovered(self, name: str):
+        disconnected_at = self._disconnected_at.pop(name, None)
 
-                client = loop.create_connection(
-                    lambda: DahuaAPI(self.outgoing_events, self.dahua_config, self._set_api),
-                    self.dahua_config.host,
-                    5000
-                )
+        if disconnected_at is None:
+            return
 
-                self.is_connected = True
+        recover_time = monotonic() - disconnected_at
 
-                loop.run_until_complete(client)
-                loop.run_forever()
-                loop.close()
+        self.recoveries += 1
+        self.recover_time_total += recover_time
+        self.recover_time_max = max(self.recover_time_max, recover_time)
+
+        logger.info(f"{name}:: Recovered after {recover_time:.1f} seconds")
+
+    async def _run_device(self, dahua_config: DahuaConfigurationData):
+        """
+            Keep one device connected, failures and reconnects of a device do not affect the other devices.
+        """
+        lp: str = f"{dahua_config.name}::"
+        backoff = Backoff()
+
+        while self.is_running:
+            try:
+                logger.info(f"{lp} Connecting")
+
+                await self._session(dahua_config, backoff)
 
             except Exception as ex:
                 exc_type, exc_obj, exc_tb = sys.exc_info()
                 line = exc_tb.tb_lineno
 
-                logger.error(f"Connection failed, Error: {ex}, Line: {line}")
-
-                sleep_time = 30
+                logger.error(f"{lp} Connection failed, Error: {ex}, Line: {line}")
 
             finally:
-                logger.info(f"Disconnected, will try to connect in {sleep_time} seconds")
+                self.apis.pop(dahua_config.name, None)
+
+            if self.is_running:
+                self._disconnected_at.setdefault(dahua_config.name, monotonic())
+                self.reconnects += 1
+                self.device_reconnects[dahua_config.name] = self.device_reconnects.get(dahua_config.name, 0) + 1
+
+                sleep_time = backoff.next_delay()
+
+                logger.info(f"{lp} Disconnected, will try to connect in {sleep_time:.1f} seconds")
+
+                await asyncio.sleep(sleep_time)
+
+    def _connect(self):
+        super(DahuaClient, self)._connect()
+
+        self.is_connected = True
+
+        try:
+            # All device sessions are multiplexed on this thread's event loop
+            asyncio.run(self.connect_async())
+
+        except Exception as ex:
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+
+            logger.error(f"Event loop failed, Error: {ex}, Line: {exc_tb.tb_lineno}")
 
-                self.is_connected = False
+        finally:
+            self.is_connected = False
 
-                sleep(sleep_time)
-                self.connect()
+    async def connect_async(self):
+        self.is_connected = True
+
+        logger.info(f"Bridging {len(self.devices)} devices")
+
+        self._login_slots = asyncio.Semaphore(RECONNECT_MAX_CONCURRENT_LOGINS)
+
+        try:
+            await asyncio.gather(*[self._run_device(dahua_config) for dahua_config in self.devices])
+
+        finally:
+            self.is_connected = False
 
     def _event_received(self, data):
         super(DahuaClient, self)._event_received(data)
 
+        device = data.get("device")
         topic = data.get("topic")
         payload = data.get("payload")
 
-        self.api.handle_action(topic, payload)
+        api = self.api if device is None else self.apis.get(device)
+
+        if api is None:
+            logger.warning(f"Device {device} is not connected, dropping command {topic}, Payload: {payload}")
+            return
 
+        # Commands run on the session's loop, next to everything else that writes to its transport
+        api.scheduler.call_soon(api.handle_action, topic, payload)
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
+
+from common.consts import *
+
+logger = logging.getLogger(__name__)
+
+
+class DahuaHTTPClient:
+    """
+        Persistent HTTP client for the CGI API of one device, shared by all sessions of that device.
+
+        The requests Session keeps the connection alive and HTTPDigestAuth caches the digest nonce,
+        once challenged, the following requests send the Authorization header right away and cost one round trip.
+        Requests run on a dedicated worker thread (the digest state of requests is per thread),
+        callers get a future and never block the event loop or the command listener.
+    """
+
+    _clients: Dict[str, "DahuaHTTPClient"] = {}
+    _clients_lock = Lock()
+
+    def __init__(self, base_url: str, username: str, password: str, name: str = ""):
+        self.base_url = base_url
+        self.name = name or base_url
+
+        self._session = requests.Session()
+        self._session.auth = HTTPDigestAuth(username, password)
+        self._session.verify = False
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"HTTP-{self.name}")
+
+        self.requests = 0
+        self.errors = 0
+        self.last_latency: Optional[float] = None
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    @classmethod
+    def get(cls, base_url: str, username: str, password: str, name: str = "") -> "DahuaHTTPClient":
+        """
+            The client of a device, created on first use.
+        """
+        key = f"{username}@{base_url}"
+
+        with cls._clients_lock:
+            client = cls._clients.get(key)
+
+            if client is None:
+                client = cls(base_url, username, password, name)
+                cls._clients[key] = client
+
+        return client
+
+    def request(self, endpoint: str) -> Future:
+        """
+            Send a GET request to a CGI endpoint.
+
+        :param endpoint: Path relative to /cgi-bin/
+        :return: A future of the response, raises for HTTP errors
+        """
+        return self._executor.submit(self._get, endpoint)
+
+    async def request_async(self, endpoint: str) -> requests.Response:
+        return await asyncio.wrap_future(self.request(endpoint))
+
+    def get_stats(self) -> Dict[str, float]:
+        return {
+            "http_requests": self.requests,
+            "http_errors": self.errors,
+            "http_latency_total": self.total_latency,
+            "http_latency_max": self.max_latency
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._session.close()
+
+    def _get(self, endpoint: str) -> requests.Response:
+        url = f"{self.base_url}{endpoint}"
+        start = perf_counter()
+
+        try:
+            response = self._session.get(url, timeout=HTTP_REQUEST_TIMEOUT)
+            response.raise_for_status()
+
+            return response
+
+        except Exception:
+            self.errors += 1
+            raise
+
+        finally:
+            latency = perf_counter() - start
+
+            self.requests += 1
+            self.last_latency = latency
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+            logger.debug(f"{self.name} GET {endpoint} took {latency * 1000:.1f} ms")
@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import sys
+from threading import Lock
+from time import time
+from typing import Any, Dict, Optional
+
+from common.consts import *
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceDetailsCache:
+    """
+        Identity and capabilities of the devices (version, serial number, device type, hold time,
+        supported RPC methods), keyed by host:port (see get_key) and kept in a JSON file across restarts.
+        Entries of older versions, keyed by host only, are never matched and the devices are probed again.
+
+        Sessions read their entry at startup, so events are enriched from the first frame and reconnects
+        skip the identity probes. Updates are kept in memory and written on flush, the file is merged on write
+        since the worker processes of the supervisor share it.
+    """
+
+    _caches: Dict[str, "DeviceDetailsCache"] = {}
+    _caches_lock = Lock()
+
+    def __init__(self, path: str = ""):
+        self.path = path
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._dirty: Dict[str, Dict[str, Any]] = {}
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+        if self.path:
+            self._entries = self.read(self.path)
+
+            logger.info(f"Loaded details of {len(self._entries)} devices from {self.path}")
+
+    @classmethod
+    def get(cls, path: Optional[str] = None) -> "DeviceDetailsCache":
+        """
+            The cache of a file, shared by all sessions of the process.
+
+        :param path: Overrides DEVICE_DETAILS_CACHE_FILE, empty keeps the cache in memory only
+        """
+        path = DEVICE_DETAILS_CACHE_FILE if path is None else path
+
+        with cls._caches_lock:
+            cache = cls._caches.get(path)
+
+            if cache is None:
+                cache = cls(path)
+                cls._caches[path] = cache
+
+        return cache
+
+    @staticmethod
+    def get_key(host: str, port: int) -> str:
+        """The key of a device, several devices may share a host (port forwarding, simulators)"""
+        return f"{host}:{port}"
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+            The cached entry of a device.
+
+        :return: A copy of the entry, None when the device was never seen
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+
+            return json.loads(json.dumps(entry))
+
+    def is_stale(self, entry: Dict[str, Any]) -> bool:
+        return time() - entry.get("updated", 0) > DEVICE_DETAILS_CACHE_TTL
+
+    def update(self, key: str, entry: Dict[str, Any]) -> bool:
+        """
+            Replace the entry of a device, written on the next flush.
+
+        :return: True when the entry needs to be written
+        """
+        with self._lock:
+            current = self._entries.get(key, {})
+            compared = {key: value for key, value in current.items() if key != "updated"}
+
+            # Unchanged entries are only rewritten to renew their age
+            if compared == entry and not self.is_stale(current):
+                return False
+
+            stored = {**entry, "updated": time()}
+
+            self._entries[key] = stored
+            self._dirty[key] = stored
+
+        return True
+
+    def flush(self):
+        """
+            Write the changed entries, merged into the entries other processes wrote meanwhile.
+        """
+        with self._lock:
+            if not self._dirty or not self.path:
+                self._dirty.clear()
+                return
+
+            dirty, self._dirty = self._dirty, {}
+
+            try:
+                entries = self.read(self.path)
+                entries.update(dirty)
+
+                temp_path = f"{self.path}.{os.getpid()}.tmp"
+
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+                with open(temp_path, "w") as file:
+                    json.dump(entries, file, indent=4)
+
+                os.replace(temp_path, self.path)
+
+                self.writes += 1
+
+                logger.debug(f"Saved details of {len(dirty)} devices to {self.path}")
+
+            except Exception as ex:
+                exc_type, exc_obj, exc_tb = sys.exc_info()
+
+                logger.error(f"Failed to save device details to {self.path}, error: {ex}, Line: {exc_tb.tb_lineno}")
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "details_cache_hits": self.hits,
+            "details_cache_misses": self.misses,
+            "details_cache_writes": self.writes
+        }
+
+    @staticmethod
+    def read(path: str) -> Dict[str, Dict[str, Any]]:
+        if not os.path.exists(path):
+            return {}
+
+        try:
+            with open(path) as file:
+                entries = json.load(file)
+
+            if isinstance(entries, dict):
+                return entries
+
+            logger.warning(f"Ignoring device details cache {path}, expected a JSON object")
+
+        except Exception as ex:
+            logger.warning(f"Ignoring device details cache {path}, error: {ex}")
+
+        return {}
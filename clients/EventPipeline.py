@@ -0,0 +1,321 @@
+import logging
+from time import monotonic
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from clients.SessionScheduler import SessionScheduler
+from common.consts import *
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = monotonic()
+
+    def take(self, now: float) -> bool:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+
+        return True
+
+
+class TrackedObject:
+    __slots__ = ("bounding_box", "center", "seen_at", "ttl")
+
+    def __init__(self, bounding_box: List[int], center: List[int], seen_at: float, ttl: float):
+        self.bounding_box = bounding_box
+        self.center = center
+        self.seen_at = seen_at
+        # track_ttl of the object's code
+        self.ttl = ttl
+
+    def moved(self, bounding_box: List[int], center: List[int]) -> int:
+        """Largest change of a coordinate of the box or center (Dahua coordinates, 0 - 8191)"""
+        deltas = [abs(new - old) for new, old in zip(bounding_box, self.bounding_box)]
+        deltas += [abs(new - old) for new, old in zip(center, self.center)]
+
+        return max(deltas, default=0)
+
+
+class EventPolicy:
+    """
+        Suppression settings of one event code, an entry of the event_policies of a device:
+            {"VideoMotion": {"merge_window": 2, "debounce": 1, "debounce_edge": "leading", "rate": 1, "burst": 5}}
+        The "*" entry applies to codes without their own entry.
+    """
+
+    def __init__(self, data: Dict[str, Any]):
+        # IVS events, coordinate change of the tracked object that is published (0 does not track) and
+        # seconds after which an object that was not seen is forgotten
+        self.track_threshold = int(data.get("track_threshold", 0))
+        self.track_ttl = float(data.get("track_ttl", EVENT_TRACK_TTL))
+
+        # Events per second and bucket size, 0 does not limit
+        self.rate = float(data.get("rate", 0))
+        self.burst = max(1, int(data.get("burst", self.rate)))
+
+        # Seconds an event must be quiet, leading publishes the first event, trailing the last one
+        self.debounce = float(data.get("debounce", 0))
+        self.debounce_edge = str(data.get("debounce_edge", EVENT_DEBOUNCE_LEADING)).casefold()
+
+        # Seconds a Stop is held back, a Start within the window cancels both
+        self.merge_window = float(data.get("merge_window", 0))
+
+
+class EventPipeline:
+    """
+        Per-code suppression of event storms between the event stream and the MQTT publish.
+
+        Events of a code with a policy pass four stages, each only active when configured:
+            track - IVS events of an object (ObjectID) are published when it appears / disappears or moves
+                    more than track_threshold, the repeated frames of an object standing still are dropped
+                    unless their Action (Start / Stop) changes
+            merge - a Stop followed by a Start within merge_window is dropped together with the Start (flapping)
+            debounce - leading or trailing edge, per code and index
+            rate limit - token bucket per code
+        The Stop closing a published Start always passes debounce and rate limit, subscribers would stay "on".
+        Events held back by merge / trailing debounce are emitted from the session scheduler,
+        flush() emits them right away when the session ends.
+    """
+
+    def __init__(
+            self,
+            policies: Dict[str, Dict[str, Any]],
+            scheduler: SessionScheduler,
+            emit: Callable[[Dict[str, Any]], None]
+    ):
+        self._policies = {code: EventPolicy(policy) for code, policy in policies.items()}
+        self._default = self._policies.pop("*", None)
+        self._scheduler = scheduler
+        self._emit_event = emit
+
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._quiet_until: Dict[Tuple, float] = {}
+        self._trailing: Dict[Tuple, Tuple[Any, Dict[str, Any]]] = {}
+        self._held_stops: Dict[Tuple, Tuple[Any, Dict[str, Any]]] = {}
+        # (code, ObjectID) -> object, ordered by last seen
+        self._objects: Dict[Tuple, TrackedObject] = {}
+        self._objects_swept_at = monotonic()
+        # Objects seen more recently than the shortest track_ttl are never expired, the sweep stops there
+        self._min_track_ttl = min(
+            [policy.track_ttl for policy in list(self._policies.values()) + [self._default] if policy is not None],
+            default=EVENT_TRACK_TTL
+        )
+        # (code, Index) -> Action of the last published event
+        self._published: Dict[Tuple, Any] = {}
+
+        self.merged = 0
+        self.debounced = 0
+        self.rate_limited = 0
+        self.downsampled = 0
+        self.suppressed: Dict[str, int] = {}
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "events_merged": self.merged,
+            "events_debounced": self.debounced,
+            "events_rate_limited": self.rate_limited,
+            "events_downsampled": self.downsampled,
+            "objects_tracked": len(self._objects),
+            "events_held": len(self._trailing) + len(self._held_stops)
+        }
+
+    def process(self, message: Dict[str, Any]):
+        """
+            Run an event through the stages of its code, emit is called now, later or never.
+        """
+        code = message.get("Code")
+        policy = self._policies.get(code, self._default)
+
+        if policy is None:
+            self._emit_event(message)
+            return
+
+        key = (code, message.get("Index"))
+
+        # A Start / Stop change is never downsampled, the object standing still does not close the event
+        if (
+                policy.track_threshold > 0
+                and not self._track(policy, code, message)
+                and message.get("Action") == self._published.get(key)
+        ):
+            self.downsampled += 1
+            self._suppress(code)
+            return
+
+        self._merge(policy, key, message)
+
+    def flush(self):
+        """
+            Emit the events held back by merge / trailing debounce, used when the session ends.
+        """
+        held = list(self._held_stops.values()) + list(self._trailing.values())
+
+        self._held_stops.clear()
+        self._trailing.clear()
+
+        for handle, message in held:
+            self._scheduler.cancel(handle)
+            self._emit(message)
+
+    def _emit(self, message: Dict[str, Any]):
+        self._published[(message.get("Code"), message.get("Index"))] = message.get("Action")
+        self._emit_event(message)
+
+    def _closes_start(self, key: Tuple, message: Dict[str, Any]) -> bool:
+        """Whether the event is the Stop of a published Start"""
+        return message.get("Action") == EVENT_ACTION_STOP and self._published.get(key) == EVENT_ACTION_START
+
+    def _suppress(self, code: str, count: int = 1):
+        self.suppressed[code] = self.suppressed.get(code, 0) + count
+
+    def _track(self, policy: EventPolicy, code: str, message: Dict[str, Any]) -> bool:
+        """
+            Update the state of the event's object.
+
+        :return: False when the event only repeats the last published state of its object
+        """
+        now = monotonic()
+
+        if now - self._objects_swept_at >= 1:
+            self._sweep_objects(now)
+
+        data = message.get("Data")
+        event_object = data.get("Object") if isinstance(data, dict) else None
+
+        if not isinstance(event_object, dict) or event_object.get("ObjectID") is None:
+            return True
+
+        key = (code, event_object.get("ObjectID"))
+        bounding_box = event_object.get("BoundingBox") or []
+        center = event_object.get("Center") or []
+        tracked = self._objects.pop(key, None)
+
+        if event_object.get("Action") in EVENT_OBJECT_GONE_ACTIONS or data.get("Action") in EVENT_OBJECT_GONE_ACTIONS:
+            return True
+
+        if tracked is None or tracked.moved(bounding_box, center) > policy.track_threshold:
+            self._objects[key] = TrackedObject(bounding_box, center, now, policy.track_ttl)
+
+            if len(self._objects) > EVENT_TRACK_MAX_OBJECTS:
+                del self._objects[next(iter(self._objects))]
+
+            return True
+
+        # Re-inserted to keep the order by last seen, the published position stays the reference
+        tracked.seen_at = now
+        self._objects[key] = tracked
+
+        return False
+
+    def _sweep_objects(self, now: float):
+        """
+            Forget the objects not seen within the track_ttl of their code.
+        """
+        self._objects_swept_at = now
+        expired = []
+
+        for key, tracked in self._objects.items():
+            age = now - tracked.seen_at
+
+            # Ordered by last seen, the objects from here on are all younger
+            if age < self._min_track_ttl:
+                break
+
+            if age >= tracked.ttl:
+                expired.append(key)
+
+        for key in expired:
+            del self._objects[key]
+
+    def _merge(self, policy: EventPolicy, key: Tuple, message: Dict[str, Any]):
+        if policy.merge_window <= 0:
+            self._debounce(policy, key, message)
+            return
+
+        action = message.get("Action")
+        held = self._held_stops.pop(key, None)
+
+        if held is not None:
+            handle, stop = held
+            self._scheduler.cancel(handle)
+
+            if action == EVENT_ACTION_START:
+                # Stopped and started again right away, to the subscribers it never stopped
+                self.merged += 2
+                self._suppress(key[0], 2)
+                return
+
+            self._debounce(policy, key, stop)
+
+        if action == EVENT_ACTION_STOP:
+            handle = self._scheduler.call_later(policy.merge_window, self._release_stop, policy, key)
+            self._held_stops[key] = (handle, message)
+            return
+
+        self._debounce(policy, key, message)
+
+    def _release_stop(self, policy: EventPolicy, key: Tuple):
+        held = self._held_stops.pop(key, None)
+
+        if held is not None:
+            self._debounce(policy, key, held[1])
+
+    def _debounce(self, policy: EventPolicy, key: Tuple, message: Dict[str, Any]):
+        if policy.debounce <= 0:
+            self._rate_limit(policy, key, message)
+            return
+
+        if policy.debounce_edge == EVENT_DEBOUNCE_TRAILING:
+            pending = self._trailing.pop(key, None)
+
+            if pending is not None:
+                self._scheduler.cancel(pending[0])
+                self.debounced += 1
+                self._suppress(key[0])
+
+            handle = self._scheduler.call_later(policy.debounce, self._release_trailing, policy, key)
+            self._trailing[key] = (handle, message)
+            return
+
+        now = monotonic()
+        quiet_until = self._quiet_until.get(key, 0)
+        self._quiet_until[key] = now + policy.debounce
+
+        if now < quiet_until and not self._closes_start(key, message):
+            self.debounced += 1
+            self._suppress(key[0])
+            return
+
+        self._rate_limit(policy, key, message)
+
+    def _release_trailing(self, policy: EventPolicy, key: Tuple):
+        pending = self._trailing.pop(key, None)
+
+        if pending is not None:
+            self._rate_limit(policy, key, pending[1])
+
+    def _rate_limit(self, policy: EventPolicy, key: Tuple, message: Dict[str, Any]):
+        if policy.rate > 0 and not self._closes_start(key, message):
+            code = key[0]
+            bucket: Optional[TokenBucket] = self._buckets.get(code)
+
+            if bucket is None:
+                bucket = self._buckets[code] = TokenBucket(policy.rate, policy.burst)
+
+            if not bucket.take(monotonic()):
+                self.rate_limited += 1
+                self._suppress(code)
+                return
+
+        self._emit(message)
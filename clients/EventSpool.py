@@ -0,0 +1,412 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from collections import deque
+from threading import Lock
+from time import monotonic, time
+from typing import Any, Deque, Dict, List, Optional
+
+from common.consts import *
+
+logger = logging.getLogger(__name__)
+
+# Record length and the wall clock time it was spooled at, a length of 0 marks the end of a segment's data
+RECORD_HEADER = struct.Struct("<Id")
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor.json"
+
+
+class SpoolSegment:
+    __slots__ = ("sequence", "path", "size", "records")
+
+    def __init__(self, sequence: int, path: str, size: int = 0, records: int = 0):
+        self.sequence = sequence
+        self.path = path
+        self.size = size
+        self.records = records
+
+
+class SegmentWriter:
+    """
+        Appends records to a segment through a buffered file.
+    """
+
+    def __init__(self, path: str, capacity: int):
+        self.file = open(path, "ab")
+
+    def write(self, data: bytes):
+        self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self, size: int):
+        self.file.close()
+
+
+class MmapSegmentWriter(SegmentWriter):
+    """
+        Appends records to a preallocated, memory mapped segment, the file is cut to its data on close.
+        Writes are visible to readers of the file right away, sync is an msync.
+    """
+
+    def __init__(self, path: str, capacity: int):
+        self.file = open(path, "w+b")
+        self.file.truncate(capacity)
+        self.map = mmap.mmap(self.file.fileno(), capacity)
+        self.position = 0
+
+    def write(self, data: bytes):
+        end = self.position + len(data)
+        self.map[self.position:end] = data
+        self.position = end
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        self.map.flush()
+
+    def close(self, size: int):
+        self.map.flush()
+        self.map.close()
+        self.file.truncate(size)
+        self.file.close()
+
+
+class EventSpool:
+    """
+        Append-only, segmented on-disk queue of the events published while the MQTT broker is away.
+
+        Events are appended to the newest segment, a new segment is started when it reaches SPOOL_SEGMENT_SIZE.
+        Replay reads from the oldest segment and acknowledges what was published, fully replayed segments
+        are deleted. The read position is kept in a cursor file, after a crash at most the events of the last
+        unacknowledged batch are published twice.
+
+        Oldest segments are dropped when the spool exceeds SPOOL_MAX_BYTES, events older than SPOOL_MAX_AGE
+        are skipped on replay. SPOOL_FSYNC decides when appends reach the disk: always, interval or never.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            segment_size: int = SPOOL_SEGMENT_SIZE,
+            max_bytes: int = SPOOL_MAX_BYTES,
+            max_age: float = SPOOL_MAX_AGE,
+            fsync: str = SPOOL_FSYNC,
+            use_mmap: bool = SPOOL_MMAP
+    ):
+        if fsync not in SPOOL_FSYNC_POLICIES:
+            raise ValueError(f"Unknown spool fsync policy: {fsync}, expected one of {', '.join(SPOOL_FSYNC_POLICIES)}")
+
+        self.path = path
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync = fsync
+        self.use_mmap = use_mmap
+
+        self._lock = Lock()
+        self._segments: Deque[SpoolSegment] = deque()
+        self._writer: Optional[SegmentWriter] = None
+        self._synced_at = monotonic()
+
+        # Position in the oldest segment, records before it were replayed
+        self._read_offset = 0
+        self._read_records = 0
+        # End offset of each record handed out by read and not acknowledged yet
+        self._inflight: List[int] = []
+        # Records and bytes of all segments
+        self._records = 0
+        self._size = 0
+
+        self.spooled = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.expired = 0
+        self.syncs = 0
+
+        os.makedirs(self.path, exist_ok=True)
+
+        self._recover()
+
+        if self.pending:
+            logger.info(f"Spool {self.path} holds {self.pending} events from before the restart")
+
+    @property
+    def pending(self) -> int:
+        """Spooled events that were not replayed yet"""
+        return self._records - self._read_records
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "spooled": self.spooled,
+            "spool_replayed": self.replayed,
+            "spool_dropped": self.dropped,
+            "spool_expired": self.expired,
+            "spool_pending": self.pending,
+            "spool_bytes": self.size,
+            "spool_syncs": self.syncs
+        }
+
+    def append(self, data: Dict[str, Any]):
+        """
+            Spool an event, the newest segment is rotated when the record does not fit anymore.
+        """
+        record = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        header = RECORD_HEADER.pack(len(record), time())
+        length = len(header) + len(record)
+
+        with self._lock:
+            segment = self._segments[-1] if self._writer is not None else None
+
+            if segment is None or segment.size + length > self.segment_size:
+                segment = self._rotate(length)
+
+            self._writer.write(header + record)
+
+            segment.size += length
+            segment.records += 1
+            self._size += length
+            self._records += 1
+            self.spooled += 1
+
+            if self.fsync == SPOOL_FSYNC_ALWAYS:
+                self._sync()
+
+            elif self.fsync == SPOOL_FSYNC_INTERVAL and monotonic() - self._synced_at >= SPOOL_FSYNC_PERIOD:
+                self._sync()
+
+            if 0 < self.max_bytes < self.size:
+                self._enforce_size()
+
+    def read(self, limit: int) -> List[Dict[str, Any]]:
+        """
+            The next events to replay, in the order they were spooled.
+            They stay spooled until acknowledged, another read returns them again.
+        """
+        with self._lock:
+            self._inflight = []
+
+            while self._segments:
+                segment = self._segments[0]
+
+                if self._writer is not None and segment is self._segments[-1]:
+                    self._writer.flush()
+
+                events = self._read_segment(segment, limit)
+
+                if events or self._read_records < segment.records or segment is self._segments[-1]:
+                    return events
+
+                self._remove_oldest()
+
+            return []
+
+    def ack(self, count: int):
+        """
+            The first count events of the last read were published.
+        """
+        with self._lock:
+            if count <= 0 or not self._inflight:
+                return
+
+            count = min(count, len(self._inflight))
+
+            self._read_offset = self._inflight[count - 1]
+            self._read_records += count
+            self._inflight = []
+            self.replayed += count
+
+            segment = self._segments[0]
+
+            if self._read_records >= segment.records and segment is not self._segments[-1]:
+                self._remove_oldest()
+
+            elif self._read_records >= segment.records and self._writer is None:
+                # Everything was replayed, the next append starts a new segment
+                self._remove_oldest()
+
+            self._write_cursor()
+
+    def close(self):
+        """
+            Make the spooled events durable, the spool is reopened from its files.
+        """
+        with self._lock:
+            if self._writer is not None:
+                self._writer.sync()
+                self._writer.close(self._segments[-1].size)
+                self._writer = None
+
+            self._write_cursor()
+
+    def _read_segment(self, segment: SpoolSegment, limit: int) -> List[Dict[str, Any]]:
+        events = []
+        offset = self._read_offset
+        records = self._read_records
+        now = time()
+
+        with open(segment.path, "rb") as file:
+            file.seek(offset)
+
+            while len(events) < limit and records < segment.records:
+                header = file.read(RECORD_HEADER.size)
+
+                if len(header) < RECORD_HEADER.size:
+                    break
+
+                length, spooled_at = RECORD_HEADER.unpack(header)
+                record = file.read(length)
+
+                if length == 0 or len(record) < length:
+                    break
+
+                if 0 < self.max_age < now - spooled_at:
+                    if events:
+                        # Skipped by the next read, the events before it are still in flight
+                        break
+
+                    # Too old to be of use, skipped right away
+                    offset += RECORD_HEADER.size + length
+                    records += 1
+                    self._read_offset = offset
+                    self._read_records = records
+                    self.expired += 1
+                    continue
+
+                offset += RECORD_HEADER.size + length
+                records += 1
+
+                events.append(json.loads(record))
+                self._inflight.append(offset)
+
+        return events
+
+    def _rotate(self, length: int) -> SpoolSegment:
+        if self._writer is not None:
+            self._writer.close(self._segments[-1].size)
+
+        sequence = self._segments[-1].sequence + 1 if self._segments else 0
+        segment = SpoolSegment(sequence, os.path.join(self.path, f"{sequence:012d}{SEGMENT_SUFFIX}"))
+        writer_type = MmapSegmentWriter if self.use_mmap else SegmentWriter
+
+        self._writer = writer_type(segment.path, max(self.segment_size, length))
+        self._segments.append(segment)
+
+        return segment
+
+    def _sync(self):
+        self._writer.sync()
+        self._synced_at = monotonic()
+        self.syncs += 1
+
+    def _enforce_size(self):
+        while len(self._segments) > 1 and self.size > self.max_bytes:
+            segment = self._segments[0]
+            dropped = segment.records - self._read_records
+
+            self._inflight = []
+            self._remove_oldest()
+            self.dropped += dropped
+
+            logger.warning(f"Spool {self.path} is full, dropped {dropped} events of segment {segment.sequence}")
+
+    def _remove_oldest(self):
+        segment = self._segments.popleft()
+
+        self._records -= segment.records
+        self._size -= segment.size
+        self._read_offset = 0
+        self._read_records = 0
+
+        try:
+            os.remove(segment.path)
+
+        except OSError as ex:
+            logger.warning(f"Failed to remove spool segment {segment.path}, error: {ex}")
+
+    def _write_cursor(self):
+        sequence = self._segments[0].sequence if self._segments else -1
+        cursor = {"sequence": sequence, "offset": self._read_offset, "records": self._read_records}
+        cursor_path = os.path.join(self.path, CURSOR_FILE)
+
+        try:
+            with open(f"{cursor_path}.tmp", "w") as file:
+                json.dump(cursor, file)
+
+            os.replace(f"{cursor_path}.tmp", cursor_path)
+
+        except Exception as ex:
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+
+            logger.error(f"Failed to save spool cursor {cursor_path}, error: {ex}, Line: {exc_tb.tb_lineno}")
+
+    def _recover(self):
+        """
+            Reopen the segments left by the last run, records cut short by a crash are discarded.
+            Appends always start a new segment.
+        """
+        cursor = {}
+        cursor_path = os.path.join(self.path, CURSOR_FILE)
+
+        if os.path.exists(cursor_path):
+            try:
+                with open(cursor_path) as file:
+                    cursor = json.load(file)
+
+            except Exception as ex:
+                logger.warning(f"Ignoring spool cursor {cursor_path}, error: {ex}")
+
+        names = sorted(name for name in os.listdir(self.path) if name.endswith(SEGMENT_SUFFIX))
+
+        for name in names:
+            segment = SpoolSegment(int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(self.path, name))
+
+            if segment.sequence < cursor.get("sequence", -1):
+                os.remove(segment.path)
+                continue
+
+            self._scan(segment)
+
+            if segment.records > 0:
+                self._segments.append(segment)
+                self._records += segment.records
+                self._size += segment.size
+
+            else:
+                os.remove(segment.path)
+
+        if self._segments and self._segments[0].sequence == cursor.get("sequence"):
+            self._read_offset = int(cursor.get("offset", 0))
+            self._read_records = int(cursor.get("records", 0))
+
+    @staticmethod
+    def _scan(segment: SpoolSegment):
+        with open(segment.path, "r+b") as file:
+            while True:
+                header = file.read(RECORD_HEADER.size)
+
+                if len(header) < RECORD_HEADER.size:
+                    break
+
+                length, spooled_at = RECORD_HEADER.unpack(header)
+
+                if length == 0 or len(file.read(length)) < length:
+                    break
+
+                segment.size += RECORD_HEADER.size + length
+                segment.records += 1
+
+            file.truncate(segment.size)
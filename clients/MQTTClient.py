@@ -1,22 +1,76 @@
+import asyncio
 import json
 import logging
+import os
+import queue
 import sys
-from time import sleep
+from threading import RLock, Thread
+from time import monotonic, sleep, time
+from typing import Any, Dict, List, Optional, Tuple
 
 from paho.mqtt import reasoncodes
 import paho.mqtt.client as mqtt
 
+from clients.Backoff import Backoff
 from clients.BaseClient import BaseClient
+from clients.EventSpool import EventSpool
+from clients.Metrics import Histogram
+from clients.Profiler import Profiler
 from common.consts import *
+from models.DahuaConfigData import DahuaConfigurationData
 from models.MQTTConfigData import MQTTConfigurationData
 
 
 logger = logging.getLogger(__name__)
 
 
+class MQTTAsyncioHelper:
+    """
+        Drives the paho socket from an asyncio event loop instead of the loop_start() thread,
+        reads / writes are triggered by socket readiness and loop_misc runs once a second.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: mqtt.Client):
+        self.loop = loop
+        self.client = client
+        self.misc: Optional[asyncio.Task] = None
+
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+
+        if self.misc is None or self.misc.done():
+            self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
 class MQTTClient(BaseClient):
-    def __init__(self):
-        super().__init__("MQTT")
+    def __init__(self, devices: Optional[List[DahuaConfigurationData]] = None):
+        if COMMAND_QUEUE_POLICY == QUEUE_POLICY_BLOCK:
+            # block relies on the producer pausing, MQTT commands can't be paused and the queue would grow unbounded
+            raise ValueError(f"Queue policy {QUEUE_POLICY_BLOCK} is not supported by the command queue")
+
+        super().__init__("MQTT", COMMAND_QUEUE_SIZE, COMMAND_QUEUE_POLICY)
         logger.info(f"{MQTT_DEBUG=}")
         if MQTT_DEBUG is True:
             logger.setLevel(logging.DEBUG)
@@ -29,13 +83,55 @@ class MQTTClient(BaseClient):
                 handler.setLevel(logging.INFO)
             logger.info(f"Set INFO level for {__name__}")
         self._mqtt_config = MQTTConfigurationData()
-        self._mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, self._mqtt_config.client_id, clean_session=True)
+        self.published = 0
+        self.publish_errors = 0
+        self._backoff = Backoff()
+        self.publish_latency = Histogram()
+        # Queued by the Dahua session -> handed to paho, device clock (skew corrected) -> handed to paho
+        self.latency_queue = Histogram()
+        self.latency_total = Histogram()
+        # mid -> when it was handed to paho, and acks that arrived before publish returned the mid
+        self._publish_times: Dict[int, float] = {}
+        self._early_acks: Dict[int, float] = {}
+        self._publish_lock = RLock()
+        self._spool: Optional[EventSpool] = None
+
+        if SPOOL_DIR:
+            spool_path = os.path.join(SPOOL_DIR, self._mqtt_config.client_id)
+
+            try:
+                self._spool = EventSpool(spool_path)
+
+            except Exception as ex:
+                exc_type, exc_obj, exc_tb = sys.exc_info()
+
+                logger.error(f"Failed to open spool {spool_path}, events will not be spooled, error: {ex}, Line: {exc_tb.tb_lineno}")
+
+        # device name -> topic prefix, all devices share this connection
+        self._topic_prefixes: Dict[str, str] = {}
+        # command topic prefix -> device name
+        self._command_prefixes: Dict[str, str] = {}
+
+        for device in devices or []:
+            self._topic_prefixes[device.name] = device.topic_prefix
+            self._command_prefixes[f"{device.topic_prefix}{TOPIC_COMMAND}/"] = device.name
+
+        # Reconnects are paced by _backoff in both runtimes, paho's own retries would bypass it
+        self._mqtt_client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            self._mqtt_config.client_id,
+            clean_session=True,
+            reconnect_on_failure=False
+        )
         self._mqtt_client.user_data_set(self)
+        # paho keeps unsent messages in memory, bound it too
+        self._mqtt_client.max_queued_messages_set(MQTT_MAX_QUEUED_MESSAGES)
         self._mqtt_client.username_pw_set(self._mqtt_config.username, self._mqtt_config.password)
 
         self._mqtt_client.on_connect = self._on_mqtt_connect
         self._mqtt_client.on_message = self._on_mqtt_message
         self._mqtt_client.on_disconnect = self._on_mqtt_disconnect
+        self._mqtt_client.on_publish = self._on_mqtt_publish
 
     @property
     def topic_command_prefix(self):
@@ -45,41 +141,228 @@ class MQTTClient(BaseClient):
     def topic_prefix(self):
         return self._mqtt_config.topic_prefix
 
+    @property
+    def topic_command_prefixes(self) -> List[str]:
+        return list(self._command_prefixes) or [self.topic_command_prefix]
+
+    @property
+    def is_ready(self) -> bool:
+        # Keep events queued while the broker is away instead of handing them to paho, unless they are spooled
+        return self.is_connected or self._spool is not None
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = super(MQTTClient, self).get_stats()
+        stats["published"] = self.published
+        stats["publish_errors"] = self.publish_errors
+        stats.update(self.publish_latency.get_stats("publish_latency"))
+        stats.update(self.latency_queue.get_stats("latency_queue"))
+        stats.update(self.latency_total.get_stats("latency_total"))
+
+        if self._spool is not None:
+            stats.update(self._spool.get_stats())
+
+        return stats
+
+    def initialize(self, incoming_events: queue.Queue):
+        if self._spool is not None:
+            Thread(target=self._replay, name="MQTTReplay", daemon=True).start()
+
+        super(MQTTClient, self).initialize(incoming_events)
+
+    def terminate(self):
+        super(MQTTClient, self).terminate()
+
+        if self._spool is not None:
+            self._spool.close()
+
+    def _get_command_target(self, topic: str) -> Tuple[Optional[str], str]:
+        """
+            Find the device a command topic is addressed to.
+
+        :return: The device name (None when devices are not registered) and the command
+        """
+        for command_prefix, device in self._command_prefixes.items():
+            if topic.startswith(command_prefix):
+                return device, topic[len(command_prefix):]
+
+        return None, topic.replace(self.topic_command_prefix, "")
+
     def _connect(self):
         super(MQTTClient, self)._connect()
 
         config = self._mqtt_config
 
-        while not self.is_connected:
+        while self.should_connect:
             try:
                 logger.info("Trying to connect to MQTT Broker...")
 
-                self._mqtt_client.connect(config.host, int(config.port), 60)
+                # The network loop of the previous connection ends with it, paho does not reconnect by itself
+                self._mqtt_client.loop_stop()
+                self._mqtt_client.connect(config.host, int(config.port), MQTT_KEEPALIVE)
+
+                # From here on a refusal or a lost connection schedules the next attempt (_on_mqtt_disconnect),
+                # this attempt must not count as pending anymore
+                self._timer_connect = None
                 self._mqtt_client.loop_start()
 
-                sleep(5)
+                return
 
             except Exception as ex:
                 exc_type, exc_obj, exc_tb = sys.exc_info()
                 error_details = f"error: {ex}, Line: {exc_tb.tb_lineno}"
+                sleep_time = self._backoff.next_delay()
+
+                logger.error(f"Failed to connect to broker, retry in {sleep_time:.1f} seconds, {error_details}")
+
+                sleep(sleep_time)
+
+    async def connect_async(self):
+        """
+            asyncio runtime, the socket is driven by the event loop (MQTTAsyncioHelper), no loop_start() thread.
+            paho's connect itself (DNS lookup and TCP handshake) still blocks the loop until it returns.
+        """
+        config = self._mqtt_config
+
+        MQTTAsyncioHelper(self._loop, self._mqtt_client)
+
+        replay = self._loop.create_task(self._replay_async()) if self._spool is not None else None
+
+        while self.is_running:
+            # A refusal or a lost connection requests the next attempt (_on_mqtt_disconnect), paced by _backoff.
+            # paho reports a missing CONNACK as a disconnect after the keepalive.
+            sleep_time = MQTT_KEEPALIVE
+
+            if self.should_connect:
+                try:
+                    logger.info("Trying to connect to MQTT Broker...")
+
+                    self._mqtt_client.connect(config.host, int(config.port), MQTT_KEEPALIVE)
+
+                except Exception as ex:
+                    exc_type, exc_obj, exc_tb = sys.exc_info()
+                    error_details = f"error: {ex}, Line: {exc_tb.tb_lineno}"
+                    sleep_time = self._backoff.next_delay()
+
+                    logger.error(f"Failed to connect to broker, retry in {sleep_time:.1f} seconds, {error_details}")
+
+            await self.wait_connect_request(sleep_time)
 
-                logger.error(f"Failed to connect to broker, retry in 60 seconds, {error_details}")
+        if replay is not None:
+            replay.cancel()
 
-                sleep(60)
+        self._mqtt_client.disconnect()
+
+    def _replay(self):
+        """
+            Publish the spooled events once the broker is back, threaded runtime.
+        """
+        while self.is_running:
+            sleep(self._replay_batch())
+
+    async def _replay_async(self):
+        """
+            asyncio runtime counterpart of _replay.
+        """
+        while self.is_running:
+            await asyncio.sleep(self._replay_batch())
+
+    def _replay_batch(self) -> float:
+        """
+            Publish the next spooled events, paced to SPOOL_REPLAY_RATE.
+
+        :return: Seconds until the next batch
+        """
+        if not self.is_connected or not self._spool.pending:
+            return QUEUE_RESUME_INTERVAL
+
+        try:
+            batch = self._spool.read(LISTEN_BATCH_SIZE)
+
+        except Exception as ex:
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+
+            logger.error(f"Failed to read spooled events, error: {ex}, Line: {exc_tb.tb_lineno}")
+
+            return QUEUE_RESUME_INTERVAL
+
+        published = 0
+
+        for data in batch:
+            if not self._publish(data):
+                break
+
+            published += 1
+
+        self._spool.ack(published)
+
+        if published < len(batch):
+            # Disconnected or paho's queue is full, retried from the first unpublished event
+            return QUEUE_RESUME_INTERVAL
+
+        return published / SPOOL_REPLAY_RATE if SPOOL_REPLAY_RATE > 0 else 0
 
     def _event_received(self, data):
         super(MQTTClient, self)._event_received(data)
 
+        spool = self._spool
+
+        if spool is not None and (not self.is_connected or spool.pending):
+            # Spooled events go first, the new ones wait behind them to keep the order
+            self._spool_event(data)
+            return
+
+        if not self._publish(data) and spool is not None:
+            self._spool_event(data)
+
+    def _spool_event(self, data: Dict[str, Any]):
+        """
+            Spool an event without its stamps, the latency histograms would count the outage as queue time.
+        """
+        self._spool.append({key: value for key, value in data.items() if key != "timings"})
+
+    def _publish(self, data) -> bool:
+        """
+            Hand an event to paho.
+
+        :return: False when it was not accepted
+        """
         topic_suffix = data.get("event")
         payload = data.get("payload")
+        topic_prefix = self._topic_prefixes.get(data.get("device"), self.topic_prefix)
+
+        topic = f"{topic_prefix}/{topic_suffix}"
+        timings = data.get("timings")
+
+        if timings is not None:
+            payload = self._measure_latency(timings, payload)
 
-        topic = f"{self.topic_prefix}/{topic_suffix}"
         logger.debug(f"Publishing MQTT message {topic}: {payload}")
 
         try:
-            self._mqtt_client.publish(topic, json.dumps(payload, indent=4))
+            with self._publish_lock:
+                sent_at = monotonic()
+                result = self._mqtt_client.publish(topic, json.dumps(payload, indent=4))
+
+                if result.rc == mqtt.MQTT_ERR_SUCCESS:
+                    acked_at = self._early_acks.pop(result.mid, None)
+
+                    if acked_at is None:
+                        self._publish_times[result.mid] = sent_at
+
+                    else:
+                        self.publish_latency.observe(acked_at - sent_at)
+
+            if result.rc == mqtt.MQTT_ERR_SUCCESS:
+                self.published += 1
+
+                return True
+
+            self.publish_errors += 1
+
+            logger.warning(f"Failed to publish message, Topic: {topic}, Error: {mqtt.error_string(result.rc)}")
         except Exception as ex:
             exc_type, exc_obj, exc_tb = sys.exc_info()
+            self.publish_errors += 1
 
             logger.error(
                 f"Failed to publish message, "
@@ -87,17 +370,21 @@ class MQTTClient(BaseClient):
                 f"Error: {ex}, Line: {exc_tb.tb_lineno}"
             )
 
+        return False
+
     @staticmethod
     def _on_mqtt_connect(client, userdata, flags, reason_code: reasoncodes.ReasonCode, properties):
         if reason_code == 0:
             logger.info(f"Connected to MQTT broker with result code: {reason_code}")
-            client.subscribe(f"{userdata.topic_command_prefix}#")
+            for topic_command_prefix in userdata.topic_command_prefixes:
+                client.subscribe(f"{topic_command_prefix}#")
             userdata.is_connected = True
+            userdata._backoff.reset()
 
         else:
+            # paho closes the connection next, the disconnect schedules the retry
             logger.error(f"Connecting to MQTT Broker failed due to {reason_code}")
             userdata.is_connected = False
-            super(MQTTClient, userdata).connect()
 
     @staticmethod
     def _on_mqtt_message(client, userdata, msg):
@@ -111,13 +398,20 @@ class MQTTClient(BaseClient):
                 if data is not None and len(data) > 0:
                     payload = json.loads(data)
 
-            topic = msg.topic.replace(userdata.topic_command_prefix, "")
+            device, topic = userdata._get_command_target(msg.topic)
+
+            if topic == TOPIC_PROFILE:
+                # Process wide, not a command for the device
+                Profiler.get().start(payload.get("duration", PROFILE_DURATION))
+                return
+
             event_data = {
+                "device": device,
                 "topic": topic,
                 "payload": payload
             }
 
-            userdata.outgoing_events.put(event_data)
+            userdata.outgoing_events.put_nowait(event_data)
         except Exception as ex:
             exc_type, exc_obj, exc_tb = sys.exc_info()
 
@@ -127,9 +421,60 @@ class MQTTClient(BaseClient):
                 f"Error: {ex}, Line: {exc_tb.tb_lineno}"
             )
 
+    def _measure_latency(self, timings: Dict[str, Any], payload: Any) -> Any:
+        """
+            Observe the latencies of an event stamped by the Dahua session.
+
+        :return: The payload, with the latencies in seconds attached when EVENT_LATENCY_ATTACH is set
+        """
+        published_at = time()
+        device_at = timings.get("device_at")
+        received_at = timings.get("received_at")
+        enqueued_at = timings.get("enqueued_at")
+
+        self.latency_queue.observe(published_at - enqueued_at)
+
+        if device_at is not None:
+            self.latency_total.observe(published_at - device_at)
+
+        if not EVENT_LATENCY_ATTACH or not isinstance(payload, dict):
+            return payload
+
+        latency = {
+            "Device": None if device_at is None else round(received_at - device_at, 6),
+            "Pipeline": round(enqueued_at - received_at, 6),
+            "Queue": round(published_at - enqueued_at, 6),
+            "Total": round(published_at - (received_at if device_at is None else device_at), 6)
+        }
+
+        return {**payload, "Latency": latency}
+
+    @staticmethod
+    def _on_mqtt_publish(client, userdata, mid, reason_code, properties):
+        """
+            The message left paho, written to the socket for QoS 0 or acknowledged by the broker for QoS 1 / 2.
+        """
+        acked_at = monotonic()
+
+        with userdata._publish_lock:
+            sent_at = userdata._publish_times.pop(mid, None)
+
+            if sent_at is None:
+                userdata._early_acks[mid] = acked_at
+
+            else:
+                userdata.publish_latency.observe(acked_at - sent_at)
+
     @staticmethod
     def _on_mqtt_disconnect(client, userdata, flags, reason_code, properties):
         # reason_code should now be a string, its __eq__ method still uses ints though.
         logger.warning(f"Disconnected from broker! Reason: {reason_code}")
         userdata.is_connected = False
-        super(MQTTClient, userdata).connect()
+
+        with userdata._publish_lock:
+            # Unsent messages are dropped by paho, their acks will never come
+            userdata._publish_times.clear()
+            userdata._early_acks.clear()
+
+        # Reset by the CONNACK of the next successful connection only
+        super(MQTTClient, userdata).connect(userdata._backoff.next_delay())
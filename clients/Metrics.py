@@ -0,0 +1,208 @@
+import logging
+import re
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from common.consts import *
+
+logger = logging.getLogger(__name__)
+
+BUCKET_KEY = re.compile(r"^(?P<name>.+)_bucket_(?P<bound>[^_]+)$")
+
+MAX_KEY_SUFFIXES = ("_max", "_high_watermark")
+
+# Sections of counts per device and event code, by metric name
+CODE_SECTIONS = {
+    STATS_EVENT_CODES: "events_by_code",
+    STATS_EVENT_CODES_SUPPRESSED: "events_suppressed_by_code",
+}
+
+
+class Histogram:
+    """
+        Counts of observed values per bucket, reported in the stats as {name}_bucket_{bound}, {name}_sum
+        and {name}_count so they add up across sessions and workers like the other counters.
+    """
+
+    __slots__ = ("bounds", "counts", "total", "count")
+
+    def __init__(self, bounds: Sequence[float] = LATENCY_BUCKETS):
+        self.bounds = list(bounds)
+        # Last count is above the highest bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def get_stats(self, name: str) -> Dict[str, float]:
+        stats = {f"{name}_bucket_{bound:g}": count for bound, count in zip(self.bounds, self.counts)}
+        stats[f"{name}_sum"] = self.total
+        stats[f"{name}_count"] = self.count
+
+        return stats
+
+
+def merge_stats(totals: Dict[str, Any], stats: Dict[str, Any]) -> Dict[str, Any]:
+    """
+        Add stats into totals, nested sections (per device, per code) are merged key by key.
+        Maximums (*_max, *_high_watermark) keep the largest value, adding them up would mean nothing.
+    """
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            merge_stats(totals.setdefault(key, {}), value)
+
+        elif key.endswith(MAX_KEY_SUFFIXES):
+            totals[key] = max(totals.get(key, 0), value)
+
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+    return totals
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _metric_name(*parts: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "_".join((METRICS_PREFIX, ) + parts))
+
+
+def _render_values(lines: List[str], prefix: str, values: Dict[str, Any], labels: Dict[str, Any]):
+    histograms: Dict[str, List] = {}
+
+    for key, value in values.items():
+        match = BUCKET_KEY.match(key)
+
+        if match is not None:
+            histograms.setdefault(match.group("name"), []).append((float(match.group("bound")), value))
+
+    histogram_keys = {f"{name}_{suffix}" for name in histograms for suffix in ("sum", "count")}
+
+    for key, value in values.items():
+        if key in histogram_keys or BUCKET_KEY.match(key) is not None:
+            continue
+
+        lines.append(f"{_metric_name(prefix, key)}{_format_labels(labels)} {value}")
+
+    for name, buckets in histograms.items():
+        metric = _metric_name(prefix, name)
+        cumulative = 0
+
+        lines.append(f"# TYPE {metric} histogram")
+
+        for bound, count in sorted(buckets):
+            cumulative += count
+            lines.append(f"{metric}_bucket{_format_labels({**labels, 'le': f'{bound:g}'})} {cumulative}")
+
+        lines.append(f"{metric}_bucket{_format_labels({**labels, 'le': '+Inf'})} {values.get(f'{name}_count', 0)}")
+        lines.append(f"{metric}_sum{_format_labels(labels)} {values.get(f'{name}_sum', 0)}")
+        lines.append(f"{metric}_count{_format_labels(labels)} {values.get(f'{name}_count', 0)}")
+
+
+def render_metrics(stats: Dict[str, Any]) -> str:
+    """
+        Prometheus text exposition of the stats of DahuaVTOManager / DahuaVTOSupervisor:
+            flat sections (dahua, mqtt, supervisor) -> dahuavto2mqtt_{section}_{key}
+            devices -> dahuavto2mqtt_device_{key}{device="..."}
+            event_codes -> dahuavto2mqtt_device_events_by_code{device="...",code="..."}
+            event_codes_suppressed -> dahuavto2mqtt_device_events_suppressed_by_code{device="...",code="..."}
+    """
+    lines: List[str] = []
+
+    for section, values in sorted(stats.items()):
+        if section == STATS_DEVICES:
+            for device, device_values in sorted(values.items()):
+                _render_values(lines, "device", device_values, {"device": device})
+
+        elif section in CODE_SECTIONS:
+            metric = _metric_name("device", CODE_SECTIONS[section])
+
+            for device, codes in sorted(values.items()):
+                for code, count in sorted(codes.items()):
+                    lines.append(f"{metric}{_format_labels({'device': device, 'code': code})} {count}")
+
+        else:
+            _render_values(lines, section, values, {})
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    server: "MetricsServer"
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        try:
+            body = render_metrics(self.server.collect()).encode("utf-8")
+
+        except Exception as ex:
+            logger.error(f"Failed to collect metrics, error: {ex}")
+
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any):
+        # Scrapes are not worth a log line each
+        pass
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+        Serves GET /metrics from a daemon thread, the counters are collected on each scrape.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, collect: Callable[[], Dict[str, Any]], host: str = METRICS_HOST, port: int = METRICS_PORT):
+        super().__init__((host, port), MetricsHandler)
+
+        self.collect = collect
+        self._thread: Optional[Thread] = None
+
+    def start(self):
+        self._thread = Thread(target=self.serve_forever, name="MetricsServer", daemon=True)
+        self._thread.start()
+
+        logger.info(f"Serving metrics on http://{self.server_address[0]}:{self.server_address[1]}/metrics")
+
+    @classmethod
+    def start_if_enabled(cls, collect: Callable[[], Dict[str, Any]]) -> Optional["MetricsServer"]:
+        """
+            Start the server when METRICS_PORT is set, a port in use is logged and metrics stay off.
+        """
+        if not METRICS_PORT:
+            return None
+
+        try:
+            server = cls(collect)
+            server.start()
+
+            return server
+
+        except OSError as ex:
+            logger.error(f"Failed to serve metrics on {METRICS_HOST}:{METRICS_PORT}, error: {ex}")
+
+        return None
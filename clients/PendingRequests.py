@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import sys
+from time import monotonic
+from typing import Any, Callable, Dict, Optional
+
+from clients.SessionScheduler import SessionScheduler
+from common.consts import *
+
+logger = logging.getLogger(__name__)
+
+
+def is_no_reply(message: Dict[str, Any]) -> bool:
+    """
+        Whether the reply was made up by the table because the device did not answer (timeout / eviction),
+        unlike a device error it says nothing about what the device supports.
+    """
+    return message.get("timeout") is True
+
+
+class PendingRequest:
+    """
+        A request sent to the device and waiting for its reply.
+    """
+    __slots__ = ("request_id", "method", "handler", "future", "sent_at", "deadline")
+
+    def __init__(
+            self,
+            request_id: int,
+            method: str,
+            handler: Optional[Callable[[Dict[str, Any]], None]],
+            future: asyncio.Future,
+            timeout: float
+    ):
+        self.request_id = request_id
+        self.method = method
+        self.handler = handler
+        self.future = future
+        self.sent_at = monotonic()
+        self.deadline = self.sent_at + timeout
+
+    def complete(self, message: Dict[str, Any]):
+        if not self.future.done():
+            self.future.set_result(message)
+
+    def error_message(self, error: str) -> Dict[str, Any]:
+        """A reply in the device's format, handed to the handler when no reply arrived, see is_no_reply"""
+        return {
+            "id": self.request_id,
+            "result": False,
+            "error": {"code": REQUEST_NO_REPLY_CODE, "message": error},
+            "timeout": True
+        }
+
+
+class PendingRequestTable:
+    """
+        Correlates replies with the requests of a session.
+
+        An entry is removed when its reply arrives, when its deadline passes (the handler then receives
+        an error reply, so the usual retry / give up paths apply) or when the table is full (oldest first).
+        Every entry is awaitable as a future resolved with the reply, callers can keep many requests in flight.
+    """
+
+    def __init__(
+            self,
+            loop: asyncio.AbstractEventLoop,
+            scheduler: SessionScheduler,
+            timeout: float = REQUEST_TIMEOUT,
+            max_size: int = MAX_PENDING_REQUESTS
+    ):
+        self._loop = loop
+        self._scheduler = scheduler
+        self._timeout = timeout
+        self._max_size = max_size
+        self._entries: Dict[int, PendingRequest] = {}
+        self._sweeping = False
+
+        self.completed = 0
+        self.timeouts = 0
+        self.evicted = 0
+
+    @property
+    def size(self) -> int:
+        return len(self._entries)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "pending_requests": self.size,
+            "requests_completed": self.completed,
+            "request_timeouts": self.timeouts,
+            "requests_evicted": self.evicted
+        }
+
+    def __contains__(self, request_id: Any) -> bool:
+        return request_id in self._entries
+
+    def add(
+            self,
+            request_id: int,
+            method: str,
+            handler: Optional[Callable[[Dict[str, Any]], None]],
+            timeout: Optional[float] = None
+    ) -> asyncio.Future:
+        """
+            Track a request, must be called on the session's loop.
+
+        :return: A future resolved with the reply (or with the error reply on timeout / eviction)
+        """
+        while len(self._entries) >= self._max_size:
+            oldest = self._entries.pop(next(iter(self._entries)))
+            self.evicted += 1
+
+            logger.warning(f"Pending request table is full, evicting #{oldest.request_id} ({oldest.method})")
+
+            self._fail(oldest, "Request evicted")
+
+        entry = PendingRequest(
+            request_id,
+            method,
+            handler,
+            self._loop.create_future(),
+            self._timeout if timeout is None else timeout
+        )
+
+        self._entries[request_id] = entry
+
+        if not self._sweeping:
+            self._sweeping = True
+            self._scheduler.call_later(REQUEST_SWEEP_INTERVAL, self._sweep)
+
+        return entry.future
+
+    def pop(self, request_id: Any) -> Optional[PendingRequest]:
+        """
+            Take the request a reply belongs to out of the table.
+        """
+        entry = self._entries.pop(request_id, None)
+
+        if entry is not None:
+            self.completed += 1
+
+        return entry
+
+    def close(self):
+        """
+            Cancel all pending requests, used when the session is torn down.
+        """
+        for entry in self._entries.values():
+            entry.future.cancel()
+
+        self._entries.clear()
+
+    def _sweep(self):
+        now = monotonic()
+        expired = [entry for entry in self._entries.values() if entry.deadline <= now]
+
+        for entry in expired:
+            del self._entries[entry.request_id]
+            self.timeouts += 1
+
+            logger.warning(f"Request #{entry.request_id} ({entry.method}) timed out after {now - entry.sent_at:.1f} seconds")
+
+            self._fail(entry, "Request timed out")
+
+        if self._entries:
+            self._scheduler.call_later(REQUEST_SWEEP_INTERVAL, self._sweep)
+        else:
+            self._sweeping = False
+
+    @staticmethod
+    def _fail(entry: PendingRequest, error: str):
+        message = entry.error_message(error)
+
+        try:
+            if entry.handler is not None:
+                entry.handler(message)
+
+        except Exception as ex:
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+
+            logger.error(f"Failed to handle {error} of #{entry.request_id}, error: {ex}, Line: {exc_tb.tb_lineno}")
+
+        finally:
+            entry.complete(message)
@@ -0,0 +1,214 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import tracemalloc
+from datetime import datetime
+import signal
+from threading import Event, Lock, Thread, Timer, get_ident
+from typing import Dict, List, Optional
+
+from common.consts import *
+
+logger = logging.getLogger(__name__)
+
+# Python 3.12 profiles through sys.monitoring, one profiler covers all threads and only one can be active
+PROFILE_SHARED = sys.version_info >= (3, 12)
+
+
+class Profiler:
+    """
+        cProfile and tracemalloc capture of the live bridge for a bounded window, started by a signal (PROFILE_SIGNAL)
+        or the Profile command topic, written to PROFILE_DIR when the window ends.
+
+        The threads doing the work (event loop, MQTT listeners) call checkpoint() per unit of work, it enrolls them
+        while a capture runs and releases them once it ended. Idle, checkpoint is a single attribute check.
+    """
+
+    _instance: Optional["Profiler"] = None
+    _instance_lock = Lock()
+
+    def __init__(self, path: str = PROFILE_DIR):
+        self.path = path
+        self.active = False
+        self.captures = 0
+
+        # Set while threads have to check in, from start until the last profile was released
+        self._armed = False
+        self._lock = Lock()
+        self._profiles: Dict[Optional[int], cProfile.Profile] = {}
+        self._finished: List[cProfile.Profile] = []
+        self._released = Event()
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._started_at: Optional[datetime] = None
+
+    @classmethod
+    def get(cls) -> "Profiler":
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+
+        return cls._instance
+
+    @classmethod
+    def install_signal(cls):
+        """
+            Start a capture on PROFILE_SIGNAL (kill -USR1 <pid>), from the main thread.
+        """
+        if PROFILE_SIGNAL is None:
+            return
+
+        def on_signal(signum, frame):
+            # The interrupted thread may hold the lock, start from a thread of its own
+            Thread(target=cls.get().start, name="ProfilerStart", daemon=True).start()
+
+        signal.signal(PROFILE_SIGNAL, on_signal)
+
+    def start(self, duration: float = PROFILE_DURATION) -> bool:
+        """
+            Start a capture of duration seconds.
+
+        :return: False when a capture is already running
+        """
+        with self._lock:
+            if self._armed:
+                logger.warning("Profiling is already running")
+                return False
+
+            duration = min(max(1.0, float(duration)), PROFILE_MAX_DURATION)
+
+            self.active = True
+            self._armed = True
+            self._finished = []
+            self._released.clear()
+            self._started_at = datetime.now()
+
+            if PROFILE_TRACEMALLOC:
+                tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+                self._snapshot = tracemalloc.take_snapshot()
+
+        timer = Timer(duration, self.stop)
+        timer.daemon = True
+        timer.start()
+
+        logger.info(f"Profiling for {duration:.0f} seconds")
+
+        return True
+
+    def checkpoint(self):
+        """
+            Enroll the calling thread while a capture runs, release it once the capture ended.
+        """
+        if not self._armed:
+            return
+
+        key = None if PROFILE_SHARED else get_ident()
+
+        with self._lock:
+            profile = self._profiles.get(key)
+
+            if self.active and profile is None:
+                profile = cProfile.Profile()
+
+                try:
+                    profile.enable()
+
+                except ValueError as ex:
+                    # Another profiler / debugger holds the hook
+                    logger.error(f"Failed to enable profiling, error: {ex}")
+
+                    self.active = False
+                    return
+
+                self._profiles[key] = profile
+
+            elif not self.active and profile is not None:
+                # cProfile of Python < 3.12 can only be disabled by its own thread
+                profile.disable()
+
+                del self._profiles[key]
+                self._finished.append(profile)
+
+                if not self._profiles:
+                    self._armed = False
+                    self._released.set()
+
+    def stop(self):
+        """
+            End the capture and write the results, threads that do not check in within PROFILE_RELEASE_TIMEOUT
+            are left out (they release their profile on their next checkpoint).
+        """
+        with self._lock:
+            self.active = False
+
+            if not self._profiles:
+                self._armed = False
+                self._released.set()
+
+        self._released.wait(PROFILE_RELEASE_TIMEOUT)
+
+        with self._lock:
+            finished, self._finished = self._finished, []
+            snapshot, self._snapshot = self._snapshot, None
+
+            if not self._profiles:
+                self._armed = False
+
+        try:
+            self._dump(finished, snapshot)
+
+        except Exception as ex:
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+
+            logger.error(f"Failed to write the profile, error: {ex}, Line: {exc_tb.tb_lineno}")
+
+        finally:
+            if snapshot is not None:
+                tracemalloc.stop()
+
+    def _dump(self, profiles: List[cProfile.Profile], snapshot: Optional[tracemalloc.Snapshot]):
+        os.makedirs(self.path, exist_ok=True)
+
+        name = os.path.join(self.path, f"profile-{os.getpid()}-{self._started_at:%Y%m%d-%H%M%S}")
+        report = io.StringIO()
+        current = None
+
+        if snapshot is not None:
+            # Before the report is built, its own allocations are not of interest
+            current = tracemalloc.take_snapshot()
+            traced, peak = tracemalloc.get_traced_memory()
+
+        if profiles:
+            stats = pstats.Stats(profiles[0], stream=report)
+
+            for profile in profiles[1:]:
+                stats.add(profile)
+
+            # Binary stats for snakeviz / pstats, the text report for a quick look
+            stats.dump_stats(f"{name}.pstats")
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP)
+            stats.sort_stats(pstats.SortKey.TIME).print_stats(PROFILE_TOP)
+
+        else:
+            report.write("No thread did any work during the capture\n")
+
+        if current is not None:
+            report.write(f"\nTraced memory: {traced / 1024:.0f} KiB, peak: {peak / 1024:.0f} KiB\n")
+            report.write(f"\nAllocations during the capture, top {PROFILE_TOP}:\n")
+
+            for difference in current.compare_to(snapshot, "lineno")[:PROFILE_TOP]:
+                report.write(f"{difference}\n")
+
+            report.write(f"\nLargest allocations, top {PROFILE_TOP}:\n")
+
+            for statistic in current.statistics("lineno")[:PROFILE_TOP]:
+                report.write(f"{statistic}\n")
+
+        with open(f"{name}.txt", "w") as file:
+            file.write(report.getvalue())
+
+        self.captures += 1
+
+        logger.info(f"Profile written to {name}.txt")
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import sys
+import weakref
+from typing import Callable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class SessionScheduler:
+    """
+        Owns the periodic and one-shot work of a session (keepalives, door relock, bootstrap retries).
+
+        Everything runs on the session's event loop through call_later, so the number of threads stays constant
+        no matter how many timers or devices there are. Closing the scheduler cancels all pending work,
+        nothing keeps firing into the transport of a dead session after a reconnect.
+    """
+
+    _instances: "weakref.WeakSet[SessionScheduler]" = weakref.WeakSet()
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, name: str = ""):
+        self.name = name
+        self._loop = loop
+        self._handles: Set[asyncio.TimerHandle] = set()
+        self._is_closed = False
+
+        SessionScheduler._instances.add(self)
+
+    @property
+    def live(self) -> int:
+        """Number of timers waiting to fire"""
+        return len(self._handles)
+
+    @property
+    def is_closed(self) -> bool:
+        return self._is_closed
+
+    @classmethod
+    def live_total(cls) -> int:
+        """Number of timers waiting to fire across all sessions"""
+        return sum(scheduler.live for scheduler in list(cls._instances))
+
+    def call_later(self, delay: float, callback: Callable, *args) -> Optional[asyncio.TimerHandle]:
+        """
+            Run callback after delay seconds on the session's loop, safe to call from any thread.
+
+        :return: The timer handle when called from the loop's thread, None otherwise
+        """
+        if self._is_closed:
+            logger.debug(f"{self.name} scheduler is closed, ignoring {callback}")
+            return None
+
+        if self._in_loop():
+            return self._schedule(delay, callback, args)
+
+        self._loop.call_soon_threadsafe(self._schedule, delay, callback, args)
+
+        return None
+
+    def call_soon(self, callback: Callable, *args):
+        """
+            Run callback on the session's loop as soon as possible, safe to call from any thread.
+        """
+        self.call_later(0, callback, *args)
+
+    def cancel(self, handle: Optional[asyncio.TimerHandle]):
+        if handle is not None:
+            handle.cancel()
+            self._handles.discard(handle)
+
+    def close(self):
+        """
+            Cancel all pending work, the scheduler does not accept new work afterwards.
+        """
+        if self._is_closed:
+            return
+
+        self._is_closed = True
+
+        logger.debug(f"{self.name} scheduler closed, cancelling {self.live} timers")
+
+        for handle in list(self._handles):
+            handle.cancel()
+
+        self._handles.clear()
+
+    def _in_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+
+        except RuntimeError:
+            return False
+
+    def _schedule(self, delay: float, callback: Callable, args) -> Optional[asyncio.TimerHandle]:
+        if self._is_closed:
+            return None
+
+        handle: Optional[asyncio.TimerHandle] = None
+
+        def run():
+            self._handles.discard(handle)
+
+            try:
+                callback(*args)
+
+            except Exception as ex:
+                exc_type, exc_obj, exc_tb = sys.exc_info()
+
+                logger.error(f"{self.name} scheduled {callback} failed, error: {ex}, Line: {exc_tb.tb_lineno}")
+
+        handle = self._loop.call_later(delay, run)
+        self._handles.add(handle)
+
+        return handle
@@ -1,4 +1,6 @@
 import os
+import signal
+import tempfile
 __all__ = [
     "DEFAULT_MQTT_CLIENT_ID",
     "DEFAULT_MQTT_TOPIC_PREFIX",
@@ -14,7 +16,20 @@ __all__ = [
     "DAHUA_CONFIG_MANAGER_GETCONFIG",
     "DAHUA_MAGICBOX_GETSOFTWAREVERSION",
     "DAHUA_MAGICBOX_GETDEVICETYPE",
+    "DAHUA_SYSTEM_MULTICALL",
+    "DAHUA_ACCESS_CONTROL_FACTORY_INSTANCE",
+    "DAHUA_ACCESS_CONTROL_OPEN_DOOR",
+    "DOOR_OPEN_METHOD_HTTP",
+    "DOOR_OPEN_METHOD_RPC",
     "DAHUA_ALLOWED_DETAILS",
+    "DAHUA_EVENT_CODES_ALL",
+    "EVENT_ACTION_START",
+    "EVENT_ACTION_STOP",
+    "EVENT_DEBOUNCE_LEADING",
+    "EVENT_DEBOUNCE_TRAILING",
+    "EVENT_OBJECT_GONE_ACTIONS",
+    "EVENT_TRACK_TTL",
+    "EVENT_TRACK_MAX_OBJECTS",
     "ENDPOINT_ACCESS_CONTROL",
     "ENDPOINT_MAGICBOX_SYSINFO",
     "MQTT_ERROR_DEFAULT_MESSAGE",
@@ -22,13 +37,84 @@ __all__ = [
     "TOPIC_COMMAND",
     "TOPIC_DOOR",
     "TOPIC_MUTE",
+    "TOPIC_PROFILE",
     "ACCESS_CONTROL_ATTEMPTS",
     "SERIAL_NUMBER_ATTEMPTS",
     "DEVICE_TYPE_ATTEMPTS",
     "VERSION_ATTEMPTS",
+    "BOOTSTRAP_RETRY_DELAY",
+    "HTTP_REQUEST_TIMEOUT",
+    "REQUEST_TIMEOUT",
+    "REQUEST_SWEEP_INTERVAL",
+    "MAX_PENDING_REQUESTS",
+    "REQUEST_NO_REPLY_CODE",
+    "DEVICE_DETAILS_CACHE_FILE",
+    "DEVICE_DETAILS_CACHE_TTL",
+    "DEVICE_DETAILS_REVALIDATE_DELAY",
+    "DEVICE_DETAILS_FLUSH_DELAY",
+    "RECONNECT_INITIAL_DELAY",
+    "RECONNECT_MAX_DELAY",
+    "RECONNECT_JITTER",
+    "RECONNECT_MAX_CONCURRENT_LOGINS",
+    "LOGIN_TIMEOUT",
+    "WATCHDOG_INTERVAL",
+    "WATCHDOG_IDLE_TIMEOUT",
+    "WATCHDOG_EVENT_TIMEOUT",
+    "QUEUE_POLICY_BLOCK",
+    "QUEUE_POLICY_DROP_OLDEST",
+    "QUEUE_POLICY_DROP_NEWEST",
+    "QUEUE_POLICY_PRIORITY",
+    "QUEUE_POLICIES",
+    "QUEUE_PRIORITY_CODES",
+    "EVENT_QUEUE_SIZE",
+    "EVENT_QUEUE_POLICY",
+    "COMMAND_QUEUE_SIZE",
+    "COMMAND_QUEUE_POLICY",
+    "QUEUE_RESUME_INTERVAL",
+    "MQTT_MAX_QUEUED_MESSAGES",
+    "MQTT_KEEPALIVE",
+    "SPOOL_DIR",
+    "SPOOL_SEGMENT_SIZE",
+    "SPOOL_MAX_BYTES",
+    "SPOOL_MAX_AGE",
+    "SPOOL_FSYNC_ALWAYS",
+    "SPOOL_FSYNC_INTERVAL",
+    "SPOOL_FSYNC_NEVER",
+    "SPOOL_FSYNC_POLICIES",
+    "SPOOL_FSYNC",
+    "SPOOL_FSYNC_PERIOD",
+    "SPOOL_MMAP",
+    "SPOOL_REPLAY_RATE",
+    "METRICS_HOST",
+    "METRICS_PORT",
+    "METRICS_PREFIX",
+    "LATENCY_BUCKETS",
+    "STATS_DEVICES",
+    "STATS_EVENT_CODES",
+    "STATS_EVENT_CODES_SUPPRESSED",
+    "CLOCK_SKEW_WINDOW",
+    "EVENT_LATENCY_ATTACH",
+    "EVENT_TIMINGS_KEY",
+    "PROFILE_DIR",
+    "PROFILE_DURATION",
+    "PROFILE_MAX_DURATION",
+    "PROFILE_RELEASE_TIMEOUT",
+    "PROFILE_TRACEMALLOC",
+    "PROFILE_TRACEMALLOC_FRAMES",
+    "PROFILE_TOP",
+    "PROFILE_SIGNAL",
     "API_DEBUG",
     "MQTT_DEBUG",
     "KEEPALIVE_DEBUG",
+    "LISTEN_WORKERS",
+    "LISTEN_BATCH_SIZE",
+    "RUNTIME_THREADED",
+    "RUNTIME_ASYNCIO",
+    "RUNTIME_MODE",
+    "SUPERVISOR_WORKERS",
+    "SUPERVISOR_STATS_INTERVAL",
+    "SUPERVISOR_RESTART_DELAY",
+    "SUPERVISOR_RESTART_MAX_DELAY",
 ]
 
 DEFAULT_MQTT_CLIENT_ID = "DahuaVTO2MQTT"
@@ -51,6 +137,22 @@ DAHUA_EVENT_MANAGER_ATTACH = "eventManager.attach"
 DAHUA_CONFIG_MANAGER_GETCONFIG = "configManager.getConfig"
 DAHUA_MAGICBOX_GETSOFTWAREVERSION = "magicBox.getSoftwareVersion"
 DAHUA_MAGICBOX_GETDEVICETYPE = "magicBox.getDeviceType"
+DAHUA_SYSTEM_MULTICALL = "system.multicall"
+DAHUA_ACCESS_CONTROL_FACTORY_INSTANCE = "accessControl.factory.instance"
+DAHUA_ACCESS_CONTROL_OPEN_DOOR = "accessControl.openDoor"
+
+DOOR_OPEN_METHOD_HTTP = "http"
+DOOR_OPEN_METHOD_RPC = "rpc"
+
+DAHUA_EVENT_CODES_ALL = "All"
+
+EVENT_ACTION_START = "Start"
+EVENT_ACTION_STOP = "Stop"
+EVENT_DEBOUNCE_LEADING = "leading"
+EVENT_DEBOUNCE_TRAILING = "trailing"
+EVENT_OBJECT_GONE_ACTIONS = ("Disappear", "Leave")
+EVENT_TRACK_TTL = 30.0
+EVENT_TRACK_MAX_OBJECTS = 4096
 
 DAHUA_ALLOWED_DETAILS = [
     DAHUA_DEVICE_TYPE,
@@ -84,12 +186,118 @@ MQTT_ERROR_MESSAGES = {
 TOPIC_COMMAND = "/Command"
 TOPIC_DOOR = "Open"
 TOPIC_MUTE = "Mute"
+TOPIC_PROFILE = "Profile"
 
 ACCESS_CONTROL_ATTEMPTS = 4
 SERIAL_NUMBER_ATTEMPTS = 4
 DEVICE_TYPE_ATTEMPTS = 4
 VERSION_ATTEMPTS = 4
+BOOTSTRAP_RETRY_DELAY = 1.0
+HTTP_REQUEST_TIMEOUT = 10
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", 10))
+REQUEST_SWEEP_INTERVAL = 1.0
+MAX_PENDING_REQUESTS = max(1, int(os.environ.get("MAX_PENDING_REQUESTS", 1024)))
+# Error code of the reply made up when the device did not answer (timed out / evicted)
+REQUEST_NO_REPLY_CODE = -1
+
+DEVICE_DETAILS_CACHE_FILE = os.environ.get(
+    "DEVICE_DETAILS_CACHE_FILE",
+    # The volume of the container, see README
+    "/config/dahuavto2mqtt-details.json"
+)
+DEVICE_DETAILS_CACHE_TTL = float(os.environ.get("DEVICE_DETAILS_CACHE_TTL", 86400))
+DEVICE_DETAILS_REVALIDATE_DELAY = 60.0
+DEVICE_DETAILS_FLUSH_DELAY = 5.0
+
+RECONNECT_INITIAL_DELAY = float(os.environ.get("RECONNECT_INITIAL_DELAY", 1))
+RECONNECT_MAX_DELAY = float(os.environ.get("RECONNECT_MAX_DELAY", 60))
+RECONNECT_JITTER = min(1.0, max(0.0, float(os.environ.get("RECONNECT_JITTER", 0.5))))
+RECONNECT_MAX_CONCURRENT_LOGINS = max(1, int(os.environ.get("RECONNECT_MAX_CONCURRENT_LOGINS", 8)))
+LOGIN_TIMEOUT = 30.0
+
+WATCHDOG_INTERVAL = 5.0
+# 0 derives the limit from the keepalive interval of the session
+WATCHDOG_IDLE_TIMEOUT = float(os.environ.get("WATCHDOG_IDLE_TIMEOUT", 0))
+# 0 disables the check, quiet devices (doorbells) may go hours without an event
+WATCHDOG_EVENT_TIMEOUT = float(os.environ.get("WATCHDOG_EVENT_TIMEOUT", 0))
+
+QUEUE_POLICY_BLOCK = "block"
+QUEUE_POLICY_DROP_OLDEST = "drop_oldest"
+QUEUE_POLICY_DROP_NEWEST = "drop_newest"
+QUEUE_POLICY_PRIORITY = "priority"
+QUEUE_POLICIES = [QUEUE_POLICY_BLOCK, QUEUE_POLICY_DROP_OLDEST, QUEUE_POLICY_DROP_NEWEST, QUEUE_POLICY_PRIORITY]
+QUEUE_PRIORITY_CODES = [
+    code.strip()
+    for code in os.environ.get(
+        "QUEUE_PRIORITY_CODES",
+        "Invite,CallNoAnswered,IgnoreInvite,HungUp,DoorStatus,AccessControl,AlarmLocal,BackKeyLight,MagneticLock,Open,Mute"
+    ).split(",")
+    if code.strip()
+]
+# Events from the devices to MQTT
+EVENT_QUEUE_SIZE = max(0, int(os.environ.get("EVENT_QUEUE_SIZE", 10000)))
+EVENT_QUEUE_POLICY = str(os.environ.get("EVENT_QUEUE_POLICY", QUEUE_POLICY_PRIORITY)).casefold()
+# Commands from MQTT to the devices
+COMMAND_QUEUE_SIZE = max(0, int(os.environ.get("COMMAND_QUEUE_SIZE", 100)))
+COMMAND_QUEUE_POLICY = str(os.environ.get("COMMAND_QUEUE_POLICY", QUEUE_POLICY_DROP_OLDEST)).casefold()
+QUEUE_RESUME_INTERVAL = 0.1
+MQTT_MAX_QUEUED_MESSAGES = max(0, int(os.environ.get("MQTT_MAX_QUEUED_MESSAGES", 1000)))
+MQTT_KEEPALIVE = 60
+
+# Events published while the broker is away are spooled to disk, empty disables the spool
+SPOOL_DIR = os.environ.get("SPOOL_DIR", "")
+SPOOL_SEGMENT_SIZE = max(4096, int(os.environ.get("SPOOL_SEGMENT_SIZE", 4 * 1024 * 1024)))
+SPOOL_MAX_BYTES = max(0, int(os.environ.get("SPOOL_MAX_BYTES", 256 * 1024 * 1024)))
+SPOOL_MAX_AGE = max(0.0, float(os.environ.get("SPOOL_MAX_AGE", 86400)))
+SPOOL_FSYNC_ALWAYS = "always"
+SPOOL_FSYNC_INTERVAL = "interval"
+SPOOL_FSYNC_NEVER = "never"
+SPOOL_FSYNC_POLICIES = [SPOOL_FSYNC_ALWAYS, SPOOL_FSYNC_INTERVAL, SPOOL_FSYNC_NEVER]
+SPOOL_FSYNC = str(os.environ.get("SPOOL_FSYNC", SPOOL_FSYNC_INTERVAL)).casefold()
+SPOOL_FSYNC_PERIOD = float(os.environ.get("SPOOL_FSYNC_PERIOD", 1))
+SPOOL_MMAP = str(os.environ.get("SPOOL_MMAP", False)).casefold() == str(True).casefold()
+SPOOL_REPLAY_RATE = max(0.0, float(os.environ.get("SPOOL_REPLAY_RATE", 200)))
+
+# Prometheus text endpoint (GET /metrics), 0 does not serve it
+METRICS_HOST = os.environ.get("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+METRICS_PREFIX = "dahuavto2mqtt"
+# Seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Nested sections of the stats, keyed by device name
+STATS_DEVICES = "devices"
+STATS_EVENT_CODES = "event_codes"
+STATS_EVENT_CODES_SUPPRESSED = "event_codes_suppressed"
+
+# Seconds of events the clock offset of a device is estimated from
+CLOCK_SKEW_WINDOW = float(os.environ.get("CLOCK_SKEW_WINDOW", 300))
+# Add the measured latencies to the published payload (Latency)
+EVENT_LATENCY_ATTACH = str(os.environ.get("EVENT_LATENCY_ATTACH", False)).casefold() == str(True).casefold()
+# Receipt stamps of an event on its way through the pipeline, removed before it is queued
+EVENT_TIMINGS_KEY = "_timings"
+
+# Runtime profiling, started by PROFILE_SIGNAL or the Profile command
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "dahuavto2mqtt-profiles"))
+PROFILE_DURATION = float(os.environ.get("PROFILE_DURATION", 30))
+PROFILE_MAX_DURATION = 600.0
+PROFILE_RELEASE_TIMEOUT = 5.0
+PROFILE_TRACEMALLOC = str(os.environ.get("PROFILE_TRACEMALLOC", True)).casefold() == str(True).casefold()
+PROFILE_TRACEMALLOC_FRAMES = max(1, int(os.environ.get("PROFILE_TRACEMALLOC_FRAMES", 1)))
+PROFILE_TOP = 30
+PROFILE_SIGNAL = getattr(signal, "SIGUSR1", None)
 
 API_DEBUG = str(os.environ.get("API_DEBUG", False)).casefold() == str(True).casefold()
 MQTT_DEBUG = str(os.environ.get("MQTT_DEBUG", False)).casefold() == str(True).casefold()
-KEEPALIVE_DEBUG = str(os.environ.get("KEEPALIVE_DEBUG", False)).casefold() == str(True).casefold()
\ No newline at end of file
+KEEPALIVE_DEBUG = str(os.environ.get("KEEPALIVE_DEBUG", False)).casefold() == str(True).casefold()
+
+LISTEN_WORKERS = max(1, int(os.environ.get("LISTEN_WORKERS", 1)))
+LISTEN_BATCH_SIZE = max(1, int(os.environ.get("LISTEN_BATCH_SIZE", 64)))
+
+RUNTIME_THREADED = "threaded"
+RUNTIME_ASYNCIO = "asyncio"
+RUNTIME_MODE = str(os.environ.get("RUNTIME_MODE", RUNTIME_THREADED)).casefold()
+
+SUPERVISOR_WORKERS = max(1, int(os.environ.get("SUPERVISOR_WORKERS", os.cpu_count() or 1)))
+SUPERVISOR_STATS_INTERVAL = float(os.environ.get("SUPERVISOR_STATS_INTERVAL", 30))
+SUPERVISOR_RESTART_DELAY = 1.0
+SUPERVISOR_RESTART_MAX_DELAY = 60.0
@@ -1,5 +1,6 @@
+import json
 import os
-from typing import Optional
+from typing import Any, Dict, List, Optional, Union
 
 from requests.auth import HTTPDigestAuth
 
@@ -7,22 +8,69 @@ from common.consts import *
 
 
 class DahuaConfigurationData:
+    name: Optional[str]
     host: Optional[str]
+    port: int
     username: Optional[str]
     password: Optional[str]
     is_ssl: Optional[bool]
+    topic_prefix: Optional[str]
+    door_open_method: str
+    event_codes: List[str]
+    event_codes_exclude: List[str]
+    event_policies: Dict[str, Dict[str, Any]]
     auth: Optional[HTTPDigestAuth]
 
-    def __init__(self):
-        self.host = os.environ.get('DAHUA_VTO_HOST')
-        self.is_ssl = str(os.environ.get('DAHUA_VTO_SSL', False)).lower() == str(True).lower()
+    def __init__(self, data: Optional[Dict[str, Any]] = None):
+        """
+            Device settings, taken from one entry of the devices file or from the environment variables.
 
-        self.username = os.environ.get('DAHUA_VTO_USERNAME')
-        self.password = os.environ.get('DAHUA_VTO_PASSWORD')
+        :param data: An entry of the devices file, missing keys fall back to the environment variables
+        """
+        if data is None:
+            data = {}
+
+        self.host = data.get("host", os.environ.get('DAHUA_VTO_HOST'))
+        self.port = int(data.get("port", os.environ.get('DAHUA_VTO_PORT', 5000)))
+        self.name = data.get("name", self.host)
+        self.is_ssl = str(data.get("ssl", os.environ.get('DAHUA_VTO_SSL', False))).lower() == str(True).lower()
+
+        self.username = data.get("username", os.environ.get('DAHUA_VTO_USERNAME'))
+        self.password = data.get("password", os.environ.get('DAHUA_VTO_PASSWORD'))
+
+        self.topic_prefix = data.get(
+            "topic_prefix",
+            os.environ.get('MQTT_BROKER_TOPIC_PREFIX', DEFAULT_MQTT_TOPIC_PREFIX)
+        )
+
+        self.door_open_method = str(
+            data.get("door_open_method", os.environ.get('DAHUA_DOOR_OPEN_METHOD', DOOR_OPEN_METHOD_HTTP))
+        ).casefold()
+
+        self.event_codes = self._read_codes(
+            data.get("event_codes", os.environ.get('DAHUA_EVENT_CODES', DAHUA_EVENT_CODES_ALL))
+        ) or [DAHUA_EVENT_CODES_ALL]
+        self.event_codes_exclude = self._read_codes(
+            data.get("event_codes_exclude", os.environ.get('DAHUA_EVENT_CODES_EXCLUDE', ""))
+        )
+
+        event_policies = data.get("event_policies", os.environ.get('DAHUA_EVENT_POLICIES', "{}"))
+        self.event_policies = json.loads(event_policies) if isinstance(event_policies, str) else event_policies
 
         self._auth = HTTPDigestAuth(self.username, self.password)
         self._base_url = f"{PROTOCOLS[self.is_ssl]}://{self.host}/cgi-bin/"
 
+    @staticmethod
+    def _read_codes(value: Union[str, List[str], None]) -> List[str]:
+        """Event codes from a list (devices file) or a comma separated string (environment variable)"""
+        if value is None:
+            return []
+
+        if isinstance(value, str):
+            value = value.split(",")
+
+        return [str(code).strip() for code in value if str(code).strip()]
+
     @property
     def base_url(self):
         return self._base_url
@@ -0,0 +1,73 @@
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+from common.consts import *
+from models.DahuaConfigData import DahuaConfigurationData
+
+logger = logging.getLogger(__name__)
+
+
+class DevicesConfigurationData:
+    """
+        The devices bridged by this process.
+
+        DAHUA_DEVICES_FILE points to a JSON file listing the devices, each with its own credentials and topic prefix:
+            {"devices": [{"name": "front-door", "host": "10.0.0.5", "username": "admin", "password": "secret"}]}
+        Devices without a topic_prefix publish under MQTT_BROKER_TOPIC_PREFIX/<name>.
+        Without the file, a single device is configured from the DAHUA_VTO_* environment variables.
+    """
+    devices_file: Optional[str]
+    items: List[Dict[str, Any]]
+    devices: List[DahuaConfigurationData]
+
+    def __init__(self, devices_file: Optional[str] = None, items: Optional[List[Dict[str, Any]]] = None):
+        """
+        :param devices_file: Overrides DAHUA_DEVICES_FILE
+        :param items: Device entries as listed in the devices file, used instead of reading the file
+        """
+        self.devices_file = devices_file or os.environ.get('DAHUA_DEVICES_FILE')
+
+        if items is None and self.devices_file:
+            items = self.read(self.devices_file)
+
+        if items is None:
+            self.items = []
+            self.devices = [DahuaConfigurationData()]
+        else:
+            self.items = self._normalize(items)
+            self.devices = [DahuaConfigurationData(item) for item in self.items]
+
+            logger.info(f"Loaded {len(self.devices)} devices")
+
+    @staticmethod
+    def read(devices_file: str) -> List[Dict[str, Any]]:
+        with open(devices_file) as file:
+            data = json.load(file)
+
+        return data.get("devices", []) if isinstance(data, dict) else data
+
+    @staticmethod
+    def _normalize(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        topic_prefix = os.environ.get('MQTT_BROKER_TOPIC_PREFIX', DEFAULT_MQTT_TOPIC_PREFIX)
+        result = []
+
+        for item in items:
+            item = dict(item)
+
+            if not item.get("host"):
+                raise ValueError(f"Device without host: {item.get('name')}")
+
+            item.setdefault("name", item.get("host"))
+            item.setdefault("topic_prefix", f"{topic_prefix}/{item['name']}")
+
+            result.append(item)
+
+        names = [item["name"] for item in result]
+        duplicates = {name for name in names if names.count(name) > 1}
+
+        if duplicates:
+            raise ValueError(f"Device names must be unique, duplicates: {', '.join(sorted(duplicates))}")
+
+        return result